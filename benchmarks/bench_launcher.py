@@ -0,0 +1,55 @@
+"""Compare the time to start NiftyReg from a parent that holds a lot of memory.
+
+Allocates (and touches) a large array, then runs the same short NiftyReg
+command repeatedly with every launcher backend, with and without CPU pinning.
+Before Python 3.10, the popen backend copies the page tables of the parent.
+Needs the NiftyReg binaries on the PATH.
+
+Usage:
+    python benchmarks/bench_launcher.py [--gb N] [--calls N] [--cmd CMD]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from niftyregpy import utils
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--gb", type=float, default=4)
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--cmd", default="reg_tools -h")
+    args = parser.parse_args()
+
+    # Resident memory of the parent, every page written once
+    ballast = np.ones(int(args.gb * (1 << 30)) // 8)
+
+    print(f"{ballast.nbytes / (1 << 30):.1f} GB resident, {args.calls} x {args.cmd}")
+    print(f"{'backend':>8} {'pin':>5} {'time':>9} {'ms/call':>8}")
+
+    for backend in utils.launcher.BACKENDS:
+        utils.set_launcher(backend)
+
+        for pin in (False, True):
+            utils.set_thread_budget(pin=pin)
+
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                assert utils.call_niftyreg(args.cmd), args.cmd
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{backend:>8} {str(pin):>5} {elapsed:>8.2f}s "
+                f"{1000 * elapsed / args.calls:>8.2f}"
+            )
+
+    utils.set_thread_budget()
+    utils.set_launcher()
+
+
+if __name__ == "__main__":
+    main()
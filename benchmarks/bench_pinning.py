@@ -0,0 +1,74 @@
+"""Compare batch registration throughput with and without CPU pinning.
+
+Runs the same f3d batch with every job free to migrate between cores, and with
+every job bound to its own CPUs (grouped by NUMA node). Needs the NiftyReg
+binaries on the PATH.
+
+Usage:
+    python benchmarks/bench_pinning.py [--jobs N] [--workers N] [--size N]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from niftyregpy import reg, utils
+
+
+def _pairs(jobs, size, sigma=4):
+
+    # Smoothed noise and shifted copies of it, both filtered in the Fourier
+    # domain so that numpy is enough
+    rng = np.random.default_rng(0)
+    spectrum = np.fft.fftn(rng.random((size, size, size)))
+    k = np.meshgrid(*[np.fft.fftfreq(size)] * 3, indexing="ij")
+    spectrum *= np.exp(-2 * (np.pi * sigma) ** 2 * sum(x**2 for x in k))
+
+    def shifted(d):
+        ramp = np.exp(-2j * np.pi * sum(x * y for x, y in zip(k, d)))
+        return np.fft.ifftn(spectrum * ramp).real.astype(np.float32)
+
+    ref = shifted((0, 0, 0))
+    flos = [shifted(rng.uniform(-3, 3, size=3)) for _ in range(jobs)]
+
+    return ref, flos
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--size", type=int, default=96)
+    parser.add_argument("--maxit", type=int, default=100)
+    args = parser.parse_args()
+
+    ref, flos = _pairs(args.jobs, args.size)
+    nodes = utils.numa_nodes()
+
+    print(f"{utils.cpu_count()} CPUs in {len(nodes)} NUMA node(s)")
+    print(f"{'pin':>5} {'workers':>8} {'omp':>4} {'time':>9} {'jobs/s':>8}")
+
+    for pin in (False, True):
+        utils.set_thread_budget(pin=pin)
+        omp = max(1, utils.get_thread_budget()["threads"] // args.workers)
+
+        start = time.perf_counter()
+        results, failures = reg.f3d_batch(
+            ref, flos, workers=args.workers, maxit=args.maxit, outputs="transform"
+        )
+        elapsed = time.perf_counter() - start
+
+        assert not failures, failures
+
+        print(
+            f"{str(pin):>5} {args.workers:>8} {omp:>4} {elapsed:>8.2f}s "
+            f"{args.jobs / elapsed:>8.2f}"
+        )
+
+    utils.set_thread_budget()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare the raw staging writer with write_nifti.
+
+Usage:
+    python benchmarks/bench_staging.py [--repeat N] > bench_output.txt
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+
+from niftyregpy.utils import write_nifti, write_nifti_raw
+
+SHAPES = [(32, 32, 32), (64, 64, 64), (128, 128, 64), (256, 256, 128)]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    affine = np.diag((0.8, 0.8, 2.5, 1.0))
+
+    print(f"{'shape':>16} {'order':>5} {'write_nifti':>12} {'raw':>10} {'speedup':>8}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        name = os.path.join(folder, "staged.nii")
+
+        for shape in SHAPES:
+            for order in ("C", "F"):
+                array = np.asarray(np.random.rand(*shape), np.float32, order=order)
+
+                t_nib = min(
+                    timeit.repeat(
+                        lambda: write_nifti(name, array, affine),
+                        number=1,
+                        repeat=args.repeat,
+                    )
+                )
+                t_raw = min(
+                    timeit.repeat(
+                        lambda: write_nifti_raw(name, array, affine),
+                        number=1,
+                        repeat=args.repeat,
+                    )
+                )
+
+                print(
+                    f"{str(shape):>16} {order:>5} {t_nib * 1e3:>10.2f}ms "
+                    f"{t_raw * 1e3:>8.2f}ms {t_nib / t_raw:>7.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
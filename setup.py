@@ -2,7 +2,12 @@ from setuptools import setup
 
 if __name__ == "__main__":
 
-    REQUIRED_PACKAGES = ["numpy", "nibabel", "tqdm"]
+    REQUIRED_PACKAGES = [
+        "numpy",
+        "nibabel",
+        "tqdm",
+        'contextvars; python_version < "3.7"',
+    ]
 
     setup(
         name="niftyregpy",
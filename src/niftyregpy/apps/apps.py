@@ -1,11 +1,57 @@
+import os
 import shlex
-import tempfile as tmp
 from os import path
 
+import nibabel as nib
 import numpy as np
 from tqdm import tqdm
 
-from ..utils import call_niftyreg, read_nifti, write_nifti
+from ..utils import (
+    Image,
+    call_niftyreg,
+    is_image,
+    pinning,
+    read_nifti,
+    read_niftis,
+    scratch_dir,
+    span,
+    stage_nifti,
+    stage_niftis,
+)
+
+
+def _apply(x, fn):
+    # Apply fn to the data of an array or Image, keeping the geometry
+    return x.with_array(fn(x.array)) if is_image(x) else fn(x)
+
+
+def _loaded(x):
+    # Load paths and nibabel images, so that their data can be normalized
+    if isinstance(x, nib.spatialimages.SpatialImage):
+        return Image.from_nifti(x)
+    if isinstance(x, (str, os.PathLike)):
+        img = read_nifti(x, as_image=True)
+        assert img is not None, f"Could not read {x}"
+        return img
+    return x
+
+
+def _progress(pbar, subject, on_event):
+
+    # Show the progress of the running NiftyReg call next to the progress bar
+    if pbar.disable and on_event is None:
+        return None
+
+    def handle(event):
+        if event.kind == "iteration" and subject is not None:
+            postfix = {"subject": subject, "it": event.iteration}
+            if event.level is not None:
+                postfix["level"] = f"{event.level}/{event.levels}"
+            pbar.set_postfix(postfix)
+        if on_event is not None:
+            on_event(subject, event)
+
+    return handle
 
 
 def groupwise(
@@ -19,6 +65,8 @@ def groupwise(
     nrr_args=None,
     normalize=False,
     nan_out=False,
+    pin=None,
+    on_event=None,
     verbose=False,
     show_pbar=True,
 ) -> tuple:
@@ -31,7 +79,9 @@ def groupwise(
     transforms are averaged, and used to initialize the next iteration.
 
     Arguments can be passed to both reg_aladin and reg_f3d using the
-    ``affine_args`` and ``nrr_args`` arguments.
+    ``affine_args`` and ``nrr_args`` arguments. All calls take their threads
+    from the thread budget of the process (see ``utils.set_thread_budget``),
+    and run with as many threads as ``-omp`` in these arguments asks for.
 
     If no template image is explicitly provided, the first image in ``input_imgs``
     will be used to initialize the atlas.
@@ -43,15 +93,24 @@ def groupwise(
 
     Args:
         input_imgs (tuple): Tuple that contains the images to create the atlas.
+            If the template (or the first image) is an Image, the outputs are
+            returned as Images.
         template (array): Template image to use to initialize the atlas (optional).
-        input_mask (tuple): Masks for the input images (optional).
+        input_mask (tuple): Masks for the input images, or one mask for all of
+            them (optional).
         template_mask (array): Mask for the template image (optional).
         aff_it_num (int): Number of affine iterations to perform (default = 5).
         nrr_it_num (int): Number of non-rigid iterations to perform (default = 10).
         affine_args (str): Arguments to use for the affine registration (optional).
         nrr_args (str): Arguments to use for the non-rigid registration (optional).
-        normalize (bool): Normalize input images [0, 1] (default = False).
+        normalize (bool): Normalize input images [0, 1]. Paths and nibabel
+            images are loaded to be normalized (default = False).
         nan_out (bool): If True, output NaN values (default = False).
+        pin (bool): Bind every NiftyReg call to its own CPUs, grouped by NUMA
+            node (default = as set by ``utils.set_thread_budget``).
+        on_event (callable): Called with the index of the input image (None
+            for averaging) and a ``utils.NiftyRegEvent`` for every line of
+            NiftyReg output (optional).
         verbose (bool): Verbose output (default = False).
         show_pbar (bool): Show progress bars (default = True).
 
@@ -72,7 +131,7 @@ def groupwise(
     ), "Less than 2 input images have been specified"
 
     # If only one input_mask is provided, duplicate it to number of input images
-    if isinstance(input_mask, np.ndarray):
+    if input_mask is not None and not isinstance(input_mask, (tuple, list)):
         input_mask = [input_mask for _ in input_imgs]
 
     assert input_mask is None or len(input_imgs) == len(
@@ -90,218 +149,251 @@ def groupwise(
     if template is None:
         template = input_imgs[0]
 
+    as_image = is_image(template)
+
     if normalize:
-        max_val = [x.max() for x in input_imgs]
-        min_val = [x.min() for x in input_imgs]
+        input_imgs = [_loaded(x) for x in input_imgs]
+        template = _loaded(template)
+        max_val = [np.max(x) for x in input_imgs]
+        min_val = [np.min(x) for x in input_imgs]
         input_imgs = [
-            (x - z) / (y - z) for x, y, z in zip(input_imgs, max_val, min_val)
+            _apply(x, lambda a, y=y, z=z: (a - z) / (y - z))
+            for x, y, z in zip(input_imgs, max_val, min_val)
         ]
-        template = (template - template.min()) / (template.max() - template.min())
+        y, z = np.max(template), np.min(template)
+        template = _apply(template, lambda a: (a - z) / (y - z))
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(template, *input_imgs) as tmp_folder, pinning(pin), span(
+        "groupwise"
+    ):
 
-        write_nifti(path.join(tmp_folder, "template.nii"), template)
+        # Staged files may be links to the cache or the caller's own files, so
+        # the commands use the paths returned by staging
+        average_image = stage_nifti(path.join(tmp_folder, "template.nii"), template)
 
-        for i, img in enumerate(input_imgs):
-            write_nifti(path.join(tmp_folder, f"input_{i}.nii"), img)
+        inputs = stage_niftis(path.join(tmp_folder, "input"), input_imgs)
 
         if input_mask is not None:
-            for i, mask in enumerate(input_mask):
-                write_nifti(path.join(tmp_folder, f"input_mask_{i}.nii"), mask)
+            input_mask = stage_niftis(
+                path.join(tmp_folder, "input_mask"), input_mask, "mask"
+            )
 
         if template_mask is not None:
-            write_nifti(path.join(tmp_folder, "template_mask.nii"), template_mask)
-
-        average_image = path.join(tmp_folder, "template.nii")
+            template_mask = stage_nifti(
+                path.join(tmp_folder, "template_mask.nii"), template_mask, kind="mask"
+            )
 
         # Run the rigid or affine registration
         with tqdm(
-            total=aff_it_num, desc="Affine registration", disable=not show_pbar
+            total=aff_it_num * len(input_imgs),
+            desc="Affine registration",
+            disable=not show_pbar,
         ) as pbar:
             for cur_it in range(aff_it_num):
+                with span("affine iteration", iteration=cur_it + 1):
+                    for i, _ in enumerate(input_imgs):
 
-                for i, _ in enumerate(input_imgs):
-
-                    aladin_args = ""
-
-                    if cur_it > 0:
-                        prev_affine_file = path.join(
-                            tmp_folder,
-                            f"aff_mat_input_{i}_it{cur_it}.txt",
-                        )
-                        aladin_args += f" -inaff {prev_affine_file}"
-                    else:
-                        aladin_args += " -rigOnly"
-
-                    # Check if a mask has been specified for the reference image
-                    if template_mask is not None:
-                        aladin_args += " -rmask " + path.join(
-                            tmp_folder, "template_mask.nii"
-                        )
-
-                    if input_mask is not None:
-                        aladin_args += " -fmask " + path.join(
-                            tmp_folder, f"input_mask_{i}.nii"
-                        )
-
-                    cur_affine_file = path.join(
-                        tmp_folder,
-                        f"aff_mat_input_{i}_it{cur_it+1}.txt",
-                    )
-                    aladin_args += f" -ref {average_image}"
-                    aladin_args += " -flo " + path.join(tmp_folder, f"input_{i}.nii")
-                    aladin_args += f" -aff {cur_affine_file}"
-
-                    if cur_it == aff_it_num - 1:
-                        aladin_args += " -res " + path.join(
-                            tmp_folder,
-                            f"aff_res_input_{i}_it{cur_it+1}.nii",
-                        )
-
-                    if affine_args is not None:
-                        for x in shlex.split(affine_args):
-                            aladin_args += f" {shlex.quote(x)}"
+                        aladin_args = ""
 
-                    aladin_cmd = f"reg_aladin {aladin_args}"
+                        if cur_it > 0:
+                            prev_affine_file = path.join(
+                                tmp_folder,
+                                f"aff_mat_input_{i}_it{cur_it}.txt",
+                            )
+                            aladin_args += f" -inaff {shlex.quote(prev_affine_file)}"
+                        else:
+                            aladin_args += " -rigOnly"
 
-                    assert call_niftyreg(aladin_cmd, verbose), "Aladin command failed!"
+                        # Check if a mask has been specified for the reference image
+                        if template_mask is not None:
+                            aladin_args += f" -rmask {shlex.quote(template_mask)}"
 
-                if cur_it < aff_it_num - 1:
-                    # The transformations are demeaned to create the average image
-                    # Note that this is not done for the last iteration step
+                        if input_mask is not None:
+                            aladin_args += f" -fmask {shlex.quote(input_mask[i])}"
 
-                    average_args = path.join(
-                        tmp_folder, f"average_affine_it_{cur_it+1}.nii"
-                    )
-                    average_args += " -demean1 "
-                    average_args += f"{average_image} "
-                    for i, _ in enumerate(input_imgs):
                         cur_affine_file = path.join(
                             tmp_folder,
                             f"aff_mat_input_{i}_it{cur_it+1}.txt",
                         )
-                        cur_img = path.join(tmp_folder, f"input_{i}.nii")
-                        average_args += f"{cur_affine_file} {cur_img} "
+                        aladin_args += f" -ref {shlex.quote(average_image)}"
+                        aladin_args += f" -flo {shlex.quote(inputs[i])}"
+                        aladin_args += f" -aff {shlex.quote(cur_affine_file)}"
+
+                        if cur_it == aff_it_num - 1:
+                            cur_res = path.join(
+                                tmp_folder,
+                                f"aff_res_input_{i}_it{cur_it+1}.nii",
+                            )
+                            aladin_args += f" -res {shlex.quote(cur_res)}"
+
+                        if affine_args is not None:
+                            for x in shlex.split(affine_args):
+                                aladin_args += f" {shlex.quote(x)}"
+
+                        aladin_cmd = f"reg_aladin {aladin_args}"
+
+                        with span("subject", index=i):
+                            assert call_niftyreg(
+                                aladin_cmd,
+                                verbose,
+                                on_event=_progress(pbar, i, on_event),
+                            ), "Aladin command failed!"
+                        pbar.update()
+
+                    if cur_it < aff_it_num - 1:
+                        # The transformations are demeaned to create the average image
+                        # Note that this is not done for the last iteration step
+
+                        average_out = path.join(
+                            tmp_folder, f"average_affine_it_{cur_it+1}.nii"
+                        )
+                        average_args = shlex.quote(average_out)
+                        average_args += " -demean1 "
+                        average_args += f"{shlex.quote(average_image)} "
+                        for i, _ in enumerate(input_imgs):
+                            cur_affine_file = path.join(
+                                tmp_folder,
+                                f"aff_mat_input_{i}_it{cur_it+1}.txt",
+                            )
+                            average_args += f"{shlex.quote(cur_affine_file)} "
+                            average_args += f"{shlex.quote(inputs[i])} "
 
-                else:
-                    # All the result images are directly averaged during the last step
-                    average_args = path.join(
+                    else:
+                        # All the result images are directly averaged during the
+                        # last step
+                        average_out = path.join(
+                            tmp_folder, f"average_affine_it_{cur_it+1}.nii"
+                        )
+                        average_args = shlex.quote(average_out)
+                        average_args += " -avg"
+
+                        for i, _ in enumerate(input_imgs):
+                            cur_img = path.join(
+                                tmp_folder,
+                                f"aff_res_input_{i}_it{cur_it+1}.nii",
+                            )
+                            average_args += f" {shlex.quote(cur_img)}"
+
+                    average_cmd = f"reg_average {average_args}"
+                    assert call_niftyreg(
+                        average_cmd, verbose, on_event=_progress(pbar, None, on_event)
+                    ), "Average command failed!"
+
+                    average_image = path.join(
                         tmp_folder, f"average_affine_it_{cur_it+1}.nii"
                     )
 
-                    average_args += " -avg"
-
-                    for i, _ in enumerate(input_imgs):
-                        cur_img = path.join(
-                            tmp_folder,
-                            f"aff_res_input_{i}_it{cur_it+1}.nii",
-                        )
-                        average_args += f" {cur_img}"
-
-                average_cmd = f"reg_average {average_args}"
-                assert call_niftyreg(average_cmd, verbose), "Average command failed!"
-
-                average_image = path.join(
-                    tmp_folder, f"average_affine_it_{cur_it+1}.nii"
-                )
-                pbar.update()
-
         with tqdm(
-            total=nrr_it_num, desc="Non-rigid registration", disable=not show_pbar
+            total=nrr_it_num * len(input_imgs),
+            desc="Non-rigid registration",
+            disable=not show_pbar,
         ) as pbar:
             for cur_it in range(nrr_it_num):
+                with span("non-rigid iteration", iteration=cur_it + 1):
+                    for i, _ in enumerate(input_imgs):
 
-                for i, _ in enumerate(input_imgs):
-
-                    f3d_args = f" -ref {average_image}"
-                    f3d_args += " -flo "
-                    f3d_args += path.join(tmp_folder, f"input_{i}.nii")
-                    f3d_args += " -cpp "
-                    f3d_args += path.join(
-                        tmp_folder,
-                        f"nrr_cpp_input_{i}_it{cur_it+1}.nii",
-                    )
-
-                    if cur_it == nrr_it_num - 1:
-                        f3d_args += " -res " + path.join(
+                        f3d_args = f" -ref {shlex.quote(average_image)}"
+                        f3d_args += f" -flo {shlex.quote(inputs[i])}"
+                        cur_cpp = path.join(
                             tmp_folder,
-                            f"nrr_res_input_{i}_it{cur_it+1}.nii",
+                            f"nrr_cpp_input_{i}_it{cur_it+1}.nii",
                         )
-
-                    # Check if a mask has been specified for the reference image
-                    if template_mask is not None:
-                        f3d_args += " -rmask "
-                        f3d_args += path.join(tmp_folder, "template_mask.nii")
-
-                    if input_mask is not None:
-                        f3d_args += " -fmask "
-                        f3d_args += path.join(tmp_folder, f"input_mask_{i}.nii")
-
-                    if aff_it_num > 0:
-                        f3d_args += " -aff "
-                        f3d_args += path.join(
+                        f3d_args += f" -cpp {shlex.quote(cur_cpp)}"
+
+                        if cur_it == nrr_it_num - 1:
+                            cur_res = path.join(
+                                tmp_folder,
+                                f"nrr_res_input_{i}_it{cur_it+1}.nii",
+                            )
+                            f3d_args += f" -res {shlex.quote(cur_res)}"
+
+                        # Check if a mask has been specified for the reference image
+                        if template_mask is not None:
+                            f3d_args += f" -rmask {shlex.quote(template_mask)}"
+
+                        if input_mask is not None:
+                            f3d_args += f" -fmask {shlex.quote(input_mask[i])}"
+
+                        if aff_it_num > 0:
+                            cur_affine_file = path.join(
+                                tmp_folder,
+                                f"aff_mat_input_{i}_it{aff_it_num}.txt",
+                            )
+                            f3d_args += f" -aff {shlex.quote(cur_affine_file)}"
+
+                        if nrr_args is not None:
+                            for x in shlex.split(nrr_args):
+                                f3d_args += f" {shlex.quote(x)}"
+
+                        f3d_cmd = f"reg_f3d {f3d_args}"
+                        with span("subject", index=i):
+                            assert call_niftyreg(
+                                f3d_cmd, verbose, on_event=_progress(pbar, i, on_event)
+                            ), "f3d command failed!"
+                        pbar.update()
+
+                    # The transformation are demeaned to create the average image
+                    # Note that this is not done for the last iteration step
+                    if cur_it < nrr_it_num - 1:
+                        average_out = path.join(
                             tmp_folder,
-                            f"aff_mat_input_{i}_it{aff_it_num}.txt",
+                            f"average_nonrigid_it_{cur_it+1}.nii",
                         )
+                        average_args = shlex.quote(average_out)
+                        average_args += " -demean_noaff "
+                        average_args += shlex.quote(average_image)
+                        for i, _ in enumerate(input_imgs):
+                            cur_affine_file = path.join(
+                                tmp_folder,
+                                f"aff_mat_input_{i}_it{aff_it_num}.txt",
+                            )
+                            cur_f3d_file = path.join(
+                                tmp_folder,
+                                f"nrr_cpp_input_{i}_it{cur_it+1}.nii",
+                            )
+                            average_args += f" {shlex.quote(cur_affine_file)}"
+                            average_args += f" {shlex.quote(cur_f3d_file)}"
+                            average_args += f" {shlex.quote(inputs[i])}"
 
-                    if nrr_args is not None:
-                        for x in shlex.split(nrr_args):
-                            f3d_args += f" {shlex.quote(x)}"
-
-                    f3d_cmd = f"reg_f3d {f3d_args}"
-                    assert call_niftyreg(f3d_cmd, verbose), "f3d command failed!"
-
-                # The transformation are demeaned to create the average image
-                # Note that this is not done for the last iteration step
-                if cur_it < nrr_it_num - 1:
-                    average_args = path.join(
+                    else:
+                        # All the result images are directly averaged during the
+                        # last step
+                        average_out = path.join(
+                            tmp_folder, f"average_nonrigid_it_{cur_it+1}.nii"
+                        )
+                        average_args = shlex.quote(average_out)
+                        average_args += " -avg"
+                        for i, _ in enumerate(input_imgs):
+                            cur_img = path.join(
+                                tmp_folder,
+                                f"nrr_res_input_{i}_it{cur_it+1}.nii",
+                            )
+                            average_args += f" {shlex.quote(cur_img)}"
+
+                    average_cmd = f"reg_average {average_args}"
+                    assert call_niftyreg(
+                        average_cmd, verbose, on_event=_progress(pbar, None, on_event)
+                    ), "Average command failed!"
+                    average_image = path.join(
                         tmp_folder,
                         f"average_nonrigid_it_{cur_it+1}.nii",
                     )
-                    average_args += " -demean_noaff "
-                    average_args += average_image
-                    for i, _ in enumerate(input_imgs):
-                        cur_affine_file = path.join(
-                            tmp_folder,
-                            f"aff_mat_input_{i}_it{aff_it_num}.txt",
-                        )
-                        cur_f3d_file = path.join(
-                            tmp_folder,
-                            f"nrr_cpp_input_{i}_it{cur_it+1}.nii",
-                        )
-                        cur_img = path.join(tmp_folder, f"input_{i}.nii")
-                        average_args += f" {cur_affine_file} {cur_f3d_file} {cur_img}"
-
-                else:
-                    # All the result images are directly averaged during the last step
-                    average_args = path.join(
-                        tmp_folder, f"average_nonrigid_it_{cur_it+1}.nii"
-                    )
-                    average_args += " -avg"
-                    for i, _ in enumerate(input_imgs):
-                        cur_img = path.join(
-                            tmp_folder,
-                            f"nrr_res_input_{i}_it{cur_it+1}.nii",
-                        )
-                        average_args += f" {cur_img}"
-
-                average_cmd = f"reg_average {average_args}"
-                assert call_niftyreg(average_cmd, verbose), "Average command failed!"
-                average_image = path.join(
-                    tmp_folder,
-                    f"average_nonrigid_it_{cur_it+1}.nii",
-                )
-
-                pbar.update()
 
-        average = read_nifti(average_image, output_nan=nan_out)
+        average = read_nifti(average_image, output_nan=nan_out, as_image=as_image)
 
-        res = []
-        for i, _ in enumerate(input_imgs):
-            cur_img = path.join(tmp_folder, f"nrr_res_input_{i}_it{cur_it+1}.nii")
-            res.append(read_nifti(cur_img, output_nan=nan_out))
+        res = read_niftis(
+            [
+                path.join(tmp_folder, f"nrr_res_input_{i}_it{cur_it+1}.nii")
+                for i, _ in enumerate(input_imgs)
+            ],
+            output_nan=nan_out,
+            as_image=as_image,
+        )
 
         if normalize:
-            res = [x * (y - z) + z for x, y, z in zip(res, max_val, min_val)]
+            res = [
+                _apply(x, lambda a, y=y, z=z: a * (y - z) + z)
+                for x, y, z in zip(res, max_val, min_val)
+            ]
 
     return average, res
@@ -1,10 +1,25 @@
 import os
-import tempfile as tmp
-
-from ..utils import call_niftyreg, read_nifti, read_txt, write_nifti, write_txt
-
-
-def avg(input, output=None, verbose=False):
+import shlex
+
+from ..utils import (
+    Geometry,
+    NiftyRegCall,
+    is_affine,
+    is_image,
+    niftyreg_command,
+    output_file,
+    read_nifti,
+    read_txt,
+    scratch_dir,
+    stage_geometry,
+    stage_nifti,
+    stage_niftis,
+    stage_txt,
+)
+
+
+@niftyreg_command
+def avg(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     If input are images, their intensities are averaged.
@@ -12,6 +27,8 @@ def avg(input, output=None, verbose=False):
     Args:
         input (tuple): Input images or affines to be averaged.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -22,46 +39,51 @@ def avg(input, output=None, verbose=False):
         >>> out = expm(sum(logm(aff) for aff in input) / len(input))
     """
 
-    if all(a.shape == (4, 4) for a in input):
-        return _avg_txt(input, output, verbose)
+    if all(is_affine(a) for a in input):
+        return (yield from _avg_txt(input, output, verbose))
     else:
-        return _avg_nii(input, output, verbose)
+        return (yield from _avg_nii(input, output, verbose, out=out, dtype=dtype))
 
 
 def _avg_txt(input, output=None, verbose=False):
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir() as tmp_folder:
 
         if output is None:
             output = os.path.join(tmp_folder, "output.txt")
+        output = os.fspath(output)
 
-        cmd_str = f"reg_average {output}"
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -avg "
 
         for i, x in enumerate(input):
-            write_txt(os.path.join(tmp_folder, f"avg_{i}.txt"), x)
-            cmd_str += os.path.join(tmp_folder, f"avg_{i}.txt") + " "
+            x = stage_txt(os.path.join(tmp_folder, f"avg_{i}.txt"), x)
+            cmd_str += f"{shlex.quote(x)} "
 
-        return read_txt(output) if call_niftyreg(cmd_str, verbose) else None
+        return read_txt(output) if (yield NiftyRegCall(cmd_str, verbose)) else None
 
 
-def _avg_nii(input, output=None, verbose=False):
+def _avg_nii(input, output=None, verbose=False, out=None, dtype=None):
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(*input) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(input[0])
 
-        cmd_str = f"reg_average {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -avg "
 
-        for i, x in enumerate(input):
-            write_nifti(os.path.join(tmp_folder, f"avg_{i}.nii"), x)
-            cmd_str += os.path.join(tmp_folder, f"avg_{i}.nii") + " "
+        for x in stage_niftis(os.path.join(tmp_folder, "avg"), input):
+            cmd_str += f"{shlex.quote(x)} "
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
+    return None
 
+
+@niftyreg_command
 def avg_lts(aff, output=None, verbose=False):
 
     """
@@ -78,34 +100,39 @@ def avg_lts(aff, output=None, verbose=False):
 
     """
 
-    assert all(a.shape == (4, 4) for a in aff), "Not affine matrices"
+    assert all(is_affine(a) for a in aff), "Not affine matrices"
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir() as tmp_folder:
 
         if output is None:
             output = os.path.join(tmp_folder, "output.txt")
+        output = os.fspath(output)
 
-        cmd_str = f"reg_average {output}"
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -avg_lts "
 
         for i, x in enumerate(aff):
-            write_txt(os.path.join(tmp_folder, f"avg_{i}.txt"), x)
-            cmd_str += os.path.join(tmp_folder, f"avg_{i}.txt") + " "
+            x = stage_txt(os.path.join(tmp_folder, f"avg_{i}.txt"), x)
+            cmd_str += f"{shlex.quote(x)} "
 
-        return read_txt(output) if call_niftyreg(cmd_str, verbose) else None
+        return read_txt(output) if (yield NiftyRegCall(cmd_str, verbose)) else None
 
 
-def avg_tran(ref, tran, flo, output=None, verbose=False):
+@niftyreg_command
+def avg_tran(ref, tran, flo, output=None, out=None, dtype=None, verbose=False):
 
     """
     All input images are resampled into the space of ``ref`` and
     averaged. A cubic spline interpolation scheme is used for resampling.
 
     Args:
-        ref (array): Reference image.
+        ref (array/string): Reference image, the path to one, or its Geometry.
+            Only the grid of the reference is used.
         tran (tuple): Transforms.
         flo (tuple): Floating images.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -117,27 +144,32 @@ def avg_tran(ref, tran, flo, output=None, verbose=False):
         tran
     ), "Non-matching number of floating images and transforms"
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(ref, *tran, *flo) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(ref) or isinstance(ref, Geometry)
 
-        cmd_str = f"reg_average {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -avg_tran "
 
-        write_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
-        cmd_str += os.path.join(tmp_folder, "ref.nii") + " "
+        ref = stage_geometry(os.path.join(tmp_folder, "ref.nii"), ref)
+        cmd_str += f"{shlex.quote(ref)} "
+
+        tran = stage_niftis(os.path.join(tmp_folder, "avg_tran"), tran, "transform")
+        flo = stage_niftis(os.path.join(tmp_folder, "avg_flo"), flo)
 
-        for i, x in enumerate(zip(tran, flo)):
-            write_nifti(os.path.join(tmp_folder, f"avg_tran_{i}.nii"), x[0])
-            write_nifti(os.path.join(tmp_folder, f"avg_flo_{i}.nii"), x[1])
-            cmd_str += os.path.join(tmp_folder, f"avg_tran_{i}.nii") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_flo_{i}.nii") + " "
+        for x, y in zip(tran, flo):
+            cmd_str += f"{shlex.quote(x)} {shlex.quote(y)} "
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
+    return None
 
-def demean1(ref, aff, flo, output=None, verbose=False):
+
+@niftyreg_command
+def demean1(ref, aff, flo, output=None, out=None, dtype=None, verbose=False):
 
     """
     Average images and demean average image that have affine transformations to
@@ -151,10 +183,12 @@ def demean1(ref, aff, flo, output=None, verbose=False):
     reference space
 
     Args:
-        ref (array): Reference image.
+        ref (array/string): Reference image, or the path to one.
         aff (tuple): Affines.
         flo (tuple): Floating images.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -164,37 +198,44 @@ def demean1(ref, aff, flo, output=None, verbose=False):
 
     assert len(aff) == len(flo), "Non-matching number of floating images and transforms"
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(ref, *flo) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(ref)
 
-        cmd_str = f"reg_average {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -demean1 "
 
-        write_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
-        cmd_str += os.path.join(tmp_folder, "ref.nii ")
+        ref = stage_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
+        cmd_str += f"{shlex.quote(ref)} "
+
+        flo = stage_niftis(os.path.join(tmp_folder, "avg_flo"), flo)
+
+        for i, (x, y) in enumerate(zip(aff, flo)):
+            x = stage_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x)
+            cmd_str += f"{shlex.quote(x)} {shlex.quote(y)} "
 
-        for i, x in enumerate(zip(aff, flo)):
-            write_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x[0])
-            write_nifti(os.path.join(tmp_folder, f"avg_flo_{i}.nii"), x[1])
-            cmd_str += os.path.join(tmp_folder, f"avg_aff_{i}.txt") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_flo_{i}.nii") + " "
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+    return None
 
 
-def demean2(ref, tran, flo, output=None, verbose=False):
+@niftyreg_command
+def demean2(ref, tran, flo, output=None, out=None, dtype=None, verbose=False):
 
     """
     Average images and demean average image that have non-rigid
     transformations to a common space.
 
     Args:
-        ref (array): Reference image.
+        ref (array/string): Reference image, or the path to one.
         tran (tuple): Transforms.
         flo (tuple): Floating images.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -202,38 +243,45 @@ def demean2(ref, tran, flo, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(ref, *tran, *flo) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(ref)
+
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str = f"reg_average {output}"
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -demean2 "
 
-        write_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
-        cmd_str += os.path.join(tmp_folder, "ref.nii ")
+        ref = stage_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
+        cmd_str += f"{shlex.quote(ref)} "
+
+        tran = stage_niftis(os.path.join(tmp_folder, "avg_tran"), tran, "transform")
+        flo = stage_niftis(os.path.join(tmp_folder, "avg_flo"), flo)
+
+        for x, y in zip(tran, flo):
+            cmd_str += f"{shlex.quote(x)} {shlex.quote(y)} "
 
-        for i, x in enumerate(zip(tran, flo)):
-            write_nifti(os.path.join(tmp_folder, f"avg_tran_{i}.nii"), x[0])
-            write_nifti(os.path.join(tmp_folder, f"avg_flo_{i}.nii"), x[1])
-            cmd_str += os.path.join(tmp_folder, f"avg_tran_{i}.nii") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_flo_{i}.nii") + " "
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+    return None
 
 
-def demean3(ref, aff, tran, flo, output=None, verbose=False):
+@niftyreg_command
+def demean3(ref, aff, tran, flo, output=None, out=None, dtype=None, verbose=False):
 
     """
     Average images and demean average image that have linear and non-rigid
     transformations to a common space.
 
     Args:
-        ref (array): Reference image.
+        ref (array/string): Reference image, or the path to one.
         aff (tuple): Affines.
         tran (tuple): Transforms.
         flo (tuple): Floating images.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -241,63 +289,81 @@ def demean3(ref, aff, tran, flo, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(ref, *tran, *flo) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(ref)
+
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str = f"reg_average {output}"
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -demean3 "
 
-        write_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
-        cmd_str += os.path.join(tmp_folder, "ref.nii") + " "
+        ref = stage_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
+        cmd_str += f"{shlex.quote(ref)} "
+
+        tran = stage_niftis(os.path.join(tmp_folder, "avg_tran"), tran, "transform")
+        flo = stage_niftis(os.path.join(tmp_folder, "avg_flo"), flo)
 
-        for i, x in enumerate(zip(aff, tran, flo)):
-            write_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x[0])
-            write_nifti(os.path.join(tmp_folder, f"avg_tran_{i}.nii"), x[1])
-            write_nifti(os.path.join(tmp_folder, f"avg_flo_{i}.nii"), x[2])
-            cmd_str += os.path.join(tmp_folder, f"avg_aff_{i}.txt") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_tran_{i}.nii") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_flo_{i}.nii") + " "
+        for i, (x, y, z) in enumerate(zip(aff, tran, flo)):
+            x = stage_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x)
+            cmd_str += f"{shlex.quote(x)} {shlex.quote(y)} {shlex.quote(z)} "
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
+    return None
 
-def demean_noaff(ref, aff, tran, flo, output=None, verbose=False):
+
+@niftyreg_command
+def demean_noaff(ref, aff, tran, flo, output=None, out=None, dtype=None, verbose=False):
 
     """
     Same as the demean expect that the specified affine is removed from the
     non-linear (euclidean) transformation.
 
     Args:
-        ref (array): Reference image.
+        ref (array/string): Reference image, or the path to one.
         aff (tuple): Affines.
         tran (tuple): Transforms.
         flo (tuple): Floating images.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
         array: Averaged floating images.
 
     """
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(ref, *tran, *flo) as tmp_folder:
 
-        if output is None:
-            output = os.path.join(tmp_folder, "output.nii")
+        as_image = is_image(ref)
 
-        cmd_str = f"reg_average {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str = f"reg_average {shlex.quote(output)}"
         cmd_str += " -demean_noaff "
 
-        write_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
-        cmd_str += os.path.join(tmp_folder, "ref.nii") + " "
+        ref = stage_nifti(os.path.join(tmp_folder, "ref.nii"), ref)
+        cmd_str += f"{shlex.quote(ref)} "
+
+        tran = stage_niftis(os.path.join(tmp_folder, "avg_tran"), tran, "transform")
+        flo = stage_niftis(os.path.join(tmp_folder, "avg_flo"), flo)
+
+        for i, (x, y, z) in enumerate(zip(aff, tran, flo)):
+            x = stage_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x)
+            cmd_str += f"{shlex.quote(x)} {shlex.quote(y)} {shlex.quote(z)} "
+
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
+
+    return None
 
-        for i, x in enumerate(zip(aff, tran, flo)):
-            write_txt(os.path.join(tmp_folder, f"avg_aff_{i}.txt"), x[0])
-            write_nifti(os.path.join(tmp_folder, f"avg_tran_{i}.nii"), x[1])
-            write_nifti(os.path.join(tmp_folder, f"avg_flo_{i}.nii"), x[2])
-            cmd_str += os.path.join(tmp_folder, f"avg_aff_{i}.txt") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_tran_{i}.nii") + " "
-            cmd_str += os.path.join(tmp_folder, f"avg_flo_{i}.nii") + " "
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+avg_async = avg.async_
+avg_lts_async = avg_lts.async_
+avg_tran_async = avg_tran.async_
+demean1_async = demean1.async_
+demean2_async = demean2.async_
+demean3_async = demean3.async_
+demean_noaff_async = demean_noaff.async_
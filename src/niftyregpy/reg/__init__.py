@@ -1 +1,20 @@
-from .reg import aladin, f3d, jacobian, resample, tools
+from .reg import (
+    aladin,
+    aladin_async,
+    f3d,
+    f3d_async,
+    jacobian,
+    resample,
+    resample_async,
+    tools,
+    tools_async,
+)
+from .batch import (
+    BatchResult,
+    aladin_batch,
+    aladin_iter,
+    f3d_batch,
+    f3d_iter,
+    resample_batch,
+    resample_iter,
+)
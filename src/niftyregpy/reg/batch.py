@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""Batch registration and resampling.
+
+Every job runs its own NiftyReg process, so jobs are spread over a thread pool
+and each process is limited with ``-omp`` to its share of the thread budget
+(see ``utils.set_thread_budget``), so that ``workers`` x threads does not
+oversubscribe the machine. With ``pin=True``, every job is also bound to its own
+set of CPUs, within one NUMA node where possible.
+
+The ``*_batch`` functions return all results at once, in input order. The
+``*_iter`` generators yield ``(index, result)`` as jobs complete and keep a
+bounded number of jobs and results in flight, so that cohorts of any size can
+be processed in fixed memory.
+"""
+
+import contextvars
+import itertools
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import nibabel as nib
+import numpy as np
+
+from ..utils import Geometry, Image, cpu_count, get_thread_budget, pinning
+from .reg import aladin, f3d, resample
+
+logger = logging.getLogger(__name__)
+
+BatchResult = namedtuple("BatchResult", ["results", "failures"])
+BatchResult.__doc__ = """\
+Results of a batch, in input order, and ``(index, error)`` for every failed job.
+``error`` is the exception raised by the job, or None if NiftyReg failed."""
+
+
+def _is_single(x):
+
+    # Arrays, images and paths are shared by all jobs, other iterables hold
+    # one input per job
+    return x is None or isinstance(
+        x,
+        (str, os.PathLike, np.ndarray, Image, Geometry, nib.spatialimages.SpatialImage),
+    )
+
+
+def _jobs(*inputs):
+
+    inputs = [x if _is_single(x) else list(x) for x in inputs]
+    lengths = {len(x) for x in inputs if isinstance(x, list)}
+
+    assert len(lengths) <= 1, "Non-matching number of inputs"
+
+    n = lengths.pop() if lengths else 1
+
+    return [tuple(x[i] if isinstance(x, list) else x for x in inputs) for i in range(n)]
+
+
+def _iter_jobs(*inputs):
+
+    # Same as _jobs, without reading the inputs ahead
+    if all(_is_single(x) for x in inputs):
+        return iter([inputs])
+
+    return zip(*(itertools.repeat(x) if _is_single(x) else x for x in inputs))
+
+
+def _execute(fn, jobs, workers, pending, pin, kwargs):
+
+    # Run the jobs on a thread pool and yield ``(index, result, error)`` in
+    # completion order, with at most ``pending`` jobs running or done but not
+    # yet yielded
+    workers = max(1, int(workers or cpu_count()))
+    pending = max(workers, int(pending or 2 * workers))
+
+    if kwargs.get("omp") is None:
+        kwargs["omp"] = max(1, get_thread_budget()["threads"] // workers)
+
+    def run(job):
+        if pin is None:
+            return fn(*job, **kwargs)
+        with pinning(pin):
+            return fn(*job, **kwargs)
+
+    jobs = enumerate(jobs)
+    running = {}
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="niftyregpy-batch") as pool:
+        try:
+            while True:
+                for i, job in itertools.islice(jobs, pending - len(running)):
+                    # Run every job in a copy of the caller's context
+                    future = pool.submit(contextvars.copy_context().run, run, job)
+                    running[future] = i
+
+                if not running:
+                    return
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        yield i, future.result(), None
+                    except Exception as e:
+                        yield i, None, e
+        finally:
+            # Jobs that have not started are dropped if the caller stops early
+            for future in running:
+                future.cancel()
+
+
+def _run(fn, jobs, workers, pin, kwargs):
+
+    results = [None] * len(jobs)
+    failures = []
+
+    workers = min(len(jobs), workers or cpu_count())
+
+    for i, result, error in _execute(fn, jobs, workers, len(jobs), pin, kwargs):
+        results[i] = result
+        if result is None:
+            failures.append((i, error))
+
+    return BatchResult(results, sorted(failures, key=lambda x: x[0]))
+
+
+def _iter(fn, jobs, workers, pending, pin, kwargs):
+
+    for i, result, error in _execute(fn, jobs, workers, pending, pin, kwargs):
+        if error is not None:
+            logger.error("Job %d failed: %s", i, error)
+        yield i, result
+
+
+def aladin_batch(ref, flo, workers=None, pin=None, **kwargs) -> BatchResult:
+
+    """
+    Run ``reg.aladin`` for several pairs of images.
+
+    Args:
+        ref (list/array): Reference images, or one reference for all jobs.
+        flo (list/array): Floating images, or one floating image for all jobs.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        **kwargs: Passed on to ``reg.aladin``. Unless ``omp`` is given, every
+            job uses its share of the thread budget.
+
+    Returns:
+        BatchResult: ``(res, aff)`` of every job, in input order, and the
+        failed jobs.
+
+    Given lists of images ``refs`` and ``flos``, an example usage is:
+        >>> results, failures = niftyregpy.reg.aladin_batch(refs, flos, workers=4)
+
+    """
+
+    return _run(aladin, _jobs(ref, flo), workers, pin, kwargs)
+
+
+def f3d_batch(ref, flo, workers=None, pin=None, **kwargs) -> BatchResult:
+
+    """
+    Run ``reg.f3d`` for several pairs of images.
+
+    Args:
+        ref (list/array): Reference images, or one reference for all jobs.
+        flo (list/array): Floating images, or one floating image for all jobs.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        **kwargs: Passed on to ``reg.f3d``. Unless ``omp`` is given, every job
+            uses its share of the thread budget.
+
+    Returns:
+        BatchResult: ``(res, cpp)`` of every job, in input order, and the
+        failed jobs.
+
+    """
+
+    return _run(f3d, _jobs(ref, flo), workers, pin, kwargs)
+
+
+def resample_batch(ref, flo, trans, workers=None, pin=None, **kwargs) -> BatchResult:
+
+    """
+    Run ``reg.resample`` for several images and transformations.
+
+    Args:
+        ref (list/array): Reference images, or one reference for all jobs.
+        flo (list/array): Floating images, or one floating image for all jobs.
+        trans (list/array): Transformations, or one for all jobs.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        **kwargs: Passed on to ``reg.resample``. Unless ``omp`` is given, every
+            job uses its share of the thread budget.
+
+    Returns:
+        BatchResult: Resampled images, in input order, and the failed jobs.
+
+    """
+
+    return _run(resample, _jobs(ref, flo, trans), workers, pin, kwargs)
+
+
+def aladin_iter(ref, flo, workers=None, pin=None, pending=None, **kwargs):
+
+    """
+    Run ``reg.aladin`` for several pairs of images, yielding results as they
+    complete.
+
+    Args:
+        ref (iterable/array): Reference images, or one reference for all jobs.
+        flo (iterable/array): Floating images, or one floating image for all
+            jobs. Inputs are only read when their job is submitted.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        pending (int): Maximum number of jobs that are running or done but not
+            yet consumed (default = 2 x workers).
+        **kwargs: Passed on to ``reg.aladin``.
+
+    Yields:
+        tuple: Index of the job and its ``(res, aff)``, or None if it failed.
+
+    Given a generator ``subjects`` that loads the images of a cohort, an example
+    usage is:
+        >>> for i, (res, aff) in niftyregpy.reg.aladin_iter(template, subjects):
+        ...     np.save(f"aff_{i}.npy", aff)
+
+    """
+
+    return _iter(aladin, _iter_jobs(ref, flo), workers, pending, pin, kwargs)
+
+
+def f3d_iter(ref, flo, workers=None, pin=None, pending=None, **kwargs):
+
+    """
+    Run ``reg.f3d`` for several pairs of images, yielding results as they
+    complete.
+
+    Args:
+        ref (iterable/array): Reference images, or one reference for all jobs.
+        flo (iterable/array): Floating images, or one floating image for all
+            jobs. Inputs are only read when their job is submitted.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        pending (int): Maximum number of jobs that are running or done but not
+            yet consumed (default = 2 x workers).
+        **kwargs: Passed on to ``reg.f3d``.
+
+    Yields:
+        tuple: Index of the job and its ``(res, cpp)``, or None if it failed.
+
+    """
+
+    return _iter(f3d, _iter_jobs(ref, flo), workers, pending, pin, kwargs)
+
+
+def resample_iter(ref, flo, trans, workers=None, pin=None, pending=None, **kwargs):
+
+    """
+    Run ``reg.resample`` for several images and transformations, yielding
+    results as they complete.
+
+    Args:
+        ref (iterable/array): Reference images, or one reference for all jobs.
+        flo (iterable/array): Floating images, or one floating image for all
+            jobs.
+        trans (iterable/array): Transformations, or one for all jobs.
+        workers (int): Number of concurrent jobs (default = number of CPUs).
+        pin (bool): Bind every job to its own CPUs, grouped by NUMA node
+            (default = as set by ``utils.set_thread_budget``).
+        pending (int): Maximum number of jobs that are running or done but not
+            yet consumed (default = 2 x workers).
+        **kwargs: Passed on to ``reg.resample``.
+
+    Yields:
+        tuple: Index of the job and the resampled image, or None if it failed.
+
+    """
+
+    return _iter(resample, _iter_jobs(ref, flo, trans), workers, pending, pin, kwargs)
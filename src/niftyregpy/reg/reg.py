@@ -1,13 +1,79 @@
 import builtins
 import shlex
-import tempfile as tmp
-from os import path
+from os import fspath, path
 
 import numpy as np
 
-from ..utils import call_niftyreg, read_nifti, read_txt, write_nifti, write_txt
+from ..utils import (
+    Geometry,
+    NiftyRegCall,
+    StopRegistration,
+    check_roi,
+    is_affine,
+    is_image,
+    lazy_output,
+    niftyreg_command,
+    output_file,
+    read_nifti,
+    read_txt,
+    scratch_dir,
+    stage_geometry,
+    stage_nifti,
+    stage_txt,
+)
 
+_OUTPUTS = ("both", "transform", "image", "lazy")
 
+
+def _tracker(on_event, stop_when, abort_when, return_trace):
+
+    # Collect the reported values of the objective function, and stop NiftyReg
+    # once ``stop_when`` (or its alias ``abort_when``) holds for them
+    assert stop_when is None or abort_when is None, "give stop_when or abort_when"
+    if stop_when is None:
+        stop_when = abort_when
+
+    if stop_when is None and not return_trace:
+        return None, on_event
+
+    start = getattr(stop_when, "start", None)
+    if start is not None:
+        start()
+
+    trace = []
+
+    def handle(event):
+        if on_event is not None:
+            on_event(event)
+        if event.kind == "iteration":
+            trace.append(event)
+            if stop_when is not None and stop_when(trace):
+                raise StopRegistration
+
+    return (trace if return_trace else None), handle
+
+
+def _with_trace(result, trace):
+
+    if trace is None:
+        return result
+
+    return (*(result or (None, None)), trace)
+
+
+def _read_output(folder, name, outputs, wanted, **kwargs):
+
+    # Read an output if ``outputs`` asks for it, or return a lazy handle
+    if outputs == "lazy":
+        return lazy_output(folder, name, **kwargs)
+
+    if outputs in ("both", wanted):
+        return read_nifti(name, **kwargs)
+
+    return None
+
+
+@niftyreg_command
 def aladin(
     ref,
     flo,
@@ -40,6 +106,14 @@ def aladin(
     NN=None,
     LIN=None,
     user_opts=None,
+    outputs="both",
+    roi=None,
+    out=None,
+    dtype=None,
+    on_event=None,
+    return_trace=False,
+    stop_when=None,
+    abort_when=None,
     verbose=False,
 ):
 
@@ -47,32 +121,58 @@ def aladin(
     Block Matching algorithm for global registration.
     Based on Ourselin et al., "Reconstructing a 3D structure from serial
     histological sections" Image and Vision Computing, 2001
+
+    If ``ref`` or ``flo`` is an Image, the result is returned as an Image.
+
+    ``outputs`` selects what is returned: ``"both"`` (default), ``"transform"``
+    or ``"image"`` (the other output is None), or ``"lazy"`` (the result is a
+    LazyImage that is read on first access). With ``"transform"``, the result
+    image is not written at all unless ``res`` is given.
+
+    ``roi`` reads only part of the result image, see ``utils.read_nifti``.
+    The result image is read into ``out`` if given, and as ``dtype`` if given.
+
+    ``on_event`` is called with a ``utils.NiftyRegEvent`` for every line of
+    output while reg_aladin runs, e.g. to report the current pyramid level.
+
+    With ``return_trace``, the objective function reported at every iteration
+    is returned as a third output, a list of ``utils.NiftyRegEvent``. reg_aladin
+    is stopped with SIGTERM once ``stop_when(trace)`` returns True, e.g.
+    ``utils.stop_after``. A stopped run writes no outputs, so they are None,
+    e.g. to give up on registrations that do not converge within a time budget.
+    ``abort_when`` is accepted as an alias of ``stop_when``.
     """
     # usage_string = "reg_aladin -ref <filename> -flo <filename> [OPTIONS]"
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    assert outputs in _OUTPUTS, f"outputs must be one of {', '.join(_OUTPUTS)}"
+    check_roi(roi)
+
+    # Conditions such as utils.stop_after are started before the inputs are staged
+    trace, handler = _tracker(on_event, stop_when, abort_when, return_trace)
+
+    with scratch_dir(ref, flo, rmask, fmask) as tmp_folder:
 
         cmd_str = "reg_aladin"
 
-        write_nifti(path.join(tmp_folder, "ref"), ref)
-        write_nifti(path.join(tmp_folder, "flo"), flo)
+        as_image = is_image(ref) or is_image(flo)
 
-        cmd_str += (
-            " -ref "
-            + path.join(tmp_folder, "ref.nii")
-            + " -flo "
-            + path.join(tmp_folder, "flo.nii")
-        )
+        ref = stage_nifti(path.join(tmp_folder, "ref.nii"), ref)
+        flo = stage_nifti(path.join(tmp_folder, "flo.nii"), flo)
+
+        cmd_str += f" -ref {shlex.quote(ref)} -flo {shlex.quote(flo)}"
 
         opts_str = ""
 
-        if res is None:
-            res = path.join(tmp_folder, "res.nii")
+        write_res = outputs != "transform" or res is not None
+
+        res = output_file(tmp_folder, "res.nii", res)
         if aff is None:
             aff = path.join(tmp_folder, "aff.txt")
+        aff = fspath(aff)
 
-        opts_str += f" -res {res}"
-        opts_str += f" -aff {aff}"
+        if write_res:
+            opts_str += f" -res {shlex.quote(res)}"
+        opts_str += f" -aff {shlex.quote(aff)}"
 
         if noSym is True:
             opts_str += " -noSym"
@@ -84,16 +184,16 @@ def aladin(
             opts_str += " -affDirect"
 
         if inaff is not None:
-            write_txt(path.join(tmp_folder, "inaff.txt"), inaff)
-            opts_str += " -inaff " + path.join(tmp_folder, "inaff.txt")
+            inaff = stage_txt(path.join(tmp_folder, "inaff.txt"), inaff)
+            opts_str += f" -inaff {shlex.quote(inaff)}"
 
         if rmask is not None:
-            write_nifti(path.join(tmp_folder, "rmask.nii"), rmask.astype(float))
-            opts_str += " -rmask " + path.join(tmp_folder, "rmask.nii")
+            rmask = stage_nifti(path.join(tmp_folder, "rmask.nii"), rmask, kind="mask")
+            opts_str += f" -rmask {shlex.quote(rmask)}"
 
         if fmask is not None:
-            write_nifti(path.join(tmp_folder, "fmask.nii"), fmask.astype(float))
-            opts_str += " -fmask " + path.join(tmp_folder, "fmask.nii")
+            fmask = stage_nifti(path.join(tmp_folder, "fmask.nii"), fmask, kind="mask")
+            opts_str += f" -fmask {shlex.quote(fmask)}"
 
         if maxit is not None:
             opts_str += f" -maxit {maxit}"
@@ -159,21 +259,33 @@ def aladin(
             for x in shlex.split(user_opts):
                 opts_str += f" {shlex.quote(x)}"
 
-        if not verbose and "-voff" not in (user_opts or []):
+        # NiftyReg only reports progress if its output is not turned off
+        if not verbose and handler is None and "-voff" not in (user_opts or []):
             opts_str += " -voff"
 
         cmd_str += opts_str
 
-        return (
-            (
-                read_nifti(res),
-                read_txt(aff),
+        result = None
+
+        if (yield NiftyRegCall(cmd_str, verbose, on_event=handler)):
+            result = (
+                _read_output(
+                    tmp_folder,
+                    res,
+                    outputs,
+                    "image",
+                    as_image=as_image,
+                    roi=roi,
+                    out=out,
+                    dtype=dtype,
+                ),
+                read_txt(aff) if outputs != "image" else None,
             )
-            if call_niftyreg(cmd_str, verbose)
-            else None
-        )
 
+    return _with_trace(result, trace)
 
+
+@niftyreg_command
 def f3d(
     ref=None,
     flo=None,
@@ -217,6 +329,15 @@ def f3d(
     smoothGrad=None,
     pad=None,
     user_opts=None,
+    mmap=False,
+    outputs="both",
+    roi=None,
+    out=None,
+    dtype=None,
+    on_event=None,
+    return_trace=False,
+    stop_when=None,
+    abort_when=None,
     verbose=False,
 ):
 
@@ -230,45 +351,80 @@ def f3d(
     objective function based on the Normalized Mutual Information and a penalty
     term. The penalty term could be either the bending energy or the squared
     Jacobian determinant log.
+
+    If ``mmap`` is True, outputs written to a caller-provided ``res`` or ``cpp``
+    path are returned as copy-on-write memory maps instead of being loaded.
+
+    If ``ref`` or ``flo`` is an Image, the result and the control point grid are
+    returned as Images, so that the grid can be passed on to ``resample``.
+
+    ``outputs`` selects what is returned: ``"both"`` (default), ``"transform"``
+    or ``"image"`` (the other output is None), or ``"lazy"`` (LazyImage handles
+    that are read on first access). reg_f3d always writes both files.
+
+    ``roi`` reads only part of the result image, e.g. a single slice for quality
+    control, see ``utils.read_nifti``. The control point grid is read whole.
+    The result image is read into ``out`` if given, e.g. one frame of a
+    preallocated 4D array, and as ``dtype`` if given.
+
+    ``on_event`` is called with a ``utils.NiftyRegEvent`` for every line of
+    output while reg_f3d runs, including the level, iteration and value of the
+    objective function as they are reported.
+
+    With ``return_trace``, the value and terms of the objective function at
+    every iteration and level are returned as a third output, a list of
+    ``utils.NiftyRegEvent``. ``stop_when`` is called with that list at every
+    iteration, and reg_f3d is stopped with SIGTERM once it returns True, e.g.
+    ``stop_when=utils.stop_after(600)``. reg_f3d only saves the control point
+    grid when it finishes and cannot be told to save it earlier, so a stopped
+    run discards the registration: both outputs are None (and the trace is
+    returned if requested). This suits time budgets for runs that are given up
+    on; to shorten runs that keep their result, lower ``maxit`` or ``lp``
+    instead. ``abort_when`` is accepted as an alias of ``stop_when``.
     """
 
     # usage_string = "reg_f3d -ref <filename> -flo <filename> [OPTIONS]"
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    assert outputs in _OUTPUTS, f"outputs must be one of {', '.join(_OUTPUTS)}"
+    check_roi(roi)
+
+    # Conditions such as utils.stop_after are started before the inputs are staged
+    trace, handler = _tracker(on_event, stop_when, abort_when, return_trace)
+
+    with scratch_dir(ref, flo, incpp, rmask, fmask) as tmp_folder:
 
         cmd_str = "reg_f3d"
 
-        write_nifti(path.join(tmp_folder, "ref"), ref)
-        write_nifti(path.join(tmp_folder, "flo"), flo)
+        as_image = is_image(ref) or is_image(flo)
 
-        cmd_str += (
-            " -ref "
-            + path.join(tmp_folder, "ref.nii")
-            + " -flo "
-            + path.join(tmp_folder, "flo.nii")
-        )
+        ref = stage_nifti(path.join(tmp_folder, "ref.nii"), ref)
+        flo = stage_nifti(path.join(tmp_folder, "flo.nii"), flo)
+
+        cmd_str += f" -ref {shlex.quote(ref)} -flo {shlex.quote(flo)}"
 
         opts_str = ""
 
-        if res is None:
-            res = path.join(tmp_folder, "res.nii")
-        if cpp is None:
-            cpp = path.join(tmp_folder, "cpp.nii")
+        mmap_res, mmap_cpp = mmap and res is not None, mmap and cpp is not None
+
+        res = output_file(tmp_folder, "res.nii", res)
+        cpp = output_file(tmp_folder, "cpp.nii", cpp)
 
-        opts_str += f" -res {res}"
-        opts_str += f" -cpp {cpp}"
+        opts_str += f" -res {shlex.quote(res)}"
+        opts_str += f" -cpp {shlex.quote(cpp)}"
 
         if aff is not None:
-            write_txt(path.join(tmp_folder, "aff.txt"), aff)
-            opts_str += " -aff " + path.join(tmp_folder, "aff.txt")
+            aff = stage_txt(path.join(tmp_folder, "aff.txt"), aff)
+            opts_str += f" -aff {shlex.quote(aff)}"
 
         if incpp is not None:
-            write_nifti(path.join(tmp_folder, "incpp.nii"), incpp)
-            opts_str += " -incpp " + path.join(tmp_folder, "incpp.nii")
+            incpp = stage_nifti(
+                path.join(tmp_folder, "incpp.nii"), incpp, kind="transform"
+            )
+            opts_str += f" -incpp {shlex.quote(incpp)}"
 
         if rmask is not None:
-            write_nifti(path.join(tmp_folder, "rmask.nii"), rmask.astype(float))
-            opts_str += " -rmask " + path.join(tmp_folder, "rmask.nii")
+            rmask = stage_nifti(path.join(tmp_folder, "rmask.nii"), rmask, kind="mask")
+            opts_str += f" -rmask {shlex.quote(rmask)}"
 
         if smooR is not None:
             opts_str += f" -smooR {smooR}"
@@ -380,11 +536,11 @@ def f3d(
             opts_str += " -vel"
 
         if fmask is not None:
-            write_nifti(path.join(tmp_folder, "fmask.nii"), fmask.astype(float))
-            opts_str += " -fmask " + path.join(tmp_folder, "fmask.nii")
+            fmask = stage_nifti(path.join(tmp_folder, "fmask.nii"), fmask, kind="mask")
+            opts_str += f" -fmask {shlex.quote(fmask)}"
 
         if omp is not None:
-            opts_str += f" -lp {int(omp)}"
+            opts_str += f" -omp {int(omp)}"
 
         if mem is True:
             opts_str += " -mem"
@@ -402,21 +558,41 @@ def f3d(
             for x in shlex.split(user_opts):
                 opts_str += f" {shlex.quote(x)}"
 
-        if not verbose and "-voff" not in (user_opts or []):
+        # NiftyReg only reports progress if its output is not turned off
+        if not verbose and handler is None and "-voff" not in (user_opts or []):
             opts_str += " -voff"
 
         cmd_str += opts_str
 
-        return (
-            (
-                read_nifti(res),
-                read_nifti(cpp),
+        result = None
+
+        if (yield NiftyRegCall(cmd_str, verbose, on_event=handler)):
+            result = (
+                _read_output(
+                    tmp_folder,
+                    res,
+                    outputs,
+                    "image",
+                    mmap=mmap_res,
+                    as_image=as_image,
+                    roi=roi,
+                    out=out,
+                    dtype=dtype,
+                ),
+                _read_output(
+                    tmp_folder,
+                    cpp,
+                    outputs,
+                    "transform",
+                    mmap=mmap_cpp,
+                    as_image=as_image,
+                ),
             )
-            if call_niftyreg(cmd_str, verbose)
-            else None
-        )
 
+    return _with_trace(result, trace)
 
+
+@niftyreg_command
 def resample(
     ref,
     flo,
@@ -427,6 +603,11 @@ def resample(
     pad=None,
     tensor=None,
     psf=False,
+    omp=None,
+    mmap=False,
+    roi=None,
+    out=None,
+    dtype=None,
     verbose=False,
 ):
     """
@@ -438,39 +619,61 @@ def resample(
         Filename of the reference image (mandatory)
     -flo <filename>
         Filename of the floating image (mandatory)
+
+    If ``mmap`` is True and ``res`` is provided, the result is returned as a
+    copy-on-write memory map of ``res`` instead of being loaded.
+
+    ``ref`` is staged as an empty image on the same grid, as its intensities are
+    not used, and can also be given as a Geometry (shape and affine) only.
+
+    If ``ref`` or ``flo`` is an Image, or ``ref`` a Geometry, the result is
+    returned as an Image.
+
+    ``roi`` reads only part of the result, see ``utils.read_nifti``. When
+    resampling many same-shaped volumes, pass ``out`` (e.g. one frame of a
+    preallocated 4D array) to read each result into it without allocating, and
+    ``dtype`` to choose the data type of the result.
     """
 
     # usage_string = "reg_resample -ref <filename> -flo <filename> [OPTIONS]"
 
     cmd_str = "reg_resample "
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    check_roi(roi)
+
+    with scratch_dir(ref, flo, trans) as tmp_folder:
 
         cmd_str = "reg_resample"
 
-        write_nifti(path.join(tmp_folder, "ref.nii"), ref)
-        write_nifti(path.join(tmp_folder, "flo.nii"), flo)
+        as_image = is_image(ref) or is_image(flo) or isinstance(ref, Geometry)
+
+        # reg_resample only uses the grid of the reference image
+        ref = stage_geometry(path.join(tmp_folder, "ref.nii"), ref)
+        flo = stage_nifti(path.join(tmp_folder, "flo.nii"), flo)
 
-        cmd_str += " -ref " + path.join(tmp_folder, "ref.nii")
-        cmd_str += " -flo " + path.join(tmp_folder, "flo.nii")
+        cmd_str += f" -ref {shlex.quote(ref)}"
+        cmd_str += f" -flo {shlex.quote(flo)}"
 
-        if trans.shape == (4, 4):
-            write_txt(path.join(tmp_folder, "trans.txt"), trans)
-            cmd_str += " -trans " + path.join(tmp_folder, "trans.txt")
+        if is_affine(trans):
+            trans = stage_txt(path.join(tmp_folder, "trans.txt"), trans)
         else:
-            write_nifti(path.join(tmp_folder, "trans.nii"), trans)
-            cmd_str += " -trans " + path.join(tmp_folder, "trans.nii")
+            trans = stage_nifti(
+                path.join(tmp_folder, "trans.nii"), trans, kind="transform"
+            )
+
+        cmd_str += f" -trans {shlex.quote(trans)}"
 
         opts_str = ""
 
-        if res is None:
-            res = path.join(tmp_folder, "res.nii")
+        mmap = mmap and res is not None
+
+        res = output_file(tmp_folder, "res.nii", res)
 
-        opts_str += f" -res {res}"
+        opts_str += f" -res {shlex.quote(res)}"
 
         if blank is not None:
-            write_nifti(path.join(tmp_folder, "blank"), blank)
-            opts_str += " -blank " + path.join(tmp_folder, "blank")
+            blank = stage_nifti(path.join(tmp_folder, "blank.nii"), blank)
+            opts_str += f" -blank {shlex.quote(blank)}"
 
         if int(inter) in range(5):
             opts_str += f" -inter {int(inter)}"
@@ -484,12 +687,20 @@ def resample(
         if psf is True:
             opts_str += " -psf"
 
+        if omp is not None:
+            opts_str += f" -omp {int(omp)}"
+
         if not verbose:
             opts_str += " -voff"
 
         cmd_str += opts_str
 
-        return read_nifti(res) if call_niftyreg(cmd_str, verbose) else None
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(
+                res, mmap=mmap, as_image=as_image, roi=roi, out=out, dtype=dtype
+            )
+
+    return None
 
 
 def jacobian(trans, ref, jac=None, jacM=None, jacL=None):
@@ -502,6 +713,7 @@ def jacobian(trans, ref, jac=None, jacM=None, jacL=None):
     raise NotImplementedError
 
 
+@niftyreg_command
 def tools(
     input,
     out=None,
@@ -525,102 +737,157 @@ def tools(
 ):
 
     cmd_str = "reg_tools"
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
+
+        as_image = is_image(input)
 
-        write_nifti(path.join(tmp_folder, "in.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "in.nii")
+        input = stage_nifti(path.join(tmp_folder, "in.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if out is None:
-            out = path.join(tmp_folder, "out.nii")
+        out = output_file(tmp_folder, "out.nii", out)
 
-        cmd_str += f" -out {out}"
+        cmd_str += f" -out {shlex.quote(out)}"
 
         if float is not None:
             cmd_str += " -float"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if down is not None:
             cmd_str += " -down"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if smoS is not None:
             smoS = ((smoS,) * 3) if np.isscalar(smoS) else smoS
             cmd_str += f' -smoS {" ".join(str(x) for x in smoS)}'
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if smoG is not None:
             smoG = ((smoG,) * 3) if np.isscalar(smoG) else smoG
             cmd_str += f' -smoG {" ".join(str(x) for x in smoG)}'
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if smoL is not None:
             smoL = ((smoL,) * 3) if np.isscalar(smoL) else smoL
             cmd_str += f' -smoL {" ".join(str(x) for x in smoL)}'
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if add is not None:
-            if isinstance(add, np.ndarray):
-                write_nifti(path.join(tmp_folder, "add.nii"), add)
-                cmd_str += " -add " + path.join(tmp_folder, "add.nii")
-            else:
-                cmd_str += f" -add {add}"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            if not np.isscalar(add):
+                add = stage_nifti(path.join(tmp_folder, "add.nii"), add)
+            cmd_str += f" -add {shlex.quote(str(add))}"
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if sub is not None:
-            if isinstance(sub, np.ndarray):
-                write_nifti(path.join(tmp_folder, "sub.nii"), sub)
-                cmd_str += " -sub " + path.join(tmp_folder, "sub.nii")
-            else:
-                cmd_str += f" -sub {sub}"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            if not np.isscalar(sub):
+                sub = stage_nifti(path.join(tmp_folder, "sub.nii"), sub)
+            cmd_str += f" -sub {shlex.quote(str(sub))}"
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if mul is not None:
-            if isinstance(mul, np.ndarray):
-                write_nifti(path.join(tmp_folder, "mul.nii"), mul)
-                cmd_str += " -mul " + path.join(tmp_folder, "mul.nii")
-            else:
-                cmd_str += f" -mul {mul}"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            if not np.isscalar(mul):
+                mul = stage_nifti(path.join(tmp_folder, "mul.nii"), mul)
+            cmd_str += f" -mul {shlex.quote(str(mul))}"
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if div is not None:
-            if isinstance(div, np.ndarray):
-                write_nifti(path.join(tmp_folder, "div.nii"), div)
-                cmd_str += " -div " + path.join(tmp_folder, "div.nii")
-            else:
-                cmd_str += f" -div {div}"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            if not np.isscalar(div):
+                div = stage_nifti(path.join(tmp_folder, "div.nii"), div)
+            cmd_str += f" -div {shlex.quote(str(div))}"
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if rms is not None:
-            write_nifti(path.join(tmp_folder, "rms.nii"), rms)
-            cmd_str += " -rms " + path.join(tmp_folder, "rms.nii")
-            out = call_niftyreg(cmd_str, verbose=verbose, output_stdout=True)
+            rms = stage_nifti(path.join(tmp_folder, "rms.nii"), rms)
+            cmd_str += f" -rms {shlex.quote(rms)}"
+            out = yield NiftyRegCall(cmd_str, verbose=verbose, output_stdout=True)
             return builtins.float(out) if out else None
 
         if bin is not None:
             cmd_str += " -bin"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if thr is not None:
             cmd_str += f" -thr {thr}"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if nan is not None:
-            write_nifti(path.join(tmp_folder, "nan.nii"), nan)
-            cmd_str += " -nan " + path.join(tmp_folder, "nan.nii")
+            nan = stage_nifti(path.join(tmp_folder, "nan.nii"), nan, kind="mask")
+            cmd_str += f" -nan {shlex.quote(nan)}"
             return (
-                read_nifti(out, output_nan=True)
-                if call_niftyreg(cmd_str, verbose)
+                read_nifti(out, output_nan=True, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
                 else None
             )
 
         if iso is not None:
             cmd_str += " -iso"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if noscl is not None:
             cmd_str += " -noscl"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
 
         if version is not None:
             cmd_str += " --version"
-            return read_nifti(out) if call_niftyreg(cmd_str, verbose) else None
+            return (
+                read_nifti(out, as_image=as_image)
+                if (yield NiftyRegCall(cmd_str, verbose))
+                else None
+            )
+
+
+aladin_async = aladin.async_
+f3d_async = f3d.async_
+resample_async = resample.async_
+tools_async = tools.async_
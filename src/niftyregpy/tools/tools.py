@@ -1,13 +1,23 @@
 import builtins
-import tempfile as tmp
+import shlex
 from os import path
 
 import numpy as np
 
-from ..utils import call_niftyreg, is_function_available, read_nifti, write_nifti
+from ..utils import (
+    NiftyRegCall,
+    is_function_available,
+    is_image,
+    niftyreg_command,
+    output_file,
+    read_nifti,
+    scratch_dir,
+    stage_nifti,
+)
 
 
-def float(input, output=None, verbose=False):
+@niftyreg_command
+def float(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     The input image is converted to float.
@@ -15,6 +25,8 @@ def float(input, output=None, verbose=False):
     Args:
         input (array): Input array to be converted.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -22,25 +34,26 @@ def float(input, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
-        cmd_str = f"reg_tools -in {path.join(tmp_folder, 'input.nii')}"
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str = f"reg_tools -in {shlex.quote(input)}"
 
-        cmd_str += f" -out {output}"
-        cmd_str += " -float"
+        output = output_file(tmp_folder, "output.nii", output)
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -out {shlex.quote(output)}"
+        cmd_str += " -float"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def down(input, output=None, verbose=False):
+@niftyreg_command
+def down(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     The input image is downsampled 2 times.
@@ -48,6 +61,8 @@ def down(input, output=None, verbose=False):
     Args:
         input (array): Input array to be downsampled.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -55,25 +70,28 @@ def down(input, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
-        cmd_str = f"reg_tools -in {path.join(tmp_folder, 'input.nii')}"
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str = f"reg_tools -in {shlex.quote(input)}"
 
-        cmd_str += f" -out {output}"
-        cmd_str += " -down"
+        output = output_file(tmp_folder, "output.nii", output)
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -out {shlex.quote(output)}"
+        cmd_str += " -down"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def smoS(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
+@niftyreg_command
+def smoS(
+    input, output=None, sx=0.0, sy=0.0, sz=0.0, out=None, dtype=None, verbose=False
+):
 
     """
     The input image is smoothed using a cubic b-spline kernel.
@@ -84,32 +102,38 @@ def smoS(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
         sy (float): Smoothing in y.
         sz (float): Smoothing in z.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
         array: Input array smoothed using a cubic b-spline kernel.
 
     """
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += f" -smoS {sx} {sy} {sz} "
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def smoG(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
+@niftyreg_command
+def smoG(
+    input, output=None, sx=0.0, sy=0.0, sz=0.0, out=None, dtype=None, verbose=False
+):
 
     """
     The input image is smoothed using a Gaussian kernel.
@@ -120,6 +144,8 @@ def smoG(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
         sy (float): Smoothing in y.
         sz (float): Smoothing in z.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -127,26 +153,30 @@ def smoG(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += f" -smoG {sx} {sy} {sz} "
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def smoL(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
+@niftyreg_command
+def smoL(
+    input, output=None, sx=0.0, sy=0.0, sz=0.0, out=None, dtype=None, verbose=False
+):
 
     """
     The input label image is smoothed using a Gaussian kernel.
@@ -157,6 +187,8 @@ def smoL(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
         sy (float): Smoothing in y.
         sz (float): Smoothing in z.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -164,26 +196,28 @@ def smoL(input, output=None, sx=0.0, sy=0.0, sz=0.0, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        cmd_str += f" -out {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += f" -smoL {sx} {sy} {sz} "
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def add(input, x, output=None, verbose=False):
+@niftyreg_command
+def add(input, x, output=None, out=None, dtype=None, verbose=False):
 
     """
     This image (or value) is added to the input.
@@ -192,6 +226,8 @@ def add(input, x, output=None, verbose=False):
         input (array): Input array.
         x (array/float): Image or value to be added to the input array.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -199,31 +235,33 @@ def add(input, x, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, x) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
 
         if np.isscalar(x):
-            cmd_str += f" -add {x}"
+            cmd_str += f" -add {shlex.quote(str(x))}"
         else:
-            write_nifti(path.join(tmp_folder, "x.nii"), x)
-            cmd_str += " -add " + path.join(tmp_folder, "x.nii")
+            x = stage_nifti(path.join(tmp_folder, "x.nii"), x)
+            cmd_str += f" -add {shlex.quote(str(x))}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def sub(input, x, output=None, verbose=False):
+@niftyreg_command
+def sub(input, x, output=None, out=None, dtype=None, verbose=False):
 
     """
     This image (or value) is subtracted from the input
@@ -232,6 +270,8 @@ def sub(input, x, output=None, verbose=False):
         input (array): Input array.
         x (array/float): Image or value to be subtracted from the input array.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -239,31 +279,33 @@ def sub(input, x, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, x) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
 
         if np.isscalar(x):
-            cmd_str += f" -sub {x}"
+            cmd_str += f" -sub {shlex.quote(str(x))}"
         else:
-            write_nifti(path.join(tmp_folder, "x.nii"), x)
-            cmd_str += " -sub " + path.join(tmp_folder, "x.nii")
+            x = stage_nifti(path.join(tmp_folder, "x.nii"), x)
+            cmd_str += f" -sub {shlex.quote(str(x))}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def mul(input, x, output=None, verbose=False):
+@niftyreg_command
+def mul(input, x, output=None, out=None, dtype=None, verbose=False):
 
     """
     This image (or value) is multiplied with the input
@@ -272,6 +314,8 @@ def mul(input, x, output=None, verbose=False):
         input (array): Input array.
         x (array/float): Image or value to be multiplied with the input array.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -279,31 +323,33 @@ def mul(input, x, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, x) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        cmd_str += f" -out {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str += f" -out {shlex.quote(output)}"
 
         if np.isscalar(x):
-            cmd_str += f" -mul {x}"
+            cmd_str += f" -mul {shlex.quote(str(x))}"
         else:
-            write_nifti(path.join(tmp_folder, "x.nii"), x)
-            cmd_str += " -mul " + path.join(tmp_folder, "x.nii")
+            x = stage_nifti(path.join(tmp_folder, "x.nii"), x)
+            cmd_str += f" -mul {shlex.quote(str(x))}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def div(input, x, output=None, verbose=False):
+@niftyreg_command
+def div(input, x, output=None, out=None, dtype=None, verbose=False):
 
     """
     This image (or value) is divided to the input
@@ -312,6 +358,8 @@ def div(input, x, output=None, verbose=False):
         input (array): Input array.
         x (array/float): Image or value to divide the input array by.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
 
     Returns:
@@ -319,30 +367,32 @@ def div(input, x, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, x) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
 
         if np.isscalar(x):
-            cmd_str += f" -div {x}"
+            cmd_str += f" -div {shlex.quote(str(x))}"
         else:
-            write_nifti(path.join(tmp_folder, "x.nii"), x)
-            cmd_str += " -div " + path.join(tmp_folder, "x.nii")
+            x = stage_nifti(path.join(tmp_folder, "x.nii"), x)
+            cmd_str += f" -div {shlex.quote(str(x))}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
+@niftyreg_command
 def rms(input, input2, output=None, verbose=False):
 
     """
@@ -356,22 +406,21 @@ def rms(input, input2, output=None, verbose=False):
 
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, input2) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        write_nifti(path.join(tmp_folder, "input2.nii"), input2)
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        input2 = stage_nifti(path.join(tmp_folder, "input2.nii"), input2)
 
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
-        cmd_str += " -rms " + path.join(tmp_folder, "input2.nii")
+        cmd_str += f" -out {shlex.quote(output)}"
+        cmd_str += f" -rms {input2}"
 
-        out = call_niftyreg(cmd_str, verbose, output_stdout=True)
+        out = yield NiftyRegCall(cmd_str, verbose, output_stdout=True)
 
         if out:
             return builtins.float(out)
@@ -379,7 +428,8 @@ def rms(input, input2, output=None, verbose=False):
     return None
 
 
-def bin(input, output=None, verbose=False):
+@niftyreg_command
+def bin(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     Binarize the input image (val!=0?val=1:val=0)
@@ -387,29 +437,33 @@ def bin(input, output=None, verbose=False):
     Args:
         input (array): Input array to be binarized.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += " -out " + path.join(tmp_folder, "output.nii")
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += " -bin"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def thr(input, thr, output=None, verbose=False):
+@niftyreg_command
+def thr(input, thr, output=None, out=None, dtype=None, verbose=False):
 
     """
     Threshold the input image (val<thr?val=0:val=1)
@@ -417,26 +471,33 @@ def thr(input, thr, output=None, verbose=False):
     Args:
         input (array): Input array to be thresholded.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        cmd_str += " -out " + path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += f" -thr {thr}"
 
-        return read_nifti(output) if call_niftyreg(cmd_str, verbose) else None
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
+
+    return None
 
 
-def nan(input, mask, output=None, verbose=False):
+@niftyreg_command
+def nan(input, mask, output=None, out=None, dtype=None, verbose=False):
 
     """
     Mask the input image. Voxels outside of the mask are set to NaN.
@@ -445,29 +506,35 @@ def nan(input, mask, output=None, verbose=False):
         input (array): Input array.
         mask (array): Input mask, values outside mask is set to NaN.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input, mask) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        write_nifti(path.join(tmp_folder, "mask.nii"), mask)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        mask = stage_nifti(path.join(tmp_folder, "mask.nii"), mask, kind="mask")
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        cmd_str += " -out " + path.join(tmp_folder, "output.nii")
-        cmd_str += " -nan " + path.join(tmp_folder, "mask.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output, output_nan=True)
+        cmd_str += f" -out {shlex.quote(output)}"
+        cmd_str += f" -nan {shlex.quote(mask)}"
+
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(
+                output, output_nan=True, as_image=as_image, out=out, dtype=dtype
+            )
 
     return None
 
 
-def iso(input, output=None, verbose=False):
+@niftyreg_command
+def iso(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     The resulting image is made isotropic
@@ -475,29 +542,33 @@ def iso(input, output=None, verbose=False):
     Args:
         input (array): Input array to be made isotropic.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += " -out " + path.join(tmp_folder, "output.nii")
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += " -iso"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def noscl(input, output=None, verbose=False):
+@niftyreg_command
+def noscl(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     The scl_slope and scl_inter are set to 1 and 0 respectively
@@ -505,29 +576,35 @@ def noscl(input, output=None, verbose=False):
     Args:
         input (array): Input array.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
         cmd_str = "reg_tools"
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
+
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += " -out " + path.join(tmp_folder, "output.nii")
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += " -noscl"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def chgres(input, sx=0.0, sy=0.0, sz=0.0, output=None, verbose=False):
+@niftyreg_command
+def chgres(
+    input, sx=0.0, sy=0.0, sz=0.0, output=None, out=None, dtype=None, verbose=False
+):
 
     """
     Resample the input image to the specified resolution (in mm)
@@ -538,6 +615,8 @@ def chgres(input, sx=0.0, sy=0.0, sz=0.0, output=None, verbose=False):
         sy (float): Resolution in y.
         sz (float): Resolution in z.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
     cmd_str = "reg_tools"
@@ -545,24 +624,26 @@ def chgres(input, sx=0.0, sy=0.0, sz=0.0, output=None, verbose=False):
     if not is_function_available(cmd_str, "chgres"):
         return NotImplemented  # pragma: no cover
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        as_image = is_image(input)
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        cmd_str += f" -out {output}"
+        output = output_file(tmp_folder, "output.nii", output)
+
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += f" -chgres {sx} {sy} {sz}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def rmNanInf(input, x=0.0, output=None, verbose=False):
+@niftyreg_command
+def rmNanInf(input, x=0.0, output=None, out=None, dtype=None, verbose=False):
 
     """
     Remove NaN and Inf values from the input image and replace with specified value
@@ -571,6 +652,8 @@ def rmNanInf(input, x=0.0, output=None, verbose=False):
         input (array): Input array.
         x (float): Value that should be used to replace NaN and Inf (default = 0.0).
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
@@ -579,24 +662,26 @@ def rmNanInf(input, x=0.0, output=None, verbose=False):
     if not is_function_available(cmd_str, "rmNanInf"):
         return NotImplemented  # pragma: no cover
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
+
+        as_image = is_image(input)
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
-        cmd_str += f" -rmNanInf {x}"
+        cmd_str += f" -out {shlex.quote(output)}"
+        cmd_str += f" -rmNanInf {shlex.quote(str(x))}"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
 
 
-def testActiveBlocks(input, output=None, verbose=False):
+@niftyreg_command
+def testActiveBlocks(input, output=None, out=None, dtype=None, verbose=False):
 
     """
     Generate image showing the active blocks for reg.aladin (block variance is shown)
@@ -604,6 +689,8 @@ def testActiveBlocks(input, output=None, verbose=False):
     Args:
         input (array): Input array.
         output (string): Specify output file (optional).
+        out (array): Array to read the result into (optional).
+        dtype (dtype): Data type of the result (default = as written).
         verbose (bool): Verbose output (default = False).
     """
 
@@ -612,18 +699,39 @@ def testActiveBlocks(input, output=None, verbose=False):
     if not is_function_available(cmd_str, "testActiveBlocks"):
         return NotImplemented  # pragma: no cover
 
-    with tmp.TemporaryDirectory() as tmp_folder:
+    with scratch_dir(input) as tmp_folder:
+
+        as_image = is_image(input)
 
-        write_nifti(path.join(tmp_folder, "input.nii"), input)
-        cmd_str += " -in " + path.join(tmp_folder, "input.nii")
+        input = stage_nifti(path.join(tmp_folder, "input.nii"), input)
+        cmd_str += f" -in {shlex.quote(input)}"
 
-        if output is None:
-            output = path.join(tmp_folder, "output.nii")
+        output = output_file(tmp_folder, "output.nii", output)
 
-        cmd_str += f" -out {output}"
+        cmd_str += f" -out {shlex.quote(output)}"
         cmd_str += " -testActiveBlocks"
 
-        if call_niftyreg(cmd_str, verbose):
-            return read_nifti(output)
+        if (yield NiftyRegCall(cmd_str, verbose)):
+            return read_nifti(output, as_image=as_image, out=out, dtype=dtype)
 
     return None
+
+
+float_async = float.async_
+down_async = down.async_
+smoS_async = smoS.async_
+smoG_async = smoG.async_
+smoL_async = smoL.async_
+add_async = add.async_
+sub_async = sub.async_
+mul_async = mul.async_
+div_async = div.async_
+rms_async = rms.async_
+bin_async = bin.async_
+thr_async = thr.async_
+nan_async = nan.async_
+iso_async = iso.async_
+noscl_async = noscl.async_
+chgres_async = chgres.async_
+rmNanInf_async = rmNanInf.async_
+testActiveBlocks_async = testActiveBlocks.async_
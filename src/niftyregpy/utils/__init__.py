@@ -1,5 +1,6 @@
 from .utils import (
     call_niftyreg,
+    check_roi,
     colorband,
     create_test_image,
     get_help_string,
@@ -7,5 +8,58 @@ from .utils import (
     read_nifti,
     read_txt,
     write_nifti,
+    write_nifti_empty,
+    write_nifti_raw,
     write_txt,
 )
+from .binaries import (
+    capabilities,
+    find_binary,
+    get_version,
+    has_option,
+    set_niftyreg_path,
+)
+from .bulk import read_niftis, set_io_threads, stage_niftis
+from .compress import flush_outputs, output_file, set_output_compression
+from .events import EventStream, NiftyRegEvent, StopRegistration, stop_after
+from .governor import (
+    cpu_count,
+    get_thread_budget,
+    numa_nodes,
+    pinning,
+    set_thread_budget,
+    thread_tokens,
+)
+from .image import Geometry, Image, is_image
+from .lazy import LazyImage, lazy_output
+from .launcher import get_launcher, set_launcher
+from .logs import JsonFormatter, set_json_logging, set_trace_file, span
+from .metrics import render_metrics, serve_metrics, set_metrics, write_metrics
+from .runner import (
+    NiftyRegCall,
+    call_niftyreg_async,
+    niftyreg_command,
+    run_wrapper,
+    run_wrapper_async,
+    set_async_limit,
+)
+from .staging import (
+    get_staging_cache,
+    get_staging_policy,
+    is_affine,
+    set_staging_cache,
+    set_staging_policy,
+    stage_geometry,
+    stage_nifti,
+    stage_txt,
+    staging_policy,
+)
+from .telemetry import (
+    TelemetryRecord,
+    add_telemetry_hook,
+    get_telemetry,
+    remove_telemetry_hook,
+    set_telemetry,
+    telemetry_summary,
+)
+from .workspace import get_workspace, scratch_dir, set_workspace
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Helper process that starts NiftyReg on behalf of a (large) parent process.
+
+Run as a script, with a Unix SOCK_SEQPACKET socket as stdin, so that it only
+imports the standard library. Every request is a JSON message with the
+command, environment and CPUs of a call, and the write ends of its stdout and
+stderr pipes. The helper replies with the pid of the started process (or the
+error), and with its exit status and resource usage once it has ended.
+"""
+
+import json
+import os
+import socket
+import threading
+
+_MAX_MESSAGE = 1 << 20
+
+
+def _send(sock, lock, message):
+
+    with lock:
+        sock.send(json.dumps(message).encode("utf-8"))
+
+
+def _reap(sock, lock, request_id, pid):
+
+    _, status, rusage = os.wait4(pid, 0)
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+
+    _send(
+        sock,
+        lock,
+        {
+            "id": request_id,
+            "returncode": returncode,
+            "utime": rusage.ru_utime,
+            "stime": rusage.ru_stime,
+            "maxrss": rusage.ru_maxrss,
+        },
+    )
+
+
+def _start(request, fds):
+
+    actions = [(os.POSIX_SPAWN_DUP2, fd, target) for fd, target in zip(fds, (1, 2))]
+    cpus = request.get("cpus")
+
+    # The process inherits the CPUs of this thread before it runs any code
+    if cpus:
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus)
+
+    try:
+        return os.posix_spawnp(
+            request["args"][0], request["args"], request["env"], file_actions=actions
+        )
+    finally:
+        if cpus:
+            os.sched_setaffinity(0, previous)
+
+
+def main():
+
+    sock = socket.socket(fileno=0)
+    lock = threading.Lock()
+
+    while True:
+        message, fds, _, _ = socket.recv_fds(sock, _MAX_MESSAGE, 2)
+
+        if not message:
+            break
+
+        request = json.loads(message)
+
+        try:
+            pid = _start(request, fds)
+        except OSError as e:
+            _send(
+                sock,
+                lock,
+                {
+                    "id": request["id"],
+                    "errno": e.errno,
+                    "error": e.strerror,
+                    "filename": request["args"][0],
+                },
+            )
+            continue
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        _send(sock, lock, {"id": request["id"], "pid": pid})
+
+        threading.Thread(
+            target=_reap, args=(sock, lock, request["id"], pid), daemon=True
+        ).start()
+
+
+if __name__ == "__main__":
+    main()
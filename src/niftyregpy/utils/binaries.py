@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Discovery and capabilities of the NiftyReg executables.
+
+The ``reg_*`` executables are looked up once, in the folder set with
+:func:`set_niftyreg_path` or the ``NIFTYREG_PATH`` environment variable, or
+else on the ``PATH``. The help text and version of every executable are probed
+once and kept in memory, and optionally in a file shared between processes.
+Both caches are keyed by the path, modification time and size of the
+executable, so that a rebuilt NiftyReg is probed again.
+
+Wrappers check :func:`has_option` instead of running ``<tool> -h`` for every
+call. Given a NiftyReg installation, an example usage is:
+    >>> niftyregpy.utils.set_niftyreg_path("/opt/niftyreg/bin", "~/.niftyreg.json")
+    >>> niftyregpy.utils.capabilities()["reg_tools"]["version"]
+    '1.5.69'
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess as sp
+import threading
+import uuid
+
+TOOLS = (
+    "reg_aladin",
+    "reg_average",
+    "reg_f3d",
+    "reg_jacobian",
+    "reg_measure",
+    "reg_resample",
+    "reg_tools",
+    "reg_transform",
+)
+
+_OPTION = re.compile(r"(?<![\w-])--?([A-Za-z]\w*)")
+_VERSION = re.compile(r"\d+(?:\.\d+)+")
+
+_config = {"path": os.environ.get("NIFTYREG_PATH") or None, "cache_file": None}
+_lock = threading.Lock()
+_paths = {}
+_probes = {}
+_disk = None
+
+
+def set_niftyreg_path(path=None, cache_file=None):
+
+    """
+    Set where the NiftyReg executables are, and forget what has been probed.
+
+    Args:
+        path (string): Folder with the ``reg_*`` executables
+            (default = ``NIFTYREG_PATH``, or the ``PATH``).
+        cache_file (string): JSON file to keep help texts and versions in
+            across processes (optional).
+
+    """
+
+    global _disk
+
+    with _lock:
+        _config["path"] = path or os.environ.get("NIFTYREG_PATH") or None
+        _config["cache_file"] = (
+            None if cache_file is None else os.path.expanduser(os.fspath(cache_file))
+        )
+        _paths.clear()
+        _probes.clear()
+        _disk = None
+
+
+def find_binary(tool: str) -> str:
+
+    """
+    Return the path of a NiftyReg executable, or None if it is not found.
+    """
+
+    if not tool.startswith("reg_") or os.sep in tool or " " in tool:
+        return None
+
+    # Without an install path, the lookup depends on the current PATH
+    path = _config["path"] or os.environ.get("PATH", os.defpath)
+    key = (tool, path)
+
+    try:
+        return _paths[key]
+    except KeyError:
+        pass
+
+    name = shutil.which(tool, path=path)
+
+    with _lock:
+        _paths[key] = name = None if name is None else os.path.abspath(name)
+
+    return name
+
+
+def _run(name, option):
+
+    try:
+        p = sp.run([name, option], stdout=sp.PIPE, stderr=sp.PIPE, timeout=60)
+    except (OSError, sp.TimeoutExpired):
+        return None
+
+    if not p.stdout or p.stderr:
+        return None
+
+    return p.stdout.decode(encoding="utf-8", errors="replace")
+
+
+def _load_disk():
+
+    # Entries of the cache file, read once
+    global _disk
+
+    if _disk is None:
+        _disk = {}
+        try:
+            with open(_config["cache_file"], encoding="utf-8") as f:
+                _disk = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    return _disk
+
+
+def _save_disk(key, entry):
+
+    name = _config["cache_file"]
+    partial = f"{name}.{uuid.uuid4().hex}.tmp"
+
+    # Merge with entries written by other processes in the meantime
+    disk = dict(_load_disk())
+    try:
+        with open(name, encoding="utf-8") as f:
+            disk.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    disk[key] = entry
+
+    try:
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump(disk, f)
+        os.replace(partial, name)
+    except OSError:
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+
+def _probe(tool):
+
+    # Help text and version of a tool, probed once per build of the executable
+    name = find_binary(tool)
+
+    if name is None:
+        return None
+
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+
+    key = f"{name}|{st.st_mtime_ns}|{st.st_size}"
+
+    entry = _probes.get(name)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    with _lock:
+        entry = _probes.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        info = _load_disk().get(key) if _config["cache_file"] else None
+
+        if info is None:
+            text = _run(name, "-h")
+            version = _run(name, "--version")
+            match = _VERSION.search(version or "")
+            info = {
+                "help": text,
+                "version": match.group(0) if match else None,
+                "options": sorted(set(_OPTION.findall(text or ""))),
+            }
+            if _config["cache_file"]:
+                _save_disk(key, info)
+
+        _probes[name] = (key, info)
+
+    return info
+
+
+def get_version(tool: str) -> str:
+
+    """
+    Return the version of a NiftyReg executable, or None if it is not known.
+    """
+
+    info = _probe(tool)
+
+    return None if info is None else info["version"]
+
+
+def has_option(tool: str, name: str) -> bool:
+
+    """
+    Return True if the help text of a NiftyReg executable lists ``-name``
+    (case-insensitive).
+    """
+
+    info = _probe(tool)
+
+    if info is None or info["help"] is None:
+        return False
+
+    return f"-{name.lower()}" in info["help"].lower()
+
+
+def capabilities(tools=TOOLS) -> dict:
+
+    """
+    Return the path, version and options of every NiftyReg executable that is
+    found.
+
+    Returns:
+        dict: ``{tool: {"path": ..., "version": ..., "options": frozenset}}``.
+
+    """
+
+    table = {}
+
+    for tool in tools:
+        info = _probe(tool)
+        if info is not None:
+            table[tool] = {
+                "path": find_binary(tool),
+                "version": info["version"],
+                "options": frozenset(info["options"]),
+            }
+
+    return table
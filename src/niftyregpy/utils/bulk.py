@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Bulk staging and loading of NIfTI files.
+
+Hashing, encoding and file I/O release the GIL, so staging or reading many
+images at once is spread over a small shared thread pool.
+"""
+
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .staging import stage_nifti
+from .utils import read_nifti
+
+_DEFAULT_THREADS = min(8, os.cpu_count() or 1)
+
+_lock = threading.Lock()
+_threads = _DEFAULT_THREADS
+_executor = None
+
+
+def _reset_after_fork():
+    global _executor
+    _executor = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _map(fn, *iterables):
+
+    global _executor
+
+    jobs = list(zip(*iterables))
+
+    if len(jobs) < 2 or _threads < 2:
+        return [fn(*job) for job in jobs]
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_threads, thread_name_prefix="niftyregpy-io")
+        executor = _executor
+
+    # Run every job in a copy of the caller's context, e.g. its staging policy
+    context = contextvars.copy_context()
+
+    return list(executor.map(lambda job: context.copy().run(fn, *job), jobs))
+
+
+def set_io_threads(threads=_DEFAULT_THREADS):
+
+    """
+    Set the number of threads used to stage and read images in bulk.
+
+    Args:
+        threads (int): Number of threads, 1 stages images one after another
+            (default = number of CPUs, at most 8).
+
+    """
+
+    global _threads, _executor
+
+    with _lock:
+        old, _executor, _threads = _executor, None, max(1, int(threads))
+
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def stage_niftis(names, arrays, kind="image") -> list:
+
+    """
+    Stage several arrays as NIfTI files in parallel, see :func:`stage_nifti`.
+
+    Args:
+        names (string/list): Destinations, or a prefix to which ``_<index>.nii``
+            is appended.
+        arrays (list): Arrays, paths or images to stage.
+        kind (string): Kind of all arrays (default = image).
+
+    Returns:
+        list: Paths of the staged files, in the order of ``arrays``.
+
+    """
+
+    arrays = list(arrays)
+
+    if isinstance(names, (str, os.PathLike)):
+        names = [f"{os.fspath(names)}_{i}.nii" for i in range(len(arrays))]
+
+    return _map(lambda name, x: stage_nifti(name, x, kind=kind), names, arrays)
+
+
+def read_niftis(names, **kwargs) -> list:
+
+    """
+    Read several NIfTI files in parallel, see :func:`read_nifti`.
+
+    Args:
+        names (list): Files to read.
+        **kwargs: Passed on to :func:`read_nifti`.
+
+    Returns:
+        list: Arrays (or Images), in the order of ``names``.
+
+    """
+
+    return _map(lambda name: read_nifti(name, **kwargs), names)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""Compressed NIfTI inputs and outputs.
+
+NiftyReg compresses ``.nii.gz`` outputs itself, on a single thread and before
+the call returns. Instead, outputs with a ``.nii.gz`` destination are written
+uncompressed inside the workspace, returned from there, and compressed to their
+destination in the background, with ``pigz`` if it is installed and otherwise
+with zlib on several threads. Use :func:`flush_outputs` to wait for them;
+reading or staging a destination waits for its own output. An output that
+cannot be compressed is kept uncompressed next to its destination.
+
+Compressed inputs are decompressed once into the staging cache, so that
+NiftyReg reads them uncompressed. Files compressed with zlib by
+:func:`gzip_file` are decompressed on several threads, all others (including
+those written by ``pigz``) on one.
+"""
+
+import atexit
+import gzip
+import itertools
+import logging
+import os
+import shutil
+import struct
+import subprocess as sp
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .workspace import _on_release, _private_dir
+
+_CHUNK_SIZE = 4 << 20
+
+# gzip member header with an extra field holding the size of the member
+_HEADER = struct.Struct("<4sIBBH2sHI")
+_MAGIC = b"\x1f\x8b\x08\x04"
+_EXTRA_ID = b"NR"
+_TRAILER = struct.Struct("<II")
+_PIGZ = shutil.which("pigz")
+
+logger = logging.getLogger(__name__)
+
+_config = {"level": 6, "threads": os.cpu_count() or 1, "background": True}
+_lock = threading.Lock()
+_executor = None
+_pending = {}
+_failed = []
+
+
+def _reset_after_fork():
+    global _executor, _pending, _failed
+    _executor, _pending, _failed = None, {}, []
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _gzip_member(data, level):
+    # Concatenated gzip members form a valid gzip file. Each member records its
+    # size, so that gunzip_file can find the members and inflate them in parallel
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    size = _HEADER.size + len(body) + _TRAILER.size
+    header = _HEADER.pack(_MAGIC, 0, 0, 255, 8, _EXTRA_ID, 4, size)
+    return header + body + _TRAILER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+
+def _member_size(header):
+    # Size of a member written by _gzip_member, None for any other member
+    if len(header) < _HEADER.size:
+        return None
+    magic, _, _, _, xlen, extra_id, length, size = _HEADER.unpack(header)
+    if (magic, xlen, extra_id, length) != (_MAGIC, 8, _EXTRA_ID, 4):
+        return None
+    return size
+
+
+def _read_member(f):
+    header = f.read(_HEADER.size)
+    if not header:
+        return b""
+    size = _member_size(header)
+    member = header + f.read(size - _HEADER.size) if size else b""
+    if not size or len(member) != size:
+        raise OSError(f"Not a gzip member written by gzip_file: {f.name}")
+    return member
+
+
+def _gunzip_member(member):
+    data = zlib.decompress(
+        member[_HEADER.size : -_TRAILER.size], -zlib.MAX_WBITS, _CHUNK_SIZE
+    )
+    crc, size = _TRAILER.unpack(member[-_TRAILER.size :])
+    if zlib.crc32(data) != crc or len(data) & 0xFFFFFFFF != size:
+        raise OSError("CRC check failed")
+    return data
+
+
+def gzip_file(src, dst, level=None, threads=None):
+
+    """
+    Compress ``src`` to ``dst`` with gzip, using several threads.
+
+    Args:
+        src (string): File to compress.
+        dst (string): Compressed file to write.
+        level (int): Compression level (default = 6).
+        threads (int): Number of threads (default = number of CPUs).
+
+    """
+
+    level = _config["level"] if level is None else level
+    threads = _config["threads"] if threads is None else threads
+
+    if _PIGZ:
+        with open(dst, "wb") as f:
+            sp.run(
+                [_PIGZ, "-c", f"-{level}", "-p", str(threads), src],
+                stdout=f,
+                stderr=sp.PIPE,
+                check=True,
+            )
+        return
+
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        chunks = iter(lambda: fin.read(_CHUNK_SIZE), b"")
+
+        with ThreadPoolExecutor(threads) as pool:
+            # Keep a bounded number of chunks in memory
+            while True:
+                batch = list(itertools.islice(chunks, 2 * threads))
+                if not batch:
+                    break
+                for member in pool.map(_gzip_member, batch, [level] * len(batch)):
+                    fout.write(member)
+
+
+def gunzip_file(src, dst, threads=None):
+
+    """
+    Decompress the gzip file ``src`` to ``dst``.
+
+    Files written by :func:`gzip_file` with zlib are decompressed on several
+    threads. Other files, including those written by ``pigz``, are decompressed
+    on one thread, as neither zlib nor ``pigz`` can inflate a single gzip
+    stream in parallel.
+
+    Args:
+        src (string): File to decompress.
+        dst (string): Decompressed file to write.
+        threads (int): Number of threads (default = number of CPUs).
+
+    """
+
+    threads = _config["threads"] if threads is None else threads
+
+    with open(src, "rb") as f:
+        parallel = _member_size(f.read(_HEADER.size)) is not None
+
+    if not parallel and _PIGZ:
+        with open(dst, "wb") as f:
+            sp.run([_PIGZ, "-dc", src], stdout=f, stderr=sp.PIPE, check=True)
+        return
+
+    if not parallel:
+        with gzip.open(src, "rb") as fin, open(dst, "wb") as fout:
+            shutil.copyfileobj(fin, fout, _CHUNK_SIZE)
+        return
+
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        members = iter(lambda: _read_member(fin), b"")
+
+        with ThreadPoolExecutor(threads) as pool:
+            # Keep a bounded number of members in memory
+            while True:
+                batch = list(itertools.islice(members, 2 * threads))
+                if not batch:
+                    break
+                for data in pool.map(_gunzip_member, batch):
+                    fout.write(data)
+
+
+def _keep_uncompressed(src, dst):
+
+    # Move the output next to its destination, as .nii instead of .nii.gz. If
+    # that fails too, it stays where it is until the workspace is cleaned up
+    kept = dst[: -len(".gz")]
+
+    try:
+        os.replace(src, kept)
+        return kept
+    except OSError:
+        pass
+
+    try:
+        shutil.copyfile(src, kept)
+    except OSError:
+        if os.path.exists(kept):
+            os.unlink(kept)
+        return src
+
+    os.unlink(src)
+
+    return kept
+
+
+def _compress(src, dst):
+
+    partial = f"{dst}.part"
+
+    try:
+        gzip_file(src, partial)
+        os.replace(partial, dst)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        kept = _keep_uncompressed(src, dst)
+        logger.error("Could not compress %s, kept %s: %s", dst, kept, e)
+        with _lock:
+            _failed.append((dst, kept, e))
+        return kept
+
+    os.unlink(src)
+
+    return dst
+
+
+def _persist(folder, src, dst):
+
+    if not os.path.exists(src):
+        return
+
+    pending = _private_dir(folder, "pending")
+
+    # Move the output out of the scratch folder, which is about to be emptied
+    if pending is not None:
+        kept = os.path.join(pending, f"{uuid.uuid4().hex}.nii")
+        os.replace(src, kept)
+        src = kept
+
+    if pending is None or not _config["background"]:
+        return _compress(src, dst)
+
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(1, thread_name_prefix="niftyregpy-gzip")
+        key = os.path.abspath(dst)
+        future = _pending[key] = _executor.submit(_compress, src, dst)
+
+    def done(future):
+        with _lock:
+            if _pending.get(key) is future:
+                del _pending[key]
+
+    future.add_done_callback(done)
+
+
+def _wait_output(name):
+
+    # A .nii.gz output that is still being compressed is read once it has been
+    # written, or from where it was kept if that failed
+    if not _pending or not os.fspath(name).endswith(".nii.gz"):
+        return name
+
+    with _lock:
+        future = _pending.get(os.path.abspath(name))
+
+    return name if future is None else future.result()
+
+
+def output_file(folder, name, dst) -> str:
+
+    """
+    Return the file NiftyReg should write an output to.
+
+    Outputs without a destination are written to ``name`` in the scratch
+    ``folder``. Outputs with a ``.nii.gz`` destination are written there too,
+    and compressed to ``dst`` when the scratch folder is released.
+
+    Args:
+        folder (string): Scratch folder of the call.
+        name (string): File name of the output in the scratch folder.
+        dst (string): Destination requested by the caller (optional).
+
+    Returns:
+        string: Path of the output file.
+
+    """
+
+    if dst is None:
+        return os.path.join(folder, name)
+
+    dst = os.fspath(dst)
+
+    if not dst.endswith(".nii.gz"):
+        return dst
+
+    src = os.path.join(folder, name)
+    _on_release(folder, lambda: _persist(folder, src, dst))
+
+    return src
+
+
+def set_output_compression(level=6, threads=None, background=True):
+
+    """
+    Configure how ``.nii.gz`` outputs are compressed.
+
+    Args:
+        level (int): gzip compression level (default = 6).
+        threads (int): Number of compression threads (default = number of CPUs).
+        background (bool): If False, outputs are compressed before the call
+            returns (default = True).
+
+    """
+
+    _config.update(
+        level=int(level),
+        threads=max(1, int(threads or os.cpu_count() or 1)),
+        background=bool(background),
+    )
+
+
+def flush_outputs():
+
+    """
+    Wait until all ``.nii.gz`` outputs have been written to their destination.
+    Raises OSError if outputs could not be compressed since the last call, the
+    message says where they were kept instead.
+    """
+
+    with _lock:
+        pending = list(_pending.values())
+
+    wait(pending)
+
+    with _lock:
+        failed, _failed[:] = list(_failed), []
+
+    if failed:
+        raise OSError(
+            "Could not compress "
+            + ", ".join(f"{dst} (kept {kept}: {e})" for dst, kept, e in failed)
+        )
+
+
+@atexit.register
+def _flush_at_exit():
+    # Failures have been logged already
+    try:
+        flush_outputs()
+    except OSError:
+        pass
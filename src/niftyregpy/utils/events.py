@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Structured progress events from the output of NiftyReg.
+
+NiftyReg output is read line by line while the process runs. Every line is
+passed to an optional callback as a :class:`NiftyRegEvent`, with the pyramid
+level and the objective function parsed out of the lines that report them, e.g.::
+
+    [NiftyReg F3D] Current level: 2 / 3
+    [NiftyReg F3D] [12] Current objective function: 0.0467 = (wSIM)0.0468 ...
+
+Given a long ``reg_f3d`` run, an example usage is:
+    >>> def show(event):
+    ...     if event.kind == "iteration":
+    ...         print(event.level, event.iteration, event.objective)
+    >>> niftyregpy.reg.f3d(ref, flo, on_event=show)
+
+A callback can end a run early by raising :class:`StopRegistration`, in which
+case NiftyReg is sent SIGTERM and writes no outputs. :func:`stop_after` builds
+a time budget for the ``stop_when`` argument of ``reg.aladin`` and ``reg.f3d``.
+"""
+
+import re
+import time
+from collections import namedtuple
+
+from .logs import output_logger
+
+NiftyRegEvent = namedtuple(
+    "NiftyRegEvent",
+    ["kind", "tool", "level", "levels", "iteration", "objective", "terms", "line"],
+)
+NiftyRegEvent.__doc__ = """\
+Line of NiftyReg output. ``kind`` is ``"level"`` when a pyramid level starts,
+``"iteration"`` when the objective function is reported (``iteration`` is 0 for
+the initial value), ``"error"`` for lines on stderr and ``"line"`` otherwise.
+``level`` and ``levels`` are the current and total number of levels, if known.
+``terms`` maps the weighted terms of the objective function to their values,
+e.g. ``{"wSIM": 0.0468, "wBE": 2.3e-05}``."""
+
+_NUMBER = r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?(?:nan|inf))"
+
+_LEVEL = re.compile(r"current level:?\s*(\d+)\s*/\s*(\d+)", re.IGNORECASE)
+_ITERATION = re.compile(
+    r"\[(\d+)\]\s*current objective function:\s*" + _NUMBER, re.IGNORECASE
+)
+_INITIAL = re.compile(r"initial objective function:\s*" + _NUMBER, re.IGNORECASE)
+_TERM = re.compile(r"\((\w+)\)\s*" + _NUMBER)
+
+
+class StopRegistration(Exception):
+
+    """
+    Raised by an event callback to stop the running NiftyReg process.
+    """
+
+
+class EventStream:
+
+    """
+    Turns the output of a NiftyReg process into events, one line at a time.
+
+    Args:
+        cmd_str (string): Command that produces the output.
+        verbose (bool): Log every line as it arrives, see ``utils.logs``
+            (default = False).
+        on_event (callable): Called with a :class:`NiftyRegEvent` per line
+            (optional).
+        keep (bool): Keep stdout, see :attr:`stdout` (default = False).
+
+    """
+
+    def __init__(self, cmd_str, verbose=False, on_event=None, keep=False):
+        self.tool = cmd_str.split(maxsplit=1)[0]
+        self.verbose = verbose
+        self.on_event = on_event
+        self.level = None
+        self.levels = None
+        self.stopped = False
+        self._lines = [] if keep else None
+
+    @property
+    def stdout(self) -> str:
+
+        """
+        Output kept so far, if ``keep`` was set.
+        """
+
+        return "".join(self._lines or ())
+
+    def feed(self, line, kind="line"):
+
+        """
+        Handle one line of output (bytes or str).
+        """
+
+        if isinstance(line, bytes):
+            line = line.decode(encoding="utf-8", errors="replace")
+
+        if self._lines is not None and kind == "line":
+            self._lines.append(line)
+
+        line = line.rstrip("\r\n")
+
+        if self.verbose and kind == "line":
+            output_logger.info(line)
+
+        if self.on_event is None:
+            return
+
+        iteration = objective = terms = None
+
+        if kind == "line":
+            kind, iteration, objective = self._parse(line)
+
+        if kind == "iteration":
+            terms = {k: float(v) for k, v in _TERM.findall(line.partition("=")[2])}
+
+        event = NiftyRegEvent(
+            kind,
+            self.tool,
+            self.level,
+            self.levels,
+            iteration,
+            objective,
+            terms,
+            line,
+        )
+
+        try:
+            self.on_event(event)
+        except StopRegistration:
+            self.stopped = True
+            raise
+
+    def _parse(self, line):
+
+        match = _LEVEL.search(line)
+        if match:
+            self.level, self.levels = int(match.group(1)), int(match.group(2))
+            return "level", None, None
+
+        match = _ITERATION.search(line)
+        if match:
+            return "iteration", int(match.group(1)), float(match.group(2))
+
+        match = _INITIAL.search(line)
+        if match:
+            return "iteration", 0, float(match.group(1))
+
+        return "line", None, None
+
+
+def stop_after(seconds):
+
+    """
+    Return a ``stop_when`` condition that holds once ``seconds`` of wall-clock
+    time have passed since the registration started, including staging the
+    inputs. It is checked whenever an iteration is reported.
+    """
+
+    start = [time.monotonic()]
+
+    def condition(trace):
+        return time.monotonic() - start[0] > seconds
+
+    def restart():
+        start[0] = time.monotonic()
+
+    # Called by the wrappers when a call begins, so a condition can be reused
+    condition.start = restart
+
+    return condition
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""Process-wide budget of threads for NiftyReg calls.
+
+NiftyReg uses OpenMP, and every process uses all cores unless told otherwise,
+so concurrent calls oversubscribe the machine. Every call to
+:func:`call_niftyreg` therefore takes a number of thread tokens from a shared
+budget before it starts, and waits (first come, first served) while the budget
+is exhausted. The call runs with ``OMP_NUM_THREADS`` and, for the tools that
+support it, ``-omp`` set to the number of tokens it holds.
+
+A call asks for as many tokens as its ``-omp`` option. Calls of the tools that
+take ``-omp`` ask for ``per_call`` tokens if it is not given. Calls of the other
+tools take up to ``per_call`` tokens, as many as are free when it is their
+turn, and only wait while none are.
+
+By default ``per_call`` is the whole budget, so that a single call is as fast
+as NiftyReg on its own. **Concurrent calls without** ``-omp`` **therefore run
+one after another**; set ``per_call`` (or ``-omp``) to run them side by side.
+
+With pinning enabled (``set_thread_budget(pin=True)`` or :func:`pinning`), the
+tokens of a call are specific CPUs and the NiftyReg process is bound to them,
+so that concurrent calls run on disjoint sets of cores. The CPUs of a call are
+taken from a single NUMA node when one has enough free CPUs.
+"""
+
+import asyncio
+import collections
+import contextvars
+import glob
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+_OMP_TOOLS = ("reg_aladin", "reg_f3d", "reg_resample")
+_OMP_OPTION = re.compile(r"(?<!\S)-omp\s+(\d+)")
+
+_pin_override = contextvars.ContextVar("niftyregpy_pin", default=None)
+
+logger = logging.getLogger(__name__)
+
+_waiter = None
+_waiter_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _waiter
+    _waiter = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def cpu_count() -> int:
+
+    """
+    Return the number of CPUs this process may run on.
+    """
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _available_cpus():
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(text):
+
+    # e.g. "0-3,8-11"
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes() -> dict:
+
+    """
+    Return the CPUs of every NUMA node, or a single node with all CPUs if the
+    topology is not known.
+    """
+
+    nodes = {}
+
+    for name in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(name))[4:])
+        try:
+            with open(name) as f:
+                nodes[node] = _parse_cpulist(f.read())
+        except (OSError, ValueError):
+            continue
+
+    return nodes or {0: _available_cpus()}
+
+
+class _Governor:
+    def __init__(self, threads, per_call, pin=False):
+        self.in_use = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._held = set()
+        self.resize(threads, per_call, pin)
+
+    def resize(self, threads, per_call, pin=False):
+
+        # Calls that are running keep their tokens and CPUs, calls that are
+        # waiting are granted against the new budget
+        with self._cond:
+            self.threads = threads
+            self.per_call = per_call
+            self.pin = pin
+
+            # Pinned calls get CPUs this process may run on, so pinning needs a
+            # budget of at most that many threads
+            cpus = set(_available_cpus())
+            self._nodes = [
+                [c for c in node if c in cpus]
+                for _, node in sorted(numa_nodes().items())
+            ]
+            self._nodes = [node for node in self._nodes if node]
+            self._cpus = cpus
+            self._free = cpus - self._held
+            self._can_pin = threads <= len(cpus)
+
+            self._cond.notify_all()
+
+    def _clamp(self, n):
+        return max(1, min(int(n), self.threads))
+
+    def _pick(self, n):
+
+        # Prefer the fullest NUMA node that still fits the call, otherwise
+        # spread it over the nodes with the most free CPUs
+        free = [[c for c in node if c in self._free] for node in self._nodes]
+        fits = [node for node in free if len(node) >= n]
+
+        if fits:
+            return min(fits, key=len)[:n]
+
+        cpus = []
+        for node in sorted(free, key=len, reverse=True):
+            cpus += node[: n - len(cpus)]
+
+        return cpus
+
+    def acquire(self, n, pin=False, elastic=False):
+
+        # Elastic calls take up to n tokens, as many as are free
+        ticket = object()
+        cpus = None
+
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                self._cond.wait_for(
+                    lambda: self._queue[0] is ticket
+                    and self.in_use + (1 if elastic else self._clamp(n)) <= self.threads
+                )
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+            n = self._clamp(n)
+            if elastic:
+                n = max(1, min(n, self.threads - self.in_use))
+            self.in_use += n
+
+            if pin and self._can_pin:
+                cpus = self._pick(n)
+                self._free.difference_update(cpus)
+                self._held.update(cpus)
+
+        return n, cpus
+
+    def release(self, n, cpus=None):
+        with self._cond:
+            self.in_use -= n
+            if cpus:
+                self._held.difference_update(cpus)
+                self._free.update(self._cpus.intersection(cpus))
+            self._cond.notify_all()
+
+    def waiting(self):
+        with self._cond:
+            return len(self._queue)
+
+
+_governor = _Governor(cpu_count(), None)
+
+
+def set_thread_budget(threads=None, per_call=None, pin=False):
+
+    """
+    Set the number of threads shared by all NiftyReg calls of this process.
+
+    Args:
+        threads (int): Size of the budget (default = number of CPUs).
+        per_call (int): Threads of a call without ``-omp`` (default = threads).
+            With the default, concurrent calls without ``-omp`` run one after
+            another.
+        pin (bool): Bind every call to its own CPUs, grouped by NUMA node. Only
+            possible if ``threads`` is at most the number of CPUs
+            (default = False).
+
+    """
+
+    threads = max(1, int(threads or cpu_count()))
+    per_call = None if per_call is None else max(1, int(per_call))
+
+    # The budget is resized in place, so that tokens held by running calls
+    # still count against it
+    _governor.resize(threads, per_call, bool(pin))
+
+
+@contextmanager
+def pinning(pin=True):
+
+    """
+    Enable (or disable) pinning for the NiftyReg calls made in this context,
+    regardless of :func:`set_thread_budget`. ``pin=None`` changes nothing.
+    """
+
+    if pin is None:
+        yield
+        return
+
+    token = _pin_override.set(bool(pin))
+    try:
+        yield
+    finally:
+        _pin_override.reset(token)
+
+
+def get_thread_budget() -> dict:
+
+    """
+    Return the size of the thread budget, the threads in use and the number of
+    calls waiting for threads.
+    """
+
+    governor = _governor
+
+    return {
+        "threads": governor.threads,
+        "per_call": governor.per_call or governor.threads,
+        "pin": governor.pin,
+        "in_use": governor.in_use,
+        "waiting": governor.waiting(),
+    }
+
+
+_warned = False
+
+
+def _request(governor, cmd_str):
+
+    global _warned
+
+    match = _OMP_OPTION.search(cmd_str)
+    pin = _pin_override.get()
+    pin = governor.pin if pin is None else pin
+
+    if match:
+        return int(match.group(1)), pin, False
+
+    n = governor.per_call or governor.threads
+
+    if cmd_str.split(maxsplit=1)[0] not in _OMP_TOOLS:
+        # Tools without -omp cannot be told later that more threads are free,
+        # so they take what is free now instead of waiting for their share
+        return n, pin, True
+
+    if governor.per_call is None and governor.in_use and not _warned:
+        _warned = True
+        logger.warning(
+            "NiftyReg calls without -omp take the whole thread budget and run "
+            "one after another, set per_call in set_thread_budget to run them "
+            "concurrently"
+        )
+
+    return n, pin, False
+
+
+def _with_threads(cmd_str, n, cpus):
+
+    # Returns the command and the launcher arguments of a call holding n tokens
+    if _OMP_OPTION.search(cmd_str):
+        cmd_str = _OMP_OPTION.sub(f"-omp {n}", cmd_str, count=1)
+    elif cmd_str.split(maxsplit=1)[0] in _OMP_TOOLS:
+        cmd_str += f" -omp {n}"
+
+    kwargs = {"env": dict(os.environ, OMP_NUM_THREADS=str(n))}
+
+    if cpus:
+        kwargs["cpus"] = cpus
+
+    return cmd_str, kwargs
+
+
+@contextmanager
+def thread_tokens(cmd_str):
+
+    """
+    Hold thread tokens for a NiftyReg command while it runs.
+
+    Yields:
+        tuple: Command with ``-omp`` set, and the keyword arguments to launch
+        it with (environment and CPUs to bind it to).
+
+    """
+
+    governor = _governor
+    n, cpus = governor.acquire(*_request(governor, cmd_str))
+
+    try:
+        yield _with_threads(cmd_str, n, cpus)
+    finally:
+        governor.release(n, cpus)
+
+
+def _get_waiter():
+
+    # Async calls wait for their tokens on a thread of their own rather than on
+    # the default executor, which running calls need to stage and read. Tokens
+    # are handed out first come, first served, so one thread is enough
+    global _waiter
+
+    with _waiter_lock:
+        if _waiter is None:
+            _waiter = ThreadPoolExecutor(1, thread_name_prefix="niftyregpy-tokens")
+        return _waiter
+
+
+class thread_tokens_async:
+
+    """
+    Same as :func:`thread_tokens`, waiting without blocking the event loop or
+    its default executor.
+    """
+
+    # A class rather than contextlib.asynccontextmanager, which needs Python 3.7
+
+    def __init__(self, cmd_str):
+        self.cmd_str = cmd_str
+        self.governor = _governor
+
+    async def __aenter__(self):
+        governor = self.governor
+        acquired = _get_waiter().submit(
+            governor.acquire, *_request(governor, self.cmd_str)
+        )
+
+        def give_back(future):
+            if not future.cancelled() and future.exception() is None:
+                governor.release(*future.result())
+
+        try:
+            self.n, self.cpus = await asyncio.shield(asyncio.wrap_future(acquired))
+        except asyncio.CancelledError:
+            # Calls that are still queued are dropped, the others are handed
+            # their tokens anyway, give them back once they are
+            if not acquired.cancel():
+                acquired.add_done_callback(give_back)
+            raise
+
+        return _with_threads(self.cmd_str, self.n, self.cpus)
+
+    async def __aexit__(self, *exc_info):
+        self.governor.release(self.n, self.cpus)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Image container that keeps the geometry of an array.
+
+Plain arrays are staged with an identity affine, i.e. as 1 mm isotropic voxels.
+An :class:`Image` carries the affine and NIfTI header along with the array, so
+that voxel spacing and orientation survive a chain of calls such as
+``aladin`` -> ``f3d`` -> ``resample``. Wrappers that are given an Image return
+an Image.
+"""
+
+import nibabel as nib
+import numpy as np
+
+
+class Image:
+
+    """
+    Array with an affine and an optional NIfTI header.
+
+    The array is not copied, so an Image can wrap a memory map or a view.
+
+    Args:
+        array (array): Image data.
+        affine (array): Voxel to world affine (default = identity).
+        header (header): NIfTI header, e.g. to keep intent codes (optional).
+
+    Given an array ``data`` with 0.5 x 0.5 x 2 mm voxels, an example usage is:
+        >>> img = Image(data, np.diag((0.5, 0.5, 2, 1)))
+        >>> res, aff = niftyregpy.reg.aladin(img, flo)
+
+    """
+
+    __slots__ = ("array", "affine", "header")
+
+    def __init__(self, array, affine=None, header=None):
+        self.array = np.asanyarray(array)
+        self.affine = np.eye(4) if affine is None else np.asarray(affine)
+        self.header = header
+
+    @classmethod
+    def from_nifti(cls, img):
+
+        """
+        Wrap the data of a nibabel image without copying it.
+        """
+
+        return cls(np.asanyarray(img.dataobj), img.affine, img.header)
+
+    def to_nifti(self):
+
+        """
+        Return the image as a ``nibabel.Nifti1Image``.
+        """
+
+        return nib.Nifti1Image(self.array, self.affine, self.header)
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or self.array.dtype == dtype:
+            return self.array.copy() if copy else self.array
+        return self.array.astype(dtype)
+
+    def __repr__(self):
+        spacing = ", ".join(f"{x:g}" for x in self.spacing)
+        return f"Image(shape={self.shape}, dtype={self.dtype}, spacing=({spacing}))"
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def spacing(self):
+        return tuple(np.sqrt(np.sum(self.affine[:3, :3] ** 2, axis=0)))
+
+    def with_array(self, array):
+
+        """
+        Return a new Image with the same geometry and ``array`` as data.
+        """
+
+        return Image(array, self.affine, self.header)
+
+
+class Geometry:
+
+    """
+    Voxel grid of an image, without its data.
+
+    NiftyReg only uses the grid of the reference image in ``reg.resample`` and
+    ``average.avg_tran``, so a Geometry can be passed as ``ref`` there.
+
+    Args:
+        shape (tuple): Shape of the image.
+        affine (array): Voxel to world affine (default = identity).
+
+    """
+
+    __slots__ = ("shape", "affine")
+
+    def __init__(self, shape, affine=None):
+        self.shape = tuple(int(x) for x in shape)
+        self.affine = np.eye(4) if affine is None else np.asarray(affine)
+
+    @classmethod
+    def of(cls, x):
+
+        """
+        Return the Geometry of an array, Image, Geometry or nibabel image.
+        """
+
+        if isinstance(x, Geometry):
+            return x
+
+        if isinstance(x, (Image, nib.spatialimages.SpatialImage)):
+            return cls(x.shape, x.affine)
+
+        return cls(np.shape(x))
+
+    def __repr__(self):
+        spacing = ", ".join(f"{x:g}" for x in self.spacing)
+        return f"Geometry(shape={self.shape}, spacing=({spacing}))"
+
+    @property
+    def spacing(self):
+        return tuple(np.sqrt(np.sum(self.affine[:3, :3] ** 2, axis=0)))
+
+
+def is_image(x) -> bool:
+
+    """
+    Return True if ``x`` is an :class:`Image`.
+    """
+
+    return isinstance(x, Image)
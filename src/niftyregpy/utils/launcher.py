@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""Backends that start the NiftyReg processes of :func:`call_niftyreg`.
+
+* ``"popen"`` (default): ``subprocess.Popen``. Python 3.10 and later start
+  the child with ``vfork``, older versions copy the page tables of the parent,
+  which takes longer the more memory the parent holds.
+* ``"spawn"``: ``os.posix_spawn``, which never copies the parent.
+* ``"helper"``: a small helper process, started once, receives the commands
+  over a socket and starts NiftyReg itself, so that starting a call does not
+  depend on the memory of the parent at all. The pipes of every call are
+  passed to the helper, so output is still read directly. Needs Python 3.9.
+
+Pinned calls (see ``set_thread_budget(pin=True)``) inherit their CPUs from the
+launching thread, which is bound to them while it starts the process, or from
+the helper, which does the same.
+
+Given a process that holds large arrays and runs many short calls, an example
+usage is:
+    >>> niftyregpy.utils.set_launcher("helper")
+"""
+
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess as sp
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+BACKENDS = ("popen", "spawn", "helper")
+
+_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_helper.py")
+_MAX_MESSAGE = 1 << 20
+
+_Rusage = namedtuple("_Rusage", ["ru_utime", "ru_stime", "ru_maxrss"])
+
+_backend = "popen"
+
+
+def _returncode(status):
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait_popen(p):
+
+    # Reap the process with its resource usage, where the platform has wait4
+    if p.returncode is None and hasattr(os, "wait4"):
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+        except ChildProcessError:
+            p.wait()
+            return None
+        p.returncode = _returncode(status)
+        return rusage
+
+    p.wait()
+
+    return None
+
+
+class _Process:
+
+    # The parts of subprocess.Popen used by call_niftyreg, for processes that
+    # are not started by subprocess
+    def __init__(self, pid, stdout, stderr):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class _Spawned(_Process):
+    def wait(self):
+        _, status, rusage = os.wait4(self.pid, 0)
+        self.returncode = _returncode(status)
+        return rusage
+
+
+def _pipes():
+
+    # Read and write ends of the stdout and stderr pipes of a child
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+
+    return (out_r, err_r), (out_w, err_w)
+
+
+@contextmanager
+def _bound(cpus):
+
+    # Bind the calling thread to ``cpus`` while it starts a process, which
+    # inherits the binding before it runs any code (e.g. creates its OpenMP
+    # threads). On Linux, the affinity of pid 0 is that of the calling thread
+    if not cpus:
+        yield
+        return
+
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def _spawn(args, env, cpus):
+
+    (out_r, err_r), (out_w, err_w) = _pipes()
+    actions = [(os.POSIX_SPAWN_DUP2, out_w, 1), (os.POSIX_SPAWN_DUP2, err_w, 2)]
+
+    try:
+        with _bound(cpus):
+            pid = os.posix_spawnp(args[0], args, env, file_actions=actions)
+    except BaseException:
+        os.close(out_r)
+        os.close(err_r)
+        raise
+    finally:
+        os.close(out_w)
+        os.close(err_w)
+
+    return _Spawned(pid, os.fdopen(out_r, "rb"), os.fdopen(err_r, "rb"))
+
+
+class _Helper:
+    def __init__(self):
+        self._sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        try:
+            self.pid = os.posix_spawn(
+                sys.executable,
+                [sys.executable, "-s", _HELPER],
+                os.environ,
+                file_actions=[(os.POSIX_SPAWN_DUP2, theirs.fileno(), 0)],
+            )
+        finally:
+            theirs.close()
+
+        self._lock = threading.Lock()
+        self._ids = iter(range(1, sys.maxsize))
+        self._calls = {}
+        self._closed = False
+
+        threading.Thread(
+            target=self._read, name="niftyregpy-helper", daemon=True
+        ).start()
+
+    def _read(self):
+        while True:
+            try:
+                message = self._sock.recv(_MAX_MESSAGE)
+            except OSError:
+                message = b""
+
+            if not message:
+                break
+
+            reply = json.loads(message)
+            with self._lock:
+                replies = self._calls.get(reply["id"])
+            if replies is not None:
+                replies.put(reply)
+
+        # The helper is gone, calls that are still waiting fail
+        with self._lock:
+            self._closed = True
+            calls, self._calls = list(self._calls.values()), {}
+        for replies in calls:
+            replies.put(None)
+
+        try:
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            pass
+
+    def launch(self, args, env, cpus):
+        (out_r, err_r), (out_w, err_w) = _pipes()
+
+        # Replies to a call: its pid (or error), then its exit
+        replies = queue.SimpleQueue()
+
+        try:
+            with self._lock:
+                if self._closed:
+                    raise OSError("NiftyReg helper process exited")
+                request_id = next(self._ids)
+                self._calls[request_id] = replies
+
+                request = {"id": request_id, "args": args, "env": env, "cpus": cpus}
+                socket.send_fds(
+                    self._sock, [json.dumps(request).encode("utf-8")], [out_w, err_w]
+                )
+        except BaseException:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+
+        reply = replies.get()
+
+        if reply is None or "pid" not in reply:
+            with self._lock:
+                self._calls.pop(request_id, None)
+            os.close(out_r)
+            os.close(err_r)
+            if reply is None:
+                raise OSError("NiftyReg helper process exited")
+            raise OSError(reply["errno"], reply["error"], reply["filename"])
+
+        return _Remote(self, request_id, replies, reply["pid"], out_r, err_r)
+
+
+class _Remote(_Process):
+
+    # Process started by the helper, which reports its exit
+    def __init__(self, helper, request_id, replies, pid, out_r, err_r):
+        super().__init__(pid, os.fdopen(out_r, "rb"), os.fdopen(err_r, "rb"))
+        self._helper = helper
+        self._id = request_id
+        self._replies = replies
+
+    def wait(self):
+        reply = self._replies.get()
+
+        with self._helper._lock:
+            self._helper._calls.pop(self._id, None)
+
+        if reply is None:
+            self.returncode = -signal.SIGKILL
+            return None
+
+        self.returncode = reply["returncode"]
+
+        return _Rusage(reply["utime"], reply["stime"], reply["maxrss"])
+
+
+_helper = None
+_helper_lock = threading.Lock()
+
+
+def _get_helper():
+
+    global _helper
+
+    with _helper_lock:
+        if _helper is None or _helper._closed:
+            _helper = _Helper()
+        return _helper
+
+
+def _reset_after_fork():
+    # The helper belongs to the parent
+    global _helper, _helper_lock
+    _helper = None
+    _helper_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def set_launcher(backend="popen"):
+
+    """
+    Select how NiftyReg processes are started, see the module documentation.
+
+    Args:
+        backend (string): One of ``popen``, ``spawn`` or ``helper``
+            (default = popen).
+
+    """
+
+    global _backend
+
+    assert backend in BACKENDS, f"backend must be one of {', '.join(BACKENDS)}"
+
+    if backend != "popen" and not hasattr(os, "posix_spawn"):
+        raise NotImplementedError(f"The {backend} launcher needs os.posix_spawn")
+
+    if backend == "helper" and not hasattr(socket, "send_fds"):
+        raise NotImplementedError("The helper launcher needs Python 3.9")
+
+    _backend = backend
+
+    # Start the helper now, while this process may still be small
+    if backend == "helper":
+        _get_helper()
+
+
+def get_launcher() -> str:
+
+    """
+    Return the backend that starts NiftyReg processes.
+    """
+
+    return _backend
+
+
+def _launch(args, env=None, cpus=None):
+
+    # Start a NiftyReg process with its output on pipes, bound to ``cpus`` if
+    # given. Returns a Popen-like object, to be reaped with _reap
+    backend = _backend
+    env = dict(os.environ) if env is None else env
+
+    if backend == "popen":
+        with _bound(cpus):
+            return sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE, env=env)
+
+    cpus = sorted(cpus) if cpus else None
+
+    if backend == "spawn":
+        return _spawn(args, env, cpus)
+
+    return _get_helper().launch(args, env, cpus)
+
+
+def _reap(p):
+
+    # Wait for a process started by _launch. Returns its resource usage, if
+    # known
+    if isinstance(p, sp.Popen):
+        return _wait_popen(p)
+
+    return p.wait()
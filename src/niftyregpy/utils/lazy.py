@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Outputs that are only read when they are used.
+"""
+
+import os
+import uuid
+import weakref
+
+import numpy as np
+
+from .utils import read_nifti
+from .workspace import _private_dir
+
+
+def _unlink(name):
+    try:
+        os.unlink(name)
+    except OSError:
+        pass
+
+
+class LazyImage:
+
+    """
+    Handle to a NIfTI output that is read on first access.
+
+    Outputs of a call are kept in the workspace until the handle is garbage
+    collected. Use :meth:`load` (or ``np.asarray``) to get the data.
+
+    Args:
+        name (string): File to read.
+        owned (bool): If True, the file is deleted with the handle.
+        **kwargs: Passed on to :func:`read_nifti`.
+
+    """
+
+    __slots__ = ("name", "_kwargs", "_value", "__weakref__")
+
+    def __init__(self, name, owned=False, **kwargs):
+        self.name = name
+        self._kwargs = kwargs
+        self._value = None
+        if owned:
+            weakref.finalize(self, _unlink, name)
+
+    def load(self):
+
+        """
+        Read the output, or return it if it has been read before.
+        """
+
+        if self._value is None:
+            self._value = read_nifti(self.name, **self._kwargs)
+        return self._value
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.asarray(self.load())
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def __repr__(self):
+        state = "loaded" if self._value is not None else "not loaded"
+        return f"LazyImage({self.name!r}, {state})"
+
+
+def lazy_output(folder, name, **kwargs) -> LazyImage:
+
+    """
+    Return a LazyImage for an output of a call in the scratch ``folder``.
+
+    Outputs inside the scratch folder are hard-linked to the workspace first,
+    so that they outlive the call.
+    """
+
+    if os.path.dirname(os.path.abspath(name)) != os.path.abspath(folder):
+        return LazyImage(name, **kwargs)
+
+    keep = _private_dir(folder, "lazy")
+
+    if keep is not None:
+        kept = os.path.join(keep, f"{uuid.uuid4().hex}.nii")
+        try:
+            os.link(name, kept)
+            return LazyImage(kept, owned=True, **kwargs)
+        except OSError:
+            pass
+
+    # Without a place to keep the file, read it now
+    handle = LazyImage(name, **kwargs)
+    handle.load()
+    return handle
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Logging and trace spans.
+
+Diagnostics go to the ``niftyregpy`` logger: files that cannot be written and
+the errors reported by NiftyReg are logged as errors. In verbose mode, NiftyReg
+commands and their output are logged as info to ``niftyregpy.output``, which
+prints them to stdout unless told otherwise (see :func:`set_json_logging`). It
+does not propagate to the root logger, so that applications that configure
+logging do not see every line twice.
+
+Every wrapper call, every NiftyReg process and every block in :func:`span` is a
+span with its own ID. Log records carry the ID of the innermost span as
+``call_id``, and that of the outermost as ``trace_id``, so that the output of
+concurrent calls can be told apart. With :func:`set_trace_file`, spans and the
+stage and load phases of calls (see ``set_telemetry``) are written to a file in
+the Chrome trace event format, to be opened in chrome://tracing or Perfetto.
+Nested spans are drawn on the track of their outermost span.
+
+Given a list of images ``imgs``, an example usage is:
+    >>> niftyregpy.utils.set_json_logging("run.jsonl")
+    >>> niftyregpy.utils.set_trace_file("run.trace.json")
+    >>> niftyregpy.apps.groupwise(imgs)
+    >>> niftyregpy.utils.set_trace_file(None)
+"""
+
+import atexit
+import contextvars
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from .telemetry import add_telemetry_hook, remove_telemetry_hook
+
+logger = logging.getLogger("niftyregpy")
+output_logger = logging.getLogger("niftyregpy.output")
+
+_current = contextvars.ContextVar("niftyregpy_span", default=None)
+_tracks = itertools.count(1)
+
+# Attributes of every log record, anything else was passed as ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None)))
+_RECORD_ATTRIBUTES.update(("message", "asctime", "call_id", "trace_id"))
+
+
+class _Stdout(logging.StreamHandler):
+
+    # Writes to the current sys.stdout, which may be replaced after import
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+_stdout_handler = _Stdout()
+_stdout_handler.setFormatter(logging.Formatter("%(message)s"))
+
+output_logger.setLevel(logging.INFO)
+output_logger.addHandler(_stdout_handler)
+output_logger.propagate = False
+
+
+class _Span:
+
+    __slots__ = ("id", "root", "track", "name", "args")
+
+    def __init__(self, name, parent, args):
+        self.id = uuid.uuid4().hex[:16]
+        self.root = self.id if parent is None else parent.root
+        self.track = next(_tracks) if parent is None else parent.track
+        self.name = name
+        self.args = args
+
+
+class _Correlation(logging.Filter):
+
+    # Stamps records with the spans they were logged in
+    def filter(self, record):
+        current = _current.get()
+        record.call_id = None if current is None else current.id
+        record.trace_id = None if current is None else current.root
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    """
+    Formats log records as JSON objects, one per line, with their time, level,
+    logger, message, correlation IDs and any ``extra`` fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "call_id": getattr(record, "call_id", None),
+            "trace_id": getattr(record, "trace_id", None),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+_json_handler = None
+
+
+def set_json_logging(target=None, level=logging.INFO, echo=False) -> logging.Handler:
+
+    """
+    Log all diagnostics of niftyregpy as JSON lines.
+
+    Args:
+        target (string/stream): File to append to, or stream to write to
+            (default = stderr).
+        level (int): Lowest level to log (default = INFO, i.e. including
+            verbose output). None turns JSON logging off again.
+        echo (bool): Also print verbose output to stdout (default = False).
+
+    Returns:
+        logging.Handler: The handler, or None if JSON logging is off.
+
+    """
+
+    global _json_handler
+
+    if _json_handler is not None:
+        logger.removeHandler(_json_handler)
+        output_logger.removeHandler(_json_handler)
+        _json_handler.close()
+        _json_handler = None
+
+    if echo or level is None:
+        output_logger.addHandler(_stdout_handler)
+    else:
+        output_logger.removeHandler(_stdout_handler)
+
+    if level is None:
+        return None
+
+    if isinstance(target, (str, os.PathLike)):
+        handler = logging.FileHandler(target, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler(target)
+
+    handler.setLevel(level)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(_Correlation())
+
+    # Verbose output does not propagate, so it gets the handler too
+    logger.addHandler(handler)
+    output_logger.addHandler(handler)
+    if logger.level == logging.NOTSET or logger.level > level:
+        logger.setLevel(level)
+
+    _json_handler = handler
+
+    return handler
+
+
+class _TraceFile:
+    def __init__(self, name):
+        self._file = open(name, "w", encoding="utf-8")
+        self._file.write("[")
+        self._first = True
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write("\n" if self._first else ",\n")
+            self._file.write(line)
+            self._first = False
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("\n]\n")
+                self._file.close()
+
+
+_trace = None
+
+
+def _event(name, category, start, duration, track, args):
+
+    return {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": round(start * 1e6),
+        "dur": round(duration * 1e6),
+        "pid": os.getpid(),
+        "tid": track,
+        "args": args,
+    }
+
+
+def _trace_record(record):
+
+    # Phases of a call are drawn inside the span that is open when they end,
+    # and the resources of a NiftyReg process are added to its span
+    trace, current = _trace, _current.get()
+
+    if trace is None:
+        return
+
+    if record.phase == "exec" and current is not None and current.name == record.tool:
+        current.args.update(cpu=record.cpu, rss=record.rss)
+        return
+
+    track = threading.get_ident() if current is None else current.track
+    args = {"name": record.name, "nbytes": record.nbytes}
+    if record.cpu is not None:
+        args.update(cpu=record.cpu, rss=record.rss)
+
+    trace.write(
+        _event(record.phase, record.phase, record.start, record.wall, track, args)
+    )
+
+
+def set_trace_file(name=None):
+
+    """
+    Write spans to a Chrome trace event file (or stop writing if ``name`` is
+    None). The file is complete once tracing is stopped or Python exits.
+    """
+
+    global _trace
+
+    trace, _trace = _trace, None
+
+    if trace is not None:
+        remove_telemetry_hook(_trace_record)
+        trace.close()
+
+    if name is not None:
+        _trace = _TraceFile(name)
+        add_telemetry_hook(_trace_record)
+
+
+@atexit.register
+def _close_trace():
+    if _trace is not None:
+        set_trace_file(None)
+
+
+@contextmanager
+def span(name, **args):
+
+    """
+    Time a block as a span of the trace, and log the records in it with its
+    correlation ID. Keyword arguments are shown with the span, e.g.
+    ``span("subject", index=3)``.
+    """
+
+    current = _Span(name, _current.get(), args)
+    token = _current.set(current)
+    start, clock = time.time(), time.perf_counter()
+
+    try:
+        yield current.id
+    finally:
+        _current.reset(token)
+        trace = _trace
+        if trace is not None:
+            args.update(call_id=current.id, trace_id=current.root)
+            trace.write(
+                _event(
+                    name,
+                    "span",
+                    start,
+                    time.perf_counter() - clock,
+                    current.track,
+                    args,
+                )
+            )
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Metrics of long-running processes, in the Prometheus text format.
+
+Once enabled with :func:`set_metrics`, NiftyReg calls and the staging layer
+update a set of counters and histograms:
+
+* ``niftyregpy_calls_total`` and ``niftyregpy_failures_total``: NiftyReg
+  processes started and failed, per tool.
+* ``niftyregpy_staging_cache_hits_total`` and ``..._misses_total``: inputs
+  linked from the staging cache, and inputs that had to be written.
+* ``niftyregpy_exec_seconds``: run time of NiftyReg processes, per tool.
+* ``niftyregpy_stage_seconds`` and ``niftyregpy_stage_bytes``: time spent and
+  bytes written staging inputs, per wrapper.
+* ``niftyregpy_output_bytes``: size of the outputs read, per wrapper.
+
+The histograms are fed from the telemetry records (see ``set_telemetry``).
+The metrics can be written to a file, e.g. for the textfile collector of the
+node exporter, or served over HTTP. Given a worker that runs registrations for
+days, an example usage is:
+    >>> niftyregpy.utils.set_metrics()
+    >>> server = niftyregpy.utils.serve_metrics(9108)
+"""
+
+import bisect
+import os
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from .telemetry import add_telemetry_hook, remove_telemetry_hook
+
+_PREFIX = "niftyregpy_"
+
+_SECONDS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+_BYTES = tuple(1 << n for n in range(16, 34, 2))
+
+_METRICS = {
+    "calls_total": ("counter", "NiftyReg processes started.", None),
+    "failures_total": ("counter", "NiftyReg processes that failed.", None),
+    "staging_cache_hits_total": (
+        "counter",
+        "Inputs linked from the staging cache.",
+        None,
+    ),
+    "staging_cache_misses_total": (
+        "counter",
+        "Inputs written because they were not in the staging cache.",
+        None,
+    ),
+    "exec_seconds": ("histogram", "Run time of NiftyReg processes.", _SECONDS),
+    "stage_seconds": ("histogram", "Time spent staging inputs.", _SECONDS),
+    "stage_bytes": ("histogram", "Bytes written staging inputs.", _BYTES),
+    "output_bytes": ("histogram", "Size of the outputs read.", _BYTES),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Buckets are upper bounds, including their bound
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class _Registry:
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = _Histogram(_METRICS[name][2])
+            histogram.observe(value)
+
+
+_registry = None
+
+
+def _reset_after_fork():
+    global _registry
+    if _registry is not None:
+        _registry = _Registry()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _inc(name, **labels):
+
+    # Increment a counter, if metrics are enabled
+    registry = _registry
+
+    if registry is not None:
+        registry.inc(name, tuple(sorted(labels.items())))
+
+
+def _from_telemetry(record):
+
+    registry = _registry
+
+    if registry is None:
+        return
+
+    if record.phase == "exec":
+        registry.observe("exec_seconds", (("tool", record.tool),), record.wall)
+        return
+
+    labels = (("call", record.call or ""),)
+
+    if record.phase == "stage":
+        registry.observe("stage_seconds", labels, record.wall)
+        registry.observe("stage_bytes", labels, record.nbytes or 0)
+    elif record.phase == "load" and record.nbytes is not None:
+        registry.observe("output_bytes", labels, record.nbytes)
+
+
+def set_metrics(enabled=True):
+
+    """
+    Enable (or disable) metrics, and reset them.
+    """
+
+    global _registry
+
+    remove_telemetry_hook(_from_telemetry)
+    _registry = None
+
+    if enabled:
+        _registry = _Registry()
+        add_telemetry_hook(_from_telemetry)
+
+
+def _escape(value):
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+
+    labels = labels + tuple(extra.items())
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value):
+
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render_metrics() -> str:
+
+    """
+    Return all metrics in the Prometheus text exposition format.
+    """
+
+    registry = _registry
+    lines = []
+
+    if registry is None:
+        return ""
+
+    with registry._lock:
+        values = sorted(registry.values.items())
+        histograms = {
+            key: (list(h.counts), h.sum)
+            for key, h in values
+            if isinstance(h, _Histogram)
+        }
+
+    for name, (kind, help_text, buckets) in _METRICS.items():
+        samples = [(labels, value) for (n, labels), value in values if n == name]
+        full_name = _PREFIX + name
+
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+
+        for labels, value in samples:
+            if kind == "counter":
+                lines.append(f"{full_name}{_labels(labels)} {value}")
+                continue
+
+            counts, total = histograms[(name, labels)]
+            cumulative = 0
+            for bound, count in zip(buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _labels(labels, le=_number(bound))
+                lines.append(f"{full_name}_bucket{le} {cumulative}")
+            lines.append(f"{full_name}_sum{_labels(labels)} {total!r}")
+            lines.append(f"{full_name}_count{_labels(labels)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(name):
+
+    """
+    Write all metrics to the file ``name``. The file is replaced atomically, so
+    that readers never see a partial file.
+    """
+
+    partial = f"{name}.{uuid.uuid4().hex}.tmp"
+
+    with open(partial, "w", encoding="utf-8") as f:
+        f.write(render_metrics())
+
+    os.replace(partial, name)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    # http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+def serve_metrics(port=0, host="127.0.0.1") -> HTTPServer:
+
+    """
+    Serve all metrics over HTTP on ``/metrics``, from a background thread.
+
+    Args:
+        port (int): Port to listen on (default = any free port, see
+            ``server.server_port``).
+        host (string): Address to listen on (default = localhost only).
+
+    Returns:
+        HTTPServer: The server, stop it with ``server.shutdown()``.
+
+    """
+
+    server = _Server((host, port), _Handler)
+
+    thread = threading.Thread(
+        target=server.serve_forever, name="niftyregpy-metrics", daemon=True
+    )
+    thread.start()
+
+    return server
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Blocking and asyncio execution of NiftyReg wrappers.
+
+The wrappers are written as generators: they stage their inputs, yield a
+:class:`NiftyRegCall` for every NiftyReg command they need, receive the result
+of :func:`call_niftyreg` for it, and finally return their outputs. The
+:func:`niftyreg_command` decorator turns such a generator into the usual
+blocking function, with an ``async_`` attribute that runs the same steps from
+an event loop. There, staging and reading run on the default executor and the
+output of the commands is read by the event loop, limited to a number of
+concurrent calls per event loop (see :func:`set_async_limit`) and by the thread
+budget shared with blocking calls (see :func:`set_thread_budget`). The commands
+are started by the launcher backend (see :func:`set_launcher`) as for blocking
+calls.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import shlex
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .binaries import find_binary
+from .governor import thread_tokens_async
+from .events import EventStream, StopRegistration
+from .launcher import _launch, _reap
+from .logs import output_logger, span
+from .metrics import _inc
+from .telemetry import _calling, _exec_record
+from .utils import _result, call_niftyreg
+
+_DEFAULT_LIMIT = os.cpu_count() or 1
+
+_limit = _DEFAULT_LIMIT
+_semaphores = weakref.WeakKeyDictionary()
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _reaper
+    _reaper = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class NiftyRegCall:
+
+    """
+    NiftyReg command requested by a wrapper.
+
+    Holds the arguments of :func:`call_niftyreg`, i.e. ``NiftyRegCall(cmd_str,
+    verbose)`` runs ``call_niftyreg(cmd_str, verbose)``.
+    """
+
+    __slots__ = ("args", "kwargs")
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"NiftyRegCall({self.args[0]!r})"
+
+
+class _Return:
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _step(gen, result, error):
+
+    # Advance a wrapper to its next call, or to its return value
+    try:
+        return gen.send(result) if error is None else gen.throw(error)
+    except StopIteration as e:
+        return _Return(e.value)
+
+
+def set_async_limit(limit=_DEFAULT_LIMIT):
+
+    """
+    Set how many NiftyReg calls an event loop runs at the same time.
+
+    Args:
+        limit (int): Number of concurrent calls per event loop
+            (default = number of CPUs).
+
+    """
+
+    global _limit
+
+    _limit = max(1, int(limit))
+    _semaphores.clear()
+
+
+def _semaphore():
+
+    loop = asyncio.get_event_loop()
+    semaphore = _semaphores.get(loop)
+
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(_limit)
+
+    return semaphore
+
+
+async def call_niftyreg_async(
+    cmd_str: str, verbose=False, output_stdout=False, on_event=None, limit=None
+):
+
+    """
+    Run a NiftyReg command as an asyncio subprocess, see :func:`call_niftyreg`.
+
+    If the calling task is cancelled, the NiftyReg process is killed.
+
+    Args:
+        cmd_str (string): Command to run.
+        verbose (bool): Print the command and its output (default = False).
+        output_stdout (bool): Return the output instead of True (default = False).
+        on_event (callable): Called with a ``NiftyRegEvent`` for every line of
+            output, as it is written (optional).
+        limit (asyncio.Semaphore): Semaphore to hold while the command runs
+            (default = limit of the event loop, see :func:`set_async_limit`).
+
+    Returns:
+        bool/string: Same as :func:`call_niftyreg`.
+
+    """
+
+    if not cmd_str.startswith("reg_"):
+        return False
+
+    _inc("calls_total", tool=cmd_str.split(maxsplit=1)[0])
+
+    async with _semaphore() if limit is None else limit:
+        async with thread_tokens_async(cmd_str) as (cmd_str, kwargs):
+            tool = cmd_str.split(maxsplit=1)[0]
+
+            with span(tool, cmd=cmd_str):
+                events = EventStream(cmd_str, verbose, on_event, keep=output_stdout)
+
+                if verbose:
+                    output_logger.info(cmd_str)
+
+                args = shlex.split(cmd_str)
+                args[0] = find_binary(tool) or tool
+
+                # The process is started from this thread without awaiting, so
+                # that only it is bound to the CPUs of the call meanwhile
+                start, clock = time.time(), time.perf_counter()
+                p = _launch(args, **kwargs)
+
+                loop = asyncio.get_event_loop()
+                transports, drain = [], None
+
+                try:
+                    try:
+                        stdout = await _reader(loop, p.stdout, transports)
+                        stderr = await _reader(loop, p.stderr, transports)
+                        drain = asyncio.ensure_future(stderr.read())
+                        async for line in stdout:
+                            events.feed(line)
+                    except StopRegistration:
+                        p.terminate()
+                    stderr = await drain
+                except BaseException:
+                    if drain is not None:
+                        drain.cancel()
+                    p.kill()
+                    raise
+                finally:
+                    for transport in transports:
+                        transport.close()
+                    p.stdout.close()
+                    p.stderr.close()
+                    # The process has closed its output or been killed, so it is
+                    # reaped soon
+                    reaped = loop.run_in_executor(_get_reaper(), _reap, p)
+                    rusage = await asyncio.shield(reaped)
+
+                _exec_record(tool, cmd_str, start, time.perf_counter() - clock, rusage)
+
+                return _result(events, stderr, p.returncode, output_stdout)
+
+
+async def _reader(loop, pipe, transports):
+
+    # Stream reader for a pipe of a launched process, its transport is added to
+    # transports to be closed
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    transports.append(transport)
+
+    return reader
+
+
+def _get_reaper():
+
+    # Processes are reaped on threads of their own, blocking in wait4
+    global _reaper
+
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = ThreadPoolExecutor(thread_name_prefix="niftyregpy-reap")
+        return _reaper
+
+
+def run_wrapper(gen):
+
+    """
+    Run a wrapper generator to completion, blocking on every NiftyReg call.
+    """
+
+    result, error = None, None
+
+    try:
+        while True:
+            call = _step(gen, result, error)
+            if isinstance(call, _Return):
+                return call.value
+            try:
+                result, error = call_niftyreg(*call.args, **call.kwargs), None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        gen.close()
+
+
+async def run_wrapper_async(gen, limit=None):
+
+    """
+    Run a wrapper generator to completion from an event loop.
+
+    Args:
+        gen (generator): Wrapper generator.
+        limit (asyncio.Semaphore): Semaphore to hold while NiftyReg runs
+            (default = limit of the event loop).
+
+    Returns:
+        Return value of the wrapper.
+
+    """
+
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    result, error = None, None
+
+    try:
+        while True:
+            step = loop.run_in_executor(None, context.run, _step, gen, result, error)
+            try:
+                call = await asyncio.shield(step)
+            except asyncio.CancelledError:
+                # The generator cannot be closed while a step is running
+                await asyncio.wait([step])
+                raise
+
+            if isinstance(call, _Return):
+                return call.value
+
+            try:
+                result = await call_niftyreg_async(
+                    *call.args, limit=limit, **call.kwargs
+                )
+                error = None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        # Closing runs the cleanup of the wrapper, e.g. of its scratch folder
+        if gen.gi_frame is not None:
+            await loop.run_in_executor(None, context.run, gen.close)
+
+
+def niftyreg_command(fn):
+
+    """
+    Turn a wrapper generator function into a blocking function.
+
+    The returned function has an ``async_`` attribute with the same arguments
+    plus ``limit``, see :func:`run_wrapper_async`.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _calling(fn.__name__), span(fn.__name__):
+            return run_wrapper(fn(*args, **kwargs))
+
+    @functools.wraps(fn)
+    async def wrapper_async(*args, limit=None, **kwargs):
+        with _calling(fn.__name__), span(fn.__name__):
+            return await run_wrapper_async(fn(*args, **kwargs), limit)
+
+    wrapper_async.__name__ = f"{fn.__name__}_async"
+    wrapper_async.__qualname__ = f"{fn.__qualname__}_async"
+    wrapper.async_ = wrapper_async
+
+    return wrapper
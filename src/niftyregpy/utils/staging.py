@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""Staging of arrays as NIfTI files for NiftyReg.
+
+Before staging, arrays are cast according to the staging policy: intensity
+images and transforms are written as float32 (NiftyReg converts to float32
+internally anyway), masks as uint8 and label maps as int16.
+
+Arrays are identified by a hash of their bytes, dtype, shape and affine. Files
+that have already been written are kept in a bounded LRU cache inside the
+workspace, and are hard-linked into the scratch folder of later calls instead
+of being serialized again.
+"""
+
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import nibabel as nib
+import numpy as np
+
+from .compress import _wait_output, gunzip_file
+from .image import Geometry, Image
+from .metrics import _inc
+from .telemetry import _add_bytes, _measured
+from .utils import write_nifti, write_nifti_empty, write_nifti_raw, write_txt
+from . import workspace
+from .workspace import _cache_dir
+
+_DEFAULT_MAX_ENTRIES = 32
+_DEFAULT_MAX_BYTES = 1 << 30
+_NIFTI_EXTENSIONS = (".nii", ".nii.gz", ".hdr", ".img", ".img.gz")
+
+logger = logging.getLogger(__name__)
+
+_policy = {
+    "image": np.float32,
+    "mask": np.uint8,
+    "label": np.int16,
+    "transform": np.float32,
+}
+_policy_override = contextvars.ContextVar("staging_policy", default={})
+
+
+class _StagingCache:
+    def __init__(self, max_entries=_DEFAULT_MAX_ENTRIES, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _limit(self):
+        if self.max_bytes is not None:
+            return self.max_bytes
+        # Keep at most a quarter of a budgeted workspace for cached inputs
+        budget = workspace._workspace.max_bytes
+        return budget // 4 if budget is not None else _DEFAULT_MAX_BYTES
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                _inc("staging_cache_misses_total")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            _inc("staging_cache_hits_total")
+            return entry[0]
+
+    def forget(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._nbytes -= entry[1]
+
+    def insert(self, key, name, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = (name, nbytes)
+                self._nbytes += nbytes
+            self._evict(self.max_entries, self._limit())
+
+    def clear(self):
+        with self._lock:
+            self._evict(0, 0)
+
+    def _evict(self, max_entries, max_bytes):
+        while self._entries and (
+            len(self._entries) > max_entries or self._nbytes > max_bytes
+        ):
+            _, (name, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            # Hard links in scratch folders keep the data alive for running calls
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+
+_cache = _StagingCache()
+
+
+def _reset_after_fork():
+    global _cache
+    _cache = _StagingCache(_cache.max_entries, _cache.max_bytes)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _check_kinds(kinds):
+    unknown = set(kinds) - set(_policy)
+    if unknown:
+        raise ValueError(f"Unknown staging kind(s): {', '.join(sorted(unknown))}")
+
+
+def _fits(array, dtype):
+    if array.size == 0:
+        return True
+    info = np.iinfo(dtype)
+    return info.min <= array.min() and array.max() <= info.max
+
+
+def _cast(array, kind):
+
+    array = np.asanyarray(array)
+    policy = {**_policy, **_policy_override.get()}
+
+    if kind == "image" and not np.issubdtype(array.dtype, np.inexact):
+        kind = "label"
+
+    dtype = policy[kind]
+
+    if dtype is None:
+        return array
+
+    dtype = np.dtype(dtype)
+
+    if array.dtype == dtype:
+        return array
+
+    if array.dtype == bool and dtype.itemsize == 1 and dtype.kind in "ui":
+        return array.view(dtype)
+
+    if kind == "mask" and dtype.kind in "ui":
+        return (array != 0).view(np.uint8).astype(dtype, copy=False)
+
+    if kind == "label" and dtype.kind in "ui" and array.dtype.kind in "iu":
+        # Labels that do not fit are widened rather than wrapped around
+        for candidate in (dtype, np.dtype(np.int32)):
+            if _fits(array, candidate):
+                return array.astype(candidate)
+        return array.astype(np.float64)
+
+    return array.astype(dtype)
+
+
+def _write(name, array, affine, header):
+    # Plain arrays skip nibabel, images with a header need it to be preserved
+    if header is None:
+        return write_nifti_raw(name, array, affine)
+    return write_nifti(name, array, affine, header)
+
+
+def _digest(array, affine, header=None):
+
+    array = np.asanyarray(array)
+    order = "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+    data = array.T if order == "F" else np.ascontiguousarray(array)
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{array.dtype.str}|{array.shape}|{order}|".encode())
+    h.update(np.ascontiguousarray(affine, dtype=np.float64).tobytes())
+    if header is not None:
+        h.update(header.binaryblock)
+    h.update(memoryview(data).cast("B"))
+
+    return h.hexdigest()
+
+
+def _link(src, dst):
+
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    os.link(src, dst)
+
+
+def _nbytes(name):
+
+    # Sparse files only count with the blocks they actually use
+    st = os.stat(name)
+    return min(st.st_size, getattr(st, "st_blocks", st.st_size) * 512)
+
+
+def _written(name):
+
+    _add_bytes(_nbytes(name))
+    return name
+
+
+def _is_path(x):
+    return isinstance(x, (str, os.PathLike))
+
+
+def _file_backed(img):
+    # Images loaded from disk and not modified since can be used in place
+    name = img.get_filename()
+    return name is not None and nib.is_proxy(img.dataobj) and os.path.exists(name)
+
+
+def is_affine(x) -> bool:
+
+    """
+    Return True if ``x`` is a 4x4 affine matrix or the path of a text file.
+    """
+
+    if _is_path(x):
+        return not os.fspath(x).lower().endswith(_NIFTI_EXTENSIONS)
+
+    return not isinstance(x, Image) and np.shape(x) == (4, 4)
+
+
+def set_staging_policy(**kinds):
+
+    """
+    Set the data type that arrays of each kind are cast to before staging.
+
+    Kinds are ``image`` (intensity images), ``mask``, ``label`` (integer images)
+    and ``transform``. A data type of None keeps the dtype of the input.
+
+        >>> set_staging_policy(image=None)  # stage images with their own dtype
+
+    """
+
+    _check_kinds(kinds)
+    _policy.update(kinds)
+
+
+def get_staging_policy() -> dict:
+
+    """
+    Return the staging policy in effect.
+    """
+
+    return {**_policy, **_policy_override.get()}
+
+
+@contextmanager
+def staging_policy(**kinds):
+
+    """
+    Context manager that overrides the staging policy for the calls made within.
+
+        >>> with staging_policy(label=np.uint8):
+        ...     res = reg.resample(ref, labels, trans, inter=0)
+
+    """
+
+    _check_kinds(kinds)
+    token = _policy_override.set({**_policy_override.get(), **kinds})
+
+    try:
+        yield
+    finally:
+        _policy_override.reset(token)
+
+
+def set_staging_cache(max_entries=_DEFAULT_MAX_ENTRIES, max_bytes=None):
+
+    """
+    Configure the cache of staged NIfTI files.
+
+    Args:
+        max_entries (int): Maximum number of cached files, 0 disables the
+            cache (default = 32).
+        max_bytes (int): Maximum total size of cached files (default = a quarter
+            of the workspace budget, or 1 GiB if the workspace has no budget).
+
+    """
+
+    global _cache
+
+    old = _cache
+    _cache = _StagingCache(max_entries, max_bytes)
+    old.clear()
+
+
+def get_staging_cache() -> dict:
+
+    """
+    Return statistics of the cache of staged NIfTI files.
+    """
+
+    return {
+        "entries": len(_cache._entries),
+        "nbytes": _cache._nbytes,
+        "hits": _cache.hits,
+        "misses": _cache.misses,
+    }
+
+
+@_measured("stage")
+def stage_nifti(name, array, _affine=None, kind="image") -> str:
+
+    """
+    Write ``array`` to ``name`` as NIfTI, reusing a cached copy if an identical
+    array has been staged before.
+
+    Images are written with their affine and header. Paths, and nibabel images
+    that are backed by an unmodified file, are not written at all and their
+    file name is returned instead. Compressed ``.nii.gz`` files are staged
+    decompressed.
+
+    Args:
+        name (string): Destination inside a scratch folder. ``.nii`` is
+            appended if the name has no extension.
+        array (array/string/image): Array, path, Image or nibabel image to
+            stage.
+        _affine (array): Affine of the image (default = identity, or the affine
+            of a nibabel image).
+        kind (string): One of ``image``, ``mask``, ``label`` or ``transform``,
+            selects the data type from the staging policy (default = image).
+
+    Returns:
+        string: Path of the staged file, or None if writing failed.
+
+    """
+
+    if _is_path(array):
+        array = os.fspath(_wait_output(array))
+        if array.endswith(".nii.gz") and os.path.exists(array):
+            return _stage_compressed(name, array)
+        return array
+
+    header = None
+
+    if isinstance(array, nib.spatialimages.SpatialImage):
+        if _file_backed(array):
+            return stage_nifti(name, array.get_filename())
+        array, _affine = np.asanyarray(array.dataobj), array.affine
+
+    if isinstance(array, Image):
+        array, _affine, header = array.array, array.affine, array.header
+
+    if not name.endswith(_NIFTI_EXTENSIONS):
+        name += ".nii"
+
+    array = _cast(array, kind)
+    affine = np.eye(4) if _affine is None else _affine
+    cache, cache_dir = _cache, _cache_dir(os.path.dirname(name))
+
+    if cache.max_entries <= 0 or cache_dir is None:
+        return _written(name) if _write(name, array, affine, header) else None
+
+    key = (cache_dir, _digest(array, affine, header))
+
+    return _stage_cached(
+        cache, key, name, lambda partial: _write(partial, array, affine, header)
+    )
+
+
+def _stage_compressed(name, src):
+
+    # Compressed files are decompressed once, keyed by their path and mtime
+    cache, cache_dir = _cache, _cache_dir(os.path.dirname(name))
+
+    if cache.max_entries <= 0 or cache_dir is None:
+        return src
+
+    name = name[:-3] if name.endswith(".gz") else name
+    if not name.endswith(".nii"):
+        name += ".nii"
+
+    st = os.stat(src)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{os.path.realpath(src)}|{st.st_mtime_ns}|{st.st_size}".encode())
+    key = (cache_dir, h.hexdigest())
+
+    def write(partial):
+        try:
+            gunzip_file(src, partial)
+            return True
+        except Exception as e:
+            logger.error("Could not decompress %s: %s", src, e)
+            return False
+
+    return _stage_cached(cache, key, name, write) or src
+
+
+def _stage_cached(cache, key, name, write):
+
+    cached = cache.lookup(key)
+
+    if cached is not None:
+        try:
+            _link(cached, name)
+            return name
+        except OSError:
+            cache.forget(key)
+
+    cached = os.path.join(key[0], f"{key[1]}.nii")
+    partial = os.path.join(key[0], f".{uuid.uuid4().hex}.nii")
+
+    if not write(partial):
+        if os.path.exists(partial):
+            os.unlink(partial)
+        return None
+
+    os.replace(partial, cached)
+    nbytes = _nbytes(cached)
+    _add_bytes(nbytes)
+
+    try:
+        _link(cached, name)
+    except OSError:
+        os.replace(cached, name)
+        return name
+
+    cache.insert(key, cached, nbytes)
+
+    return name
+
+
+@_measured("stage")
+def stage_geometry(name, ref) -> str:
+
+    """
+    Stage only the voxel grid of ``ref``, as an all-zero uint8 image.
+
+    This is enough for references of which NiftyReg only uses the grid. The
+    file is sparse and cached by shape and affine, so staging the same grid
+    again costs nothing. Paths and file-backed nibabel images are staged as
+    with :func:`stage_nifti`.
+
+    Args:
+        name (string): Destination inside a scratch folder.
+        ref (array/string/image): Array, path, Image, Geometry or nibabel image.
+
+    Returns:
+        string: Path of the staged file, or None if writing failed.
+
+    """
+
+    if _is_path(ref) or (
+        isinstance(ref, nib.spatialimages.SpatialImage) and _file_backed(ref)
+    ):
+        return stage_nifti(name, ref)
+
+    geometry = Geometry.of(ref)
+
+    if not name.endswith(".nii"):
+        name += ".nii"
+
+    def write(partial):
+        return write_nifti_empty(partial, geometry.shape, geometry.affine)
+
+    cache, cache_dir = _cache, _cache_dir(os.path.dirname(name))
+
+    if cache.max_entries <= 0 or cache_dir is None:
+        return _written(name) if write(name) else None
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"geometry|{geometry.shape}|".encode())
+    h.update(np.ascontiguousarray(geometry.affine, dtype=np.float64).tobytes())
+
+    return _stage_cached(cache, (cache_dir, h.hexdigest()), name, write)
+
+
+@_measured("stage")
+def stage_txt(name, array) -> str:
+
+    """
+    Write an affine matrix to ``name`` as text. Paths are returned as is.
+
+    Returns:
+        string: Path of the staged file, or None if writing failed.
+
+    """
+
+    if _is_path(array):
+        return os.fspath(array)
+
+    return _written(name) if write_txt(name, array) else None
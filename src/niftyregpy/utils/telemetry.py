@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""Resource telemetry of NiftyReg calls.
+
+The work of a wrapper is recorded in three phases: staging its inputs
+(``"stage"``), running NiftyReg (``"exec"``) and reading its outputs
+(``"load"``). Every record holds the wall time of the phase. Exec records also
+hold the CPU time and peak resident memory of the NiftyReg process, where the
+platform reports them (``os.wait4``), and stage and load records the number of
+bytes written or read.
+
+Records are passed to the hooks added with :func:`add_telemetry_hook`, and
+summed per wrapper and phase in an in-process registry, see
+:func:`telemetry_summary`. Given a few registrations, an example usage is:
+    >>> niftyregpy.reg.f3d(ref, flo)
+    >>> niftyregpy.utils.telemetry_summary()["f3d"]["exec"]
+    {'count': 1, 'wall': 12.3, 'wall_max': 12.3, 'cpu': 45.6, 'rss': ..., ...}
+"""
+
+import collections
+import contextvars
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+_DEFAULT_MAX_RECORDS = 1000
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+logger = logging.getLogger(__name__)
+
+TelemetryRecord = namedtuple(
+    "TelemetryRecord",
+    ["phase", "call", "tool", "name", "start", "wall", "cpu", "rss", "nbytes"],
+)
+TelemetryRecord.__doc__ = """\
+Resources used by one phase of a call. ``phase`` is ``"stage"``, ``"exec"`` or
+``"load"``, ``call`` the wrapper that ran it (e.g. ``"f3d"``, or the NiftyReg
+tool for direct calls), ``tool`` the NiftyReg executable and ``name`` the
+command or file. ``start`` is the wall clock time at which the phase started
+and ``wall`` its duration in seconds. ``cpu`` (seconds) and ``rss`` (bytes,
+peak) are those of the NiftyReg process, and ``nbytes`` the bytes written or
+read. Values that are not known are None."""
+
+_call = contextvars.ContextVar("niftyregpy_call", default=None)
+_local = threading.local()
+
+
+class _Registry:
+    def __init__(self, enabled=True, max_records=_DEFAULT_MAX_RECORDS):
+        self.enabled = enabled
+        self.records = collections.deque(maxlen=max_records)
+        self.totals = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+            key = (record.call, record.phase)
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = dict.fromkeys(
+                    ("count", "wall", "wall_max", "cpu", "rss", "nbytes"), 0
+                )
+
+            totals["count"] += 1
+            totals["wall"] += record.wall
+            totals["wall_max"] = max(totals["wall_max"], record.wall)
+            totals["cpu"] += record.cpu or 0
+            totals["rss"] = max(totals["rss"], record.rss or 0)
+            totals["nbytes"] += record.nbytes or 0
+
+            hooks = list(self.hooks)
+
+        for hook in hooks:
+            try:
+                hook(record)
+            except Exception:
+                logger.exception("Telemetry hook failed")
+
+
+_registry = _Registry()
+
+
+def _reset_after_fork():
+    global _registry
+    hooks = _registry.hooks
+    _registry = _Registry(_registry.enabled, _registry.records.maxlen)
+    _registry.hooks = hooks
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def set_telemetry(enabled=True, max_records=_DEFAULT_MAX_RECORDS):
+
+    """
+    Enable (or disable) telemetry, and clear the registry.
+
+    Args:
+        enabled (bool): Record the phases of NiftyReg calls (default = True).
+        max_records (int): Number of recent records to keep, see
+            :func:`get_telemetry` (default = 1000).
+
+    """
+
+    global _registry
+
+    hooks = _registry.hooks
+    _registry = _Registry(bool(enabled), max(0, int(max_records)))
+    _registry.hooks = hooks
+
+
+def add_telemetry_hook(hook):
+
+    """
+    Call ``hook`` with every new :class:`TelemetryRecord`, e.g. to log it.
+    """
+
+    with _registry._lock:
+        _registry.hooks.append(hook)
+
+
+def remove_telemetry_hook(hook):
+
+    """
+    Stop calling a hook added with :func:`add_telemetry_hook`.
+    """
+
+    with _registry._lock:
+        if hook in _registry.hooks:
+            _registry.hooks.remove(hook)
+
+
+def get_telemetry() -> list:
+
+    """
+    Return the most recent records, oldest first.
+    """
+
+    with _registry._lock:
+        return list(_registry.records)
+
+
+def telemetry_summary() -> dict:
+
+    """
+    Return the totals of all records per wrapper and phase.
+
+    Returns:
+        dict: ``{call: {phase: totals}}``, where the totals are the number of
+        records, the total and maximum wall time, the total CPU time, the peak
+        resident memory of any NiftyReg process and the total bytes.
+
+    """
+
+    summary = {}
+
+    with _registry._lock:
+        for (call, phase), totals in _registry.totals.items():
+            summary.setdefault(call, {})[phase] = dict(totals)
+
+    return summary
+
+
+def _record(
+    phase, name=None, tool=None, start=None, wall=0.0, cpu=None, rss=None, nbytes=None
+):
+
+    # Add a record to the registry and pass it to the hooks
+    registry = _registry
+
+    if not registry.enabled:
+        return
+
+    call = _call.get() or tool
+    start = time.time() - wall if start is None else start
+
+    registry.add(
+        TelemetryRecord(phase, call, tool, name, start, wall, cpu, rss, nbytes)
+    )
+
+
+def _exec_record(tool, name, start, wall, rusage):
+
+    # Exec record of a process, with its resource usage if it was reaped with
+    # os.wait4
+    if rusage is None:
+        return _record("exec", name, tool, start, wall)
+
+    return _record(
+        "exec",
+        name,
+        tool,
+        start,
+        wall,
+        cpu=rusage.ru_utime + rusage.ru_stime,
+        rss=rusage.ru_maxrss * _RSS_UNIT,
+    )
+
+
+class _Span:
+
+    __slots__ = ("nbytes",)
+
+    def __init__(self):
+        self.nbytes = 0
+
+
+def _add_bytes(nbytes):
+
+    # Count bytes written or read by the phase measured in this thread
+    span = getattr(_local, "span", None)
+
+    if span is not None:
+        span.nbytes += nbytes
+
+
+def _measured(phase):
+
+    # Record every call of the decorated function as ``phase``, named after its
+    # first argument. Calls made while a phase is already measured in the same
+    # thread count towards that phase.
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _registry.enabled or getattr(_local, "span", None) is not None:
+                return fn(*args, **kwargs)
+
+            name = args[0] if args else kwargs.get("name")
+            name = os.fspath(name) if isinstance(name, (str, os.PathLike)) else None
+            span = _local.span = _Span()
+            start, clock = time.time(), time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.span = None
+                _record(
+                    phase,
+                    name,
+                    start=start,
+                    wall=time.perf_counter() - clock,
+                    nbytes=span.nbytes,
+                )
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def _calling(name):
+
+    # Attribute the records made in this context to the wrapper ``name``
+    token = _call.set(name)
+    try:
+        yield
+    finally:
+        _call.reset(token)
@@ -2,42 +2,332 @@
 """Utility functions.
 """
 
+import logging
+import os
 import random
 import shlex
 import signal
-import subprocess as sp
+import threading
+import time
 
 import nibabel as nib
 import numpy as np
 
+from .binaries import _probe, find_binary, has_option
+from .compress import _wait_output
+from .events import EventStream, StopRegistration
+from .governor import thread_tokens
+from .image import Image
+from .launcher import _launch, _reap
+from .logs import output_logger, span
+from .metrics import _inc
+from .telemetry import _add_bytes, _exec_record, _measured
 
-def read_nifti(name: str, output_nan=False) -> np.array:
+logger = logging.getLogger(__name__)
+
+
+def _is_index(x):
+    return isinstance(x, (int, np.integer)) and not isinstance(x, bool)
+
+
+def check_roi(roi, step=None) -> tuple:
+
+    """
+    Check a region of interest and a stride for :func:`read_nifti`, e.g. before
+    a NiftyReg call whose result is read with them.
+
+    Returns:
+        tuple: ``roi`` as a tuple of slices and indices.
+
+    """
+
+    roi = () if roi is None else roi if isinstance(roi, tuple) else (roi,)
+
+    assert all(
+        _is_index(r) or isinstance(r, slice) for r in roi
+    ), "roi must contain only slices and integers"
+
+    if step is not None:
+        steps = (step,) if np.isscalar(step) else tuple(step)
+        assert all(
+            _is_index(s) and s > 0 for s in steps
+        ), "step must contain only positive integers"
+
+    return roi
+
+
+def _index_slice(i, n):
+
+    # Axis of length 1 at index i, which may count from the end like in numpy
+    if not -n <= i < n:
+        raise IndexError(f"index {i} is out of bounds for axis with size {n}")
+
+    i = i + n if i < 0 else i
+
+    return slice(i, i + 1)
+
+
+def _roi_index(shape, roi, step, keep_dims=False):
+
+    # Combine a region of interest and a stride into one index. With
+    # ``keep_dims``, indices select an axis of length 1 instead of dropping it
+    ndim = len(shape)
+    roi = check_roi(roi, step)
+    roi = roi + (slice(None),) * (ndim - len(roi))
+
+    if keep_dims:
+        roi = tuple(
+            _index_slice(r, n) if _is_index(r) else r for r, n in zip(roi, shape)
+        )
+
+    if step is None:
+        return roi
+
+    step = (step,) * ndim if np.isscalar(step) else tuple(step)
+    step = step + (1,) * (ndim - len(step))
+
+    return tuple(
+        slice(r.start, r.stop, (r.step or 1) * s) if isinstance(r, slice) else r
+        for r, s in zip(roi, step)
+    )
+
+
+@_measured("load")
+def read_nifti(
+    name: str,
+    output_nan=False,
+    mmap=False,
+    dtype=None,
+    as_image=False,
+    roi=None,
+    step=None,
+    out=None,
+) -> np.array:
+
+    """
+    Read a NIfTI file into an array.
+
+    Args:
+        name (string): File to read. A ``.nii.gz`` output that is still being
+            compressed is read once it has been written.
+        output_nan (bool): If True, keep NaN values (default = False).
+        mmap (bool): Return a copy-on-write memory map of the file where
+            possible, only valid while the file exists (default = False).
+        dtype (dtype): Data type of the returned array. Scaled data is scaled
+            directly in this type (default = type stored in the file).
+        as_image (bool): Return an Image that keeps the affine and header of
+            the file (default = False).
+        roi (tuple): Slices (or indices) of the leading axes to read, e.g.
+            ``(slice(None), slice(None), 40)`` for one slice. Only the selected
+            part of the file is read. Images keep the axes of indices, with
+            length 1 (optional).
+        step (int/tuple): Read every ``step``-th voxel along each axis, e.g. for
+            a preview (optional).
+        out (array): Array to decode the data into, e.g. one frame of a
+            preallocated 4D array. Must have the shape of the (selected) data,
+            and is returned instead of a new array (optional).
+
+    Returns:
+        array: Image data, or None if the file could not be read.
+
+    """
+
+    check_roi(roi, step)
+
+    name = _wait_output(name)
 
     try:
-        array = np.ascontiguousarray(nib.load(name).dataobj)
-        return array if output_nan else np.nan_to_num(array, nan=0.0)
+        # Data is copied straight from a memory map of the file into ``out``
+        img = nib.load(name, mmap="c" if mmap or out is not None else False)
+        data = img.dataobj
+
+        if roi is not None or step is not None:
+            index = _roi_index(img.shape, roi, step, keep_dims=as_image)
+            if as_image:
+                # The slicer also adjusts the affine, but cannot drop spatial axes
+                img = img.slicer[index]
+                data = img.dataobj
+            else:
+                data = data[index]
+
+        if out is not None:
+            assert dtype is None or out.dtype == dtype, "dtype must match out"
+            np.copyto(out, np.asanyarray(data, dtype=out.dtype))
+            array = out
+        elif mmap:
+            array = np.asanyarray(data, dtype=dtype)
+        else:
+            array = np.ascontiguousarray(data, dtype=dtype)
+
     except OSError:
         return None
 
+    # Memory maps are only read when they are used
+    if out is not None or not mmap:
+        _add_bytes(array.nbytes)
 
-def write_nifti(name, array, _affine=np.eye(4)) -> bool:
+    # Replacement happens in place, copy-on-write pages are only copied when
+    # they actually contain NaN values
+    if not output_nan:
+        array = np.nan_to_num(array, copy=False, nan=0.0)
+
+    return Image(array, img.affine, img.header) if as_image else array
+
+
+def write_nifti(name, array, _affine=np.eye(4), header=None) -> bool:
 
     try:
-        img = nib.Nifti1Image(array, affine=_affine)
+        img = nib.Nifti1Image(array, affine=_affine, header=header)
+        if header is not None:
+            # The header of the source file must not change the staged dtype
+            img.set_data_dtype(array.dtype)
         nib.save(img, name)
         return True
     except Exception as e:
-        print(e)
+        logger.error("Could not write %s: %s", name, e)
         return False
 
 
+_NIFTI_DATATYPES = {
+    np.dtype(np.uint8): 2,
+    np.dtype(np.int16): 4,
+    np.dtype(np.int32): 8,
+    np.dtype(np.float32): 16,
+    np.dtype(np.complex64): 32,
+    np.dtype(np.float64): 64,
+    np.dtype(np.int8): 256,
+    np.dtype(np.uint16): 512,
+    np.dtype(np.uint32): 768,
+    np.dtype(np.int64): 1024,
+    np.dtype(np.uint64): 1280,
+}
+
+
+def _write_fortran(f, array):
+
+    # NIfTI stores the first axis fastest, i.e. in Fortran order. C-ordered
+    # arrays are transposed in slabs of about 16 MiB instead of copying them whole.
+    if array.ndim < 2 or array.flags.f_contiguous:
+        f.write(memoryview(np.asfortranarray(array).T).cast("B"))
+        return
+
+    step = max(1, (16 << 20) // max(1, array[..., 0].nbytes))
+
+    for k in range(0, array.shape[-1], step):
+        slab = np.ascontiguousarray(array[..., k : k + step].T)
+        f.write(memoryview(slab).cast("B"))
+
+
+def _nifti_header(shape, dtype, affine):
+
+    # Minimal single-file NIfTI-1 header, followed by an empty extension block
+    hdr = np.zeros((), dtype=nib.nifti1.header_dtype)
+    hdr["sizeof_hdr"] = 348
+    hdr["dim"][: len(shape) + 1] = (len(shape), *shape)
+    hdr["dim"][len(shape) + 1 :] = 1
+    hdr["datatype"] = _NIFTI_DATATYPES[dtype]
+    hdr["bitpix"] = dtype.itemsize * 8
+    hdr["pixdim"][:] = 1.0
+    hdr["pixdim"][1:4] = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    hdr["vox_offset"] = 352
+    hdr["scl_slope"] = 1.0
+    hdr["xyzt_units"] = 10  # mm and s
+    hdr["sform_code"] = 2  # aligned anatomy
+    hdr["srow_x"], hdr["srow_y"], hdr["srow_z"] = affine[:3]
+    hdr["magic"] = b"n+1"
+
+    return hdr.tobytes() + bytes(4)
+
+
+def write_nifti_raw(name, array, _affine=None) -> bool:
+
+    """
+    Write an array as a single-file NIfTI-1 image without going through nibabel.
+
+    Only a minimal header is written (dimensions, data type, voxel sizes and the
+    affine as sform), followed directly by the array buffer. This is meant for
+    staging inputs for NiftyReg; use :func:`write_nifti` for anything else.
+    Compressed files and data types NIfTI cannot store are passed on to
+    :func:`write_nifti`.
+
+    Args:
+        name (string): Destination file.
+        array (array): Image data, with at most 7 dimensions.
+        _affine (array): Voxel to world affine (default = identity).
+
+    Returns:
+        bool: True if the file was written.
+
+    """
+
+    try:
+        array = np.asanyarray(array)
+        affine = np.eye(4) if _affine is None else np.asarray(_affine)
+
+        if array.dtype == bool:
+            array = array.view(np.uint8)
+        if not array.dtype.isnative:
+            array = array.astype(array.dtype.newbyteorder("="))
+
+        if not name.endswith(".nii") or array.dtype not in _NIFTI_DATATYPES:
+            return write_nifti(name, array, affine)
+
+        with open(name, "wb") as f:
+            f.write(_nifti_header(array.shape, array.dtype, affine))
+            _write_fortran(f, array)
+
+        return True
+    except Exception as e:
+        logger.error("Could not write %s: %s", name, e)
+        return False
+
+
+def write_nifti_empty(name, shape, _affine=None, dtype=np.uint8) -> bool:
+
+    """
+    Write an all-zero NIfTI-1 image of the given shape.
+
+    Only the header is written, the data is left as a hole in the file, so this
+    is cheap regardless of the size of the image. This is meant for staging
+    reference images of which NiftyReg only uses the voxel grid.
+
+    Args:
+        name (string): Destination, an uncompressed ``.nii`` file.
+        shape (tuple): Shape of the image, with at most 7 dimensions.
+        _affine (array): Voxel to world affine (default = identity).
+        dtype (dtype): Data type of the image (default = uint8).
+
+    Returns:
+        bool: True if the file was written.
+
+    """
+
+    try:
+        dtype = np.dtype(dtype)
+        affine = np.eye(4) if _affine is None else np.asarray(_affine)
+
+        with open(name, "wb") as f:
+            f.write(_nifti_header(tuple(shape), dtype, affine))
+            f.truncate(352 + int(np.prod(shape)) * dtype.itemsize)
+
+        return True
+    except Exception as e:
+        logger.error("Could not write %s: %s", name, e)
+        return False
+
+
+@_measured("load")
 def read_txt(name: str):
 
     try:
-        return np.loadtxt(name)
+        array = np.loadtxt(name)
     except OSError:
         return None
 
+    _add_bytes(os.path.getsize(name))
+
+    return array
+
 
 def write_txt(name: str, array) -> bool:
 
@@ -45,61 +335,92 @@ def write_txt(name: str, array) -> bool:
         np.savetxt(name, array)
         return True
     except Exception as e:
-        print(e)
+        logger.error("Could not write %s: %s", name, e)
         return False
 
 
-def call_niftyreg(cmd_str: str, verbose=False, output_stdout=False) -> bool:
+def call_niftyreg(
+    cmd_str: str, verbose=False, output_stdout=False, on_event=None
+) -> bool:
 
     if not cmd_str.startswith("reg_"):
         return False
 
-    p = sp.Popen(shlex.split(cmd_str), stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = p.communicate()
+    tool = cmd_str.split(maxsplit=1)[0]
+    _inc("calls_total", tool=tool)
+
+    with thread_tokens(cmd_str) as (cmd_str, kwargs), span(tool, cmd=cmd_str):
+        events = EventStream(cmd_str, verbose, on_event, keep=output_stdout)
+
+        if verbose:
+            output_logger.info(cmd_str)
+
+        args = shlex.split(cmd_str)
+        args[0] = find_binary(tool) or tool
+
+        start, clock = time.time(), time.perf_counter()
+        p = _launch(args, **kwargs)
+
+        # Read stdout as it is written, stderr is drained on the side so that
+        # neither pipe fills up
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(p.stderr.read()))
+        drain.start()
+
+        try:
+            with p.stdout:
+                for line in p.stdout:
+                    events.feed(line)
+        except StopRegistration:
+            p.terminate()
+        except BaseException:
+            # e.g. an exception raised by on_event
+            p.kill()
+            raise
+        finally:
+            drain.join()
+            p.stderr.close()
+            rusage = _reap(p)
+
+        _exec_record(tool, cmd_str, start, time.perf_counter() - clock, rusage)
+
+        return _result(events, stderr[0], p.returncode, output_stdout)
+
 
-    if verbose:
-        print(cmd_str)
-        for line in stdout.decode(encoding="utf-8").split("\n"):
-            print(line)
+def _result(events, stderr, returncode, output_stdout):
 
+    # Report the errors of a finished NiftyReg call and turn it into a result
     if stderr:
         for line in stderr.decode(encoding="utf-8").split("\n"):
-            print(line)
+            if line:
+                logger.error("%s", line, extra={"tool": events.tool})
+            events.feed(line, kind="error")
 
-    if stderr or p.returncode == -signal.SIGSEGV:
+    # Runs stopped by the caller, e.g. with StopRegistration, are not failures
+    if stderr or returncode == -signal.SIGSEGV:
+        _inc("failures_total", tool=events.tool)
         return False
 
-    return stdout.decode(encoding="utf-8") if output_stdout else True
-
+    if events.stopped:
+        return False
 
-def get_help_string(tool: str) -> str:
+    return events.stdout if output_stdout else True
 
-    if not tool.startswith("reg_"):
-        raise FileNotFoundError
 
-    cmd_str = f"{tool} -h"
+def get_help_string(tool: str) -> str:
 
-    p = sp.Popen(shlex.split(cmd_str), stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = p.communicate()
+    # Probed once per executable, see utils.binaries
+    info = _probe(tool)
 
-    if stdout and not stderr:
-        return stdout.decode(encoding="utf-8")
-    else:
+    if info is None or info["help"] is None:
         raise FileNotFoundError
 
+    return info["help"]
 
-def is_function_available(tool: str, name: str) -> bool:
-
-    try:
-        stdout = get_help_string(tool)
-
-        if f"-{name.lower()}" not in stdout.lower():
-            raise FileNotFoundError
 
-        return True
+def is_function_available(tool: str, name: str) -> bool:
 
-    except FileNotFoundError:
-        return False
+    return has_option(tool, name)
 
 
 def create_test_image(length=256, blobs=6, min_rad=3, max_rad=32, dtype=float):
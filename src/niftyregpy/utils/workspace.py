@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Scratch workspace used to stage NiftyReg inputs and outputs.
+
+By default, scratch folders are created in the system temporary directory. The
+workspace can be pointed at a RAM-backed filesystem (e.g. ``/dev/shm``) with an
+optional size budget, either through :func:`set_workspace` or through the
+``NIFTYREGPY_WORKSPACE`` and ``NIFTYREGPY_WORKSPACE_SIZE`` environment variables.
+Calls that would exceed the budget fall back to the disk-backed directory.
+
+Scratch folders are emptied and reused across calls instead of being created and
+deleted for every call.
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+_SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_size(value):
+
+    if value is None or isinstance(value, int):
+        return value
+
+    value = str(value).strip().upper().rstrip("B")
+    if value[-1:] in _SIZE_SUFFIXES:
+        return int(float(value[:-1]) * _SIZE_SUFFIXES[value[-1]])
+
+    return int(value)
+
+
+def _estimate_nbytes(inputs):
+
+    # Outputs are usually about as large as the inputs, so reserve twice the
+    # size of the in-memory inputs. Paths and scalars do not count.
+    return 2 * sum(int(getattr(x, "nbytes", 0) or 0) for x in inputs)
+
+
+def _clear_folder(folder):
+
+    for entry in os.scandir(folder):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+class _Workspace:
+    def __init__(self, root=None, max_bytes=None, fallback=None):
+        self.root = root or tempfile.gettempdir()
+        self.max_bytes = _parse_size(max_bytes)
+        self.fallback = fallback or tempfile.gettempdir()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._idle = {}
+        self._reserved = 0
+        self._on_release = {}
+        self._active = {}
+        self._retired = False
+
+    def session(self, root):
+        # One private directory per process and root, removed at exit
+        if root not in self._sessions:
+            os.makedirs(root, exist_ok=True)
+            self._sessions[root] = tempfile.mkdtemp(prefix="niftyregpy-", dir=root)
+        return self._sessions[root]
+
+    def _fits(self, nbytes):
+
+        if self.root == self.fallback:
+            return True
+
+        if self.max_bytes is not None and self._reserved + nbytes > self.max_bytes:
+            return False
+
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            return shutil.disk_usage(self.root).free >= nbytes
+        except OSError:
+            return False
+
+    def acquire(self, nbytes=0):
+
+        with self._lock:
+            primary = self._fits(nbytes)
+            root = self.root if primary else self.fallback
+            if primary:
+                self._reserved += nbytes
+            idle = self._idle.setdefault(root, [])
+            folder = idle.pop() if idle else None
+            session = self.session(root)
+            self._active[session] = self._active.get(session, 0) + 1
+
+        if folder is None:
+            folder = tempfile.mkdtemp(prefix="scratch-", dir=session)
+
+        return root, folder, nbytes if primary else 0
+
+    def release(self, root, folder, nbytes=0):
+
+        with self._lock:
+            callbacks = self._on_release.pop(folder, [])
+
+        # Callbacks may still move files out of the folder before it is emptied
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Cleanup of %s failed", folder)
+
+        session = os.path.dirname(folder)
+
+        with self._lock:
+            self._reserved -= nbytes
+            self._active[session] -= 1
+            if self._retired:
+                # The last call of a retired session removes it
+                if not self._active[session]:
+                    del self._active[session]
+                    self._sessions.pop(root, None)
+                    shutil.rmtree(session, ignore_errors=True)
+                return
+
+        try:
+            _clear_folder(folder)
+            reusable = True
+        except OSError:
+            shutil.rmtree(folder, ignore_errors=True)
+            reusable = False
+
+        with self._lock:
+            if reusable and self._sessions.get(root) == session:
+                self._idle.setdefault(root, []).append(folder)
+
+    def on_release(self, folder, fn):
+        with self._lock:
+            self._on_release.setdefault(folder, []).append(fn)
+
+    def private_dir(self, folder, name):
+        # Directories such as the staging cache live next to the scratch
+        # folders of the same root, so files can be linked or moved between them
+        session = os.path.dirname(os.path.abspath(folder))
+        with self._lock:
+            if session not in self._sessions.values():
+                return None
+        private = os.path.join(session, name)
+        os.makedirs(private, exist_ok=True)
+        return private
+
+    def retire(self):
+
+        # Remove the sessions without running calls now, and the others once
+        # their last call is released
+        with self._lock:
+            self._retired = True
+            self._idle = {}
+            idle = {
+                root: session
+                for root, session in self._sessions.items()
+                if not self._active.get(session)
+            }
+            for root in idle:
+                del self._sessions[root]
+
+        for session in idle.values():
+            shutil.rmtree(session, ignore_errors=True)
+
+    def cleanup(self):
+
+        with self._lock:
+            sessions, self._sessions, self._idle = self._sessions, {}, {}
+
+        for session in sessions.values():
+            shutil.rmtree(session, ignore_errors=True)
+
+
+_workspace = _Workspace(
+    root=os.environ.get("NIFTYREGPY_WORKSPACE"),
+    max_bytes=os.environ.get("NIFTYREGPY_WORKSPACE_SIZE"),
+)
+
+
+def _reset_after_fork():
+
+    # A forked child must not share (and later delete) the parent's folders
+    global _workspace
+    _workspace = _Workspace(_workspace.root, _workspace.max_bytes, _workspace.fallback)
+    _retired.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Workspaces replaced by set_workspace while calls were still running in them
+_retired = []
+
+
+@atexit.register
+def _cleanup_at_exit():
+    for workspace in _retired + [_workspace]:
+        workspace.cleanup()
+
+
+def set_workspace(root=None, max_bytes=None, fallback=None):
+
+    """
+    Configure where NiftyReg inputs and outputs are staged.
+
+    Args:
+        root (string): Directory for scratch folders, e.g. ``/dev/shm``
+            (default = system temporary directory).
+        max_bytes (int/string): Size budget for ``root``, either in bytes or
+            with a suffix such as ``"2G"`` (optional).
+        fallback (string): Directory used when the budget of ``root`` is
+            exceeded (default = system temporary directory).
+
+    """
+
+    global _workspace
+
+    old = _workspace
+    _workspace = _Workspace(root, max_bytes, fallback)
+
+    # Calls running in the old workspace keep their folders until they end
+    old.retire()
+    _retired[:] = [w for w in _retired + [old] if w._sessions]
+
+
+def get_workspace() -> dict:
+
+    """
+    Return the current workspace configuration.
+    """
+
+    return {
+        "root": _workspace.root,
+        "max_bytes": _workspace.max_bytes,
+        "fallback": _workspace.fallback,
+    }
+
+
+def _cache_dir(folder):
+    return _workspace.private_dir(folder, "cache")
+
+
+def _private_dir(folder, name):
+    return _workspace.private_dir(folder, name)
+
+
+def _on_release(folder, fn):
+    # Run fn when the scratch folder is released, before it is emptied
+    _workspace.on_release(folder, fn)
+
+
+@contextmanager
+def scratch_dir(*inputs):
+
+    """
+    Context manager that provides an empty scratch folder for a single call.
+
+    The inputs of the call are only used to estimate how much space the call
+    needs, so that large calls can fall back to the disk-backed directory.
+    """
+
+    workspace = _workspace
+    root, folder, reserved = workspace.acquire(_estimate_nbytes(inputs))
+
+    try:
+        yield folder
+    finally:
+        workspace.release(root, folder, reserved)
@@ -61,3 +61,30 @@ class TestApps:
             verbose=False,
         )
         assert 1 - common.dice(ref, output[0]) < self.tol
+
+    def test_groupwise_paths(self, tmp_path):
+        ref = common.create_square(self.matrix_size, size=self.object_size)
+
+        input_0 = common.create_square(
+            self.matrix_size, size=self.object_size, c=self.matrix_size // 2 - 10
+        )
+        input_1 = common.create_square(
+            self.matrix_size, size=self.object_size, c=self.matrix_size // 2 + 10
+        )
+
+        # Files are staged in place, not copied to input_<i>.nii
+        names = []
+        for i, x in enumerate((ref, input_0, input_1)):
+            names.append(tmp_path / f"image_{i}.nii")
+            utils.write_nifti(str(names[-1]), x)
+
+        output = apps.groupwise(
+            names[1:],
+            names[0],
+            aff_it_num=2,
+            nrr_it_num=2,
+            affine_args="-maxit 5 -omp 1",
+            nrr_args="-maxit 100 -omp 1",
+            verbose=False,
+        )
+        assert 1 - common.dice(ref, output[0]) < self.tol
@@ -1,3 +1,4 @@
+import asyncio
 import random
 
 import numpy as np
@@ -8,6 +9,24 @@ def random_float(low=0.0, high=1.0):
     return random.uniform(a=low, b=high)
 
 
+def run_async(coro):
+    if hasattr(asyncio, "run"):
+        return asyncio.run(coro)
+
+    # Python 3.6, cancel the tasks that are left like asyncio.run does
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        tasks = asyncio.Task.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
 def seed_random_generators(seed=42):
     np.random.seed(seed)
     random.seed(seed)
@@ -1,9 +1,33 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
 import pytest
-from niftyregpy import utils
+from niftyregpy import tools, utils
 
 import test_common as common
 
 
+@pytest.fixture(autouse=True)
+def restore_config():
+    # Tests change process-wide configuration, restore it even if they fail
+    yield
+    utils.set_workspace()
+    utils.set_staging_cache()
+    utils.set_output_compression()
+    utils.set_thread_budget()
+    utils.set_launcher()
+
+
 class TestMisc:
     def test_help_string(self):
         output = utils.get_help_string("reg_aladin")
@@ -36,3 +60,801 @@ class TestMisc:
     def test_create_test_image(self):
         image = utils.create_test_image(length=256, blobs=6, min_rad=3, max_rad=32)
         assert image is not None
+
+    def test_scratch_dir_reuse(self, tmp_path):
+        utils.set_workspace(root=str(tmp_path))
+        with utils.scratch_dir() as folder:
+            open(f"{folder}/file.nii", "w").close()
+        with utils.scratch_dir() as folder2:
+            assert folder2 == folder
+            assert not os.listdir(folder2)
+
+    def test_set_workspace_running_call(self, tmp_path):
+        old, new = tmp_path / "old", tmp_path / "new"
+        utils.set_workspace(root=str(old))
+        with utils.scratch_dir() as folder:
+            utils.set_workspace(root=str(new))
+            # The running call keeps its folder until it ends
+            assert os.path.isdir(folder)
+            open(os.path.join(folder, "out.nii"), "w").close()
+            with utils.scratch_dir() as other:
+                assert other.startswith(str(new))
+        assert not os.listdir(old)
+
+    def test_scratch_dir_fallback(self, tmp_path):
+        ram, disk = tmp_path / "ram", tmp_path / "disk"
+        utils.set_workspace(root=str(ram), max_bytes="1K", fallback=str(disk))
+        with utils.scratch_dir(np.zeros(16, np.uint8)) as folder:
+            assert folder.startswith(str(ram))
+        with utils.scratch_dir(np.zeros(1024, np.uint8)) as folder:
+            assert folder.startswith(str(disk))
+        utils.set_workspace()
+        assert not os.listdir(ram)
+
+    def test_stage_nifti_cache_hit(self, tmp_path):
+        utils.set_workspace(root=str(tmp_path))
+        utils.set_staging_cache(max_entries=4)
+        array = common.random_array((32, 32))
+        with utils.scratch_dir(array) as folder:
+            first = utils.stage_nifti(os.path.join(folder, "ref"), array)
+            inode = os.stat(first).st_ino
+        with utils.scratch_dir(array) as folder:
+            second = utils.stage_nifti(os.path.join(folder, "ref.nii"), array)
+            assert os.stat(second).st_ino == inode
+            assert np.array_equal(utils.read_nifti(second), array)
+        assert utils.get_staging_cache()["hits"] == 1
+
+    def test_stage_nifti_cache_eviction(self, tmp_path):
+        utils.set_workspace(root=str(tmp_path))
+        utils.set_staging_cache(max_entries=1)
+        with utils.scratch_dir() as folder:
+            for i in range(3):
+                utils.stage_nifti(
+                    os.path.join(folder, f"{i}.nii"), np.full(8, float(i))
+                )
+            assert utils.get_staging_cache()["entries"] == 1
+            assert all(
+                os.path.exists(os.path.join(folder, f"{i}.nii")) for i in range(3)
+            )
+
+    def test_read_nifti_mmap(self, tmp_path):
+        array = common.random_array((16, 16, 4))
+        array[0, 0, 0] = np.nan
+        name = str(tmp_path / "image.nii")
+        utils.write_nifti(name, array)
+        output = utils.read_nifti(name, mmap=True)
+        assert isinstance(output, np.memmap) and output[0, 0, 0] == 0.0
+        assert np.isnan(utils.read_nifti(name, output_nan=True)[0, 0, 0])
+
+    def test_read_nifti_dtype(self, tmp_path):
+        array = common.random_array((16, 16))
+        name = str(tmp_path / "image.nii")
+        utils.write_nifti(name, array)
+        output = utils.read_nifti(name, dtype=np.float64)
+        assert output.dtype == np.float64 and np.allclose(output, array)
+
+    def test_stage_nifti_passthrough(self, tmp_path):
+        name = str(tmp_path / "image.nii.gz")
+        utils.write_nifti(name, common.random_array((8, 8)))
+        img = nib.load(name)
+        assert utils.stage_nifti(str(tmp_path / "ref.nii"), name) == name
+        assert utils.stage_nifti(str(tmp_path / "ref.nii"), img) == name
+        img = nib.Nifti1Image(common.random_array((8, 8)), np.diag((2, 2, 2, 1)))
+        staged = utils.stage_nifti(str(tmp_path / "ref.nii"), img)
+        assert staged != name and np.allclose(nib.load(staged).affine, img.affine)
+
+    def test_is_affine(self):
+        assert utils.is_affine(common.random_affine())
+        assert utils.is_affine("affine.txt")
+        assert not utils.is_affine("cpp.nii.gz")
+        assert not utils.is_affine(common.random_array((8, 8)))
+
+    def test_stage_nifti_policy(self, tmp_path):
+        image = np.random.rand(8, 8)
+        staged = utils.stage_nifti(str(tmp_path / "image.nii"), image)
+        assert nib.load(staged).get_data_dtype() == np.float32
+        staged = utils.stage_nifti(str(tmp_path / "mask.nii"), image > 0.5, kind="mask")
+        assert nib.load(staged).get_data_dtype() == np.uint8
+        staged = utils.stage_nifti(str(tmp_path / "label.nii"), np.arange(64))
+        assert nib.load(staged).get_data_dtype() == np.int16
+        staged = utils.stage_nifti(str(tmp_path / "wide.nii"), np.arange(64) << 20)
+        assert nib.load(staged).get_data_dtype() == np.int32
+
+    def test_staging_policy_override(self, tmp_path):
+        image = np.random.rand(8, 8)
+        with utils.staging_policy(image=None):
+            assert utils.get_staging_policy()["image"] is None
+            staged = utils.stage_nifti(str(tmp_path / "image.nii"), image)
+        assert nib.load(staged).get_data_dtype() == np.float64
+        assert utils.get_staging_policy()["image"] == np.float32
+        with pytest.raises(ValueError):
+            utils.set_staging_policy(volume=np.float32)
+
+    def test_image(self, tmp_path):
+        array = common.random_array((8, 8, 4))
+        img = utils.Image(array, np.diag((0.5, 0.5, 2, 1)))
+        assert img.array is array and np.asarray(img) is array
+        assert img.shape == (8, 8, 4) and img.spacing == (0.5, 0.5, 2)
+        assert not utils.is_affine(img)
+        staged = utils.stage_nifti(str(tmp_path / "ref.nii"), img)
+        res = utils.read_nifti(staged, as_image=True)
+        assert utils.is_image(res)
+        assert np.allclose(res.affine, img.affine)
+        assert np.allclose(res, array)
+
+    def test_image_header(self, tmp_path):
+        header = nib.Nifti1Header()
+        header.set_intent("vector", name="NREG_TRANS")
+        img = utils.Image(
+            common.random_array((8, 8, 1, 1, 2)).astype(float), None, header
+        )
+        staged = utils.stage_nifti(str(tmp_path / "cpp.nii"), img, kind="transform")
+        res = nib.load(staged)
+        assert res.header.get_intent()[0] == "vector"
+        assert res.get_data_dtype() == np.float32
+
+    @pytest.mark.parametrize("dtype", [np.float32, np.int16, np.uint8, np.float64])
+    @pytest.mark.parametrize("order", ["C", "F"])
+    def test_write_nifti_raw(self, tmp_path, dtype, order):
+        array = np.asarray(np.random.rand(7, 6, 5) * 100, dtype=dtype, order=order)
+        affine = common.random_affine()
+        name = str(tmp_path / "raw.nii")
+        assert utils.write_nifti_raw(name, array, affine)
+        img = nib.load(name)
+        assert img.get_data_dtype() == dtype
+        assert np.allclose(img.affine, affine)
+        assert np.array_equal(img.get_fdata(), array)
+
+    def test_stage_niftis(self, tmp_path):
+        arrays = [common.random_array((8, 8)) * i for i in range(6)]
+        utils.set_io_threads(4)
+        with utils.staging_policy(image=np.float64):
+            names = utils.stage_niftis(str(tmp_path / "input"), arrays)
+        assert names == [str(tmp_path / f"input_{i}.nii") for i in range(6)]
+        res = utils.read_niftis(names, as_image=True)
+        assert all(x.dtype == np.float64 for x in res)
+        assert all(np.allclose(x, y) for x, y in zip(res, arrays))
+        utils.set_io_threads()
+
+    @pytest.mark.parametrize("background", [True, False])
+    def test_output_file_compressed(self, tmp_path, background):
+        utils.set_output_compression(background=background)
+        array = common.random_array((16, 16, 8))
+        dst = str(tmp_path / "res.nii.gz")
+        with utils.scratch_dir() as folder:
+            res = utils.output_file(folder, "res.nii", dst)
+            assert res.startswith(folder) and res.endswith(".nii")
+            utils.write_nifti(res, array)
+        utils.flush_outputs()
+        assert not os.path.exists(res)
+        assert np.allclose(nib.load(dst).get_fdata(), array)
+        assert utils.output_file(folder, "res.nii", str(tmp_path / "res.nii")) == str(
+            tmp_path / "res.nii"
+        )
+        utils.set_output_compression()
+
+    def test_output_file_pending(self, tmp_path, monkeypatch):
+        gzip_file = utils.compress.gzip_file
+
+        def slow(src, dst, level=None, threads=None):
+            time.sleep(0.5)
+            gzip_file(src, dst, level, threads)
+
+        monkeypatch.setattr(utils.compress, "gzip_file", slow)
+        array = common.random_array((8, 8))
+        dst = str(tmp_path / "res.nii.gz")
+        with utils.scratch_dir() as folder:
+            utils.write_nifti(utils.output_file(folder, "res.nii", dst), array)
+        # Reading and staging the destination wait until it has been written
+        assert np.allclose(utils.read_nifti(dst), array)
+        with utils.scratch_dir() as folder:
+            utils.write_nifti(utils.output_file(folder, "res.nii", dst), array + 1)
+        with utils.scratch_dir() as folder:
+            staged = utils.stage_nifti(os.path.join(folder, "ref.nii"), dst)
+            assert np.allclose(utils.read_nifti(staged), array + 1)
+        utils.flush_outputs()
+
+    @pytest.mark.parametrize("background", [True, False])
+    def test_output_file_compress_failure(self, tmp_path, monkeypatch, background):
+        def fail(src, dst, level=None, threads=None):
+            raise OSError(28, "No space left on device")
+
+        monkeypatch.setattr(utils.compress, "gzip_file", fail)
+        utils.set_output_compression(background=background)
+        array = common.random_array((8, 8))
+        dst = str(tmp_path / "res.nii.gz")
+        with utils.scratch_dir() as folder:
+            utils.write_nifti(utils.output_file(folder, "res.nii", dst), array)
+        with pytest.raises(OSError, match="No space left"):
+            utils.flush_outputs()
+        # The output is kept uncompressed instead
+        assert not os.path.exists(dst)
+        assert np.allclose(utils.read_nifti(str(tmp_path / "res.nii")), array)
+        utils.flush_outputs()
+
+    def test_gzip_file_members(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(utils.compress, "_PIGZ", None)
+        monkeypatch.setattr(utils.compress, "_CHUNK_SIZE", 1000)
+        data = np.random.bytes(10000)
+        (tmp_path / "data").write_bytes(data)
+        utils.compress.gzip_file(str(tmp_path / "data"), str(tmp_path / "data.gz"))
+        assert gzip.decompress((tmp_path / "data.gz").read_bytes()) == data
+        utils.compress.gunzip_file(
+            str(tmp_path / "data.gz"), str(tmp_path / "out"), threads=4
+        )
+        assert (tmp_path / "out").read_bytes() == data
+        # Files from other tools are decompressed as a single stream
+        (tmp_path / "other.gz").write_bytes(gzip.compress(data))
+        utils.compress.gunzip_file(str(tmp_path / "other.gz"), str(tmp_path / "out"))
+        assert (tmp_path / "out").read_bytes() == data
+
+    def test_stage_nifti_compressed(self, tmp_path):
+        utils.set_workspace()
+        utils.set_staging_cache()
+        array = common.random_array((8, 8))
+        name = str(tmp_path / "image.nii.gz")
+        utils.write_nifti(name, array)
+        with utils.scratch_dir() as folder:
+            staged = utils.stage_nifti(os.path.join(folder, "ref.nii"), name)
+            assert staged == os.path.join(folder, "ref.nii")
+            assert np.allclose(utils.read_nifti(staged), array)
+            utils.stage_nifti(os.path.join(folder, "flo.nii"), name)
+        assert utils.get_staging_cache()["hits"] == 1
+
+    def test_lazy_output(self):
+        array = common.random_array((8, 8))
+        with utils.scratch_dir() as folder:
+            name = os.path.join(folder, "res.nii")
+            utils.write_nifti(name, array)
+            handle = utils.lazy_output(folder, name)
+        kept = handle.name
+        assert os.path.exists(kept) and not os.path.exists(name)
+        assert np.allclose(np.asarray(handle), array)
+        del handle
+        assert not os.path.exists(kept)
+
+    def test_stage_geometry(self):
+        utils.set_staging_cache()
+        affine = np.diag((0.5, 0.5, 2, 1))
+        img = utils.Image(common.random_array((64, 64, 32)), affine)
+        with utils.scratch_dir() as folder:
+            staged = utils.stage_geometry(os.path.join(folder, "ref.nii"), img)
+            ref = nib.load(staged)
+            assert ref.shape == img.shape and ref.get_data_dtype() == np.uint8
+            assert np.allclose(ref.affine, affine) and not ref.get_fdata().any()
+            geometry = utils.Geometry(img.shape, affine)
+            utils.stage_geometry(os.path.join(folder, "ref2.nii"), geometry)
+        assert utils.get_staging_cache()["hits"] == 1
+
+    def test_read_nifti_roi(self):
+        array = common.random_array((64, 64, 32))
+        affine = np.diag((0.5, 0.5, 2, 1))
+        with utils.scratch_dir() as folder:
+            name = os.path.join(folder, "test.nii")
+            utils.write_nifti_raw(name, array, affine)
+            output = utils.read_nifti(name, roi=(slice(None), slice(None), 16))
+            assert np.allclose(output, array[:, :, 16])
+            output = utils.read_nifti(name, step=2, as_image=True)
+            assert np.allclose(output.array, array[::2, ::2, ::2])
+            assert np.allclose(output.spacing, (1, 1, 4))
+            output = utils.read_nifti(name, roi=slice(10, 20), as_image=True)
+            assert np.allclose(output.array, array[10:20])
+            assert np.allclose(output.affine[0, 3], 5)
+            # Images keep the axis of an index
+            output = utils.read_nifti(name, roi=(slice(None), 5, -1), as_image=True)
+            assert np.allclose(output.array, array[:, 5:6, -1:])
+            assert np.allclose(output.affine[:3, 3], (0, 2.5, 62))
+            with pytest.raises(AssertionError):
+                utils.read_nifti(name, roi=(slice(None), 1.5))
+            with pytest.raises(IndexError):
+                utils.read_nifti(name, roi=(64,), as_image=True)
+
+    def test_read_nifti_out(self):
+        array = common.random_array((32, 32, 8)).astype(np.float32)
+        array[0, 0, 0] = np.nan
+        frames = np.ones(array.shape + (3,), dtype=np.float32)
+        with utils.scratch_dir() as folder:
+            name = os.path.join(folder, "test.nii")
+            utils.write_nifti_raw(name, array)
+            output = utils.read_nifti(name, out=frames[..., 1])
+            assert output.base is frames and np.all(frames[..., 0] == 1)
+            assert frames[0, 0, 0, 1] == 0
+            assert np.allclose(frames[..., 1].ravel()[1:], array.ravel()[1:])
+            output = utils.read_nifti(name, dtype=np.float64)
+            assert output.dtype == np.float64
+
+    def test_run_wrapper(self):
+        def wrapper(cmd_str):
+            result = yield utils.NiftyRegCall(cmd_str)
+            return "done", result
+
+        assert utils.run_wrapper(wrapper("ls")) == ("done", False)
+        with pytest.raises(FileNotFoundError):
+            utils.run_wrapper(wrapper("reg_failure"))
+        output = common.run_async(utils.run_wrapper_async(wrapper("ls")))
+        assert output == ("done", False)
+
+    def test_run_wrapper_async_cancel(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_sleep"
+        script.write_text("#!/bin/sh\nexec sleep 30\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+        closed = []
+
+        def wrapper():
+            try:
+                yield utils.NiftyRegCall("reg_sleep")
+            finally:
+                closed.append(True)
+
+        async def main():
+            tasks = [asyncio.ensure_future(utils.run_wrapper_async(wrapper()))]
+            await asyncio.sleep(0.5)
+            tasks[0].cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        start = time.perf_counter()
+        output = common.run_async(main())
+        assert isinstance(output[0], asyncio.CancelledError) and closed
+        assert time.perf_counter() - start < 10
+
+    def test_thread_tokens_async(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_sleep"
+        script.write_text("#!/bin/sh\nexec sleep 1\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+        utils.set_thread_budget(1)
+
+        async def main():
+            loop = asyncio.get_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(1))
+            limit = asyncio.Semaphore(3)
+            calls = [
+                asyncio.ensure_future(
+                    utils.call_niftyreg_async("reg_sleep", limit=limit)
+                )
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0.2)
+            # Calls waiting for the budget leave the default executor free
+            start = time.perf_counter()
+            await loop.run_in_executor(None, time.sleep, 0)
+            waited = time.perf_counter() - start
+            calls[-1].cancel()
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            return waited, results
+
+        waited, results = common.run_async(main())
+        assert waited < 0.5
+        assert results[:2] == [True, True]
+        assert isinstance(results[2], asyncio.CancelledError)
+        assert utils.get_thread_budget()["in_use"] == 0
+
+    def test_thread_budget(self):
+        utils.set_thread_budget(4, per_call=2)
+        try:
+            with utils.thread_tokens("reg_aladin -ref a.nii") as (cmd_str, kwargs):
+                assert cmd_str.endswith(" -omp 2")
+                assert kwargs["env"]["OMP_NUM_THREADS"] == "2"
+                assert utils.get_thread_budget()["in_use"] == 2
+                with utils.thread_tokens("reg_tools -in a.nii") as (cmd_str, kwargs):
+                    assert "-omp" not in cmd_str and "cpus" not in kwargs
+                    # Tools without -omp take their share of the budget
+                    assert kwargs["env"]["OMP_NUM_THREADS"] == "2"
+                    assert utils.get_thread_budget()["in_use"] == 4
+            assert utils.get_thread_budget()["in_use"] == 0
+
+            # or as many tokens as are free
+            utils.set_thread_budget(4)
+            with utils.thread_tokens("reg_f3d -omp 3"):
+                with utils.thread_tokens("reg_tools -in a.nii") as (_, kwargs):
+                    assert kwargs["env"]["OMP_NUM_THREADS"] == "1"
+            with utils.thread_tokens("reg_tools -in a.nii") as (_, kwargs):
+                assert kwargs["env"]["OMP_NUM_THREADS"] == "4"
+            assert utils.get_thread_budget()["in_use"] == 0
+
+            # Resizing keeps the tokens of running calls
+            with utils.thread_tokens("reg_f3d -omp 4"):
+                utils.set_thread_budget(2)
+                assert utils.get_thread_budget()["in_use"] == 4
+            assert utils.get_thread_budget()["in_use"] == 0
+            utils.set_thread_budget(4, per_call=2)
+
+            acquired = threading.Event()
+
+            def wait_for_tokens():
+                with utils.thread_tokens("reg_f3d -omp 8"):
+                    acquired.set()
+
+            with utils.thread_tokens("reg_f3d -omp 1") as (cmd_str, _):
+                assert cmd_str == "reg_f3d -omp 1"
+                thread = threading.Thread(target=wait_for_tokens)
+                thread.start()
+                assert not acquired.wait(0.2)
+                assert utils.get_thread_budget()["waiting"] == 1
+            thread.join()
+            assert acquired.is_set()
+        finally:
+            utils.set_thread_budget()
+
+    def test_thread_budget_pin(self, monkeypatch):
+        monkeypatch.setattr(utils.governor, "_available_cpus", lambda: [0, 1, 2, 3])
+        monkeypatch.setattr(
+            utils.governor, "numa_nodes", lambda: {0: [0, 1], 1: [2, 3]}
+        )
+        utils.set_thread_budget(4, pin=True)
+        try:
+            governor = utils.governor._governor
+            n, cpus = governor.acquire(1, pin=True)
+            assert len(cpus) == 1
+            n2, cpus2 = governor.acquire(2, pin=True)
+            # The second call fits in the other NUMA node
+            assert {c // 2 for c in cpus2} == {1 - cpus[0] // 2}
+            governor.release(n, cpus)
+            n, cpus = governor.acquire(2, pin=False)
+            assert cpus is None
+            governor.release(n, cpus)
+            governor.release(n2, cpus2)
+            with utils.pinning(False):
+                with utils.thread_tokens("reg_f3d -omp 2") as (_, kwargs):
+                    assert "cpus" not in kwargs
+            with utils.thread_tokens("reg_f3d -omp 2") as (_, kwargs):
+                assert "cpus" in kwargs
+        finally:
+            utils.set_thread_budget()
+
+    def test_call_niftyreg_events(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_fake"
+        script.write_text(
+            "#!/bin/sh\n"
+            "echo '[NiftyReg F3D] Current level: 1 / 2'\n"
+            "echo '[NiftyReg F3D] Initial objective function: 0.5 = (wSIM)0.5'\n"
+            "echo '[NiftyReg F3D] [1] Current objective function: 0.25 = (wSIM)0.25'\n"
+            "echo '[NiftyReg F3D] Current level: 2 / 2'\n"
+            "echo 'done'\n"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        events = []
+        output = utils.call_niftyreg(
+            "reg_fake", output_stdout=True, on_event=events.append
+        )
+        assert output.splitlines()[-1] == "done"
+        assert [e.kind for e in events] == [
+            "level",
+            "iteration",
+            "iteration",
+            "level",
+            "line",
+        ]
+        assert events[2][1:6] == ("reg_fake", 1, 2, 1, 0.25)
+        assert events[3].level == 2 and events[4].line == "done"
+
+        async_events = []
+        common.run_async(
+            utils.call_niftyreg_async("reg_fake", on_event=async_events.append)
+        )
+        assert async_events == events
+
+    def test_quoted_paths(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_tools"
+        script.write_text('#!/bin/sh\ncp "$2" "$4"\n')
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        folder = tmp_path / "with space's"
+        folder.mkdir()
+        data = np.arange(8, dtype=np.float32).reshape(2, 2, 2)
+        utils.write_nifti(str(folder / "input.nii"), data)
+
+        output = str(folder / "output.nii")
+        res = tools.float(str(folder / "input.nii"), output=output)
+        np.testing.assert_array_equal(res, data)
+        assert os.path.exists(output)
+
+    def test_stop_registration(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_fake"
+        script.write_text(
+            "#!/bin/sh\n"
+            "echo '[NiftyReg F3D] Current level: 1 / 1'\n"
+            "for i in 1 2 3 4 5; do\n"
+            '  echo "[NiftyReg F3D] [$i] Current objective function: 0.5"\n'
+            "done\n"
+            "exec sleep 30\n"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        trace = []
+
+        def on_event(event):
+            if event.kind == "iteration":
+                trace.append(event)
+                if len(trace) == 3:
+                    raise utils.StopRegistration
+
+        start = time.monotonic()
+        utils.set_metrics()
+        try:
+            assert not utils.call_niftyreg("reg_fake", on_event=on_event)
+            text = utils.render_metrics()
+        finally:
+            utils.set_metrics(False)
+        assert [e.iteration for e in trace] == [1, 2, 3]
+
+        # Stopped by the caller, so not counted as a failure
+        assert 'niftyregpy_calls_total{tool="reg_fake"} 1' in text.splitlines()
+        assert "niftyregpy_failures_total{" not in text
+
+        trace.clear()
+        assert not common.run_async(
+            utils.call_niftyreg_async("reg_fake", on_event=on_event)
+        )
+        assert [e.iteration for e in trace] == [1, 2, 3]
+        assert time.monotonic() - start < 10
+
+    def test_stop_conditions(self):
+        def trace(*objectives, level=2):
+            return [
+                utils.NiftyRegEvent("iteration", "reg_f3d", level, 2, i, x, {}, "")
+                for i, x in enumerate(objectives)
+            ]
+
+        assert not utils.stop_after(60)(trace(1.0))
+        assert utils.stop_after(-1)(trace(1.0))
+
+        # The clock runs from the start of the call, not the first iteration
+        budget = utils.stop_after(0.05)
+        budget.start()
+        time.sleep(0.1)
+        assert budget(trace(1.0))
+        budget.start()
+        assert not budget(trace(1.0))
+
+    def test_telemetry(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_fake"
+        script.write_text("#!/bin/sh\necho done\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        @utils.niftyreg_command
+        def fake(array):
+            name = utils.stage_nifti(str(tmp_path / "in.nii"), array)
+            assert (yield utils.NiftyRegCall("reg_fake"))
+            return utils.read_nifti(name)
+
+        records = []
+        utils.set_telemetry()
+        utils.add_telemetry_hook(records.append)
+        try:
+            array = np.ones((8, 8, 8), dtype=np.float32)
+            assert np.all(fake(array) == 1)
+            assert np.all(common.run_async(fake.async_(array)) == 1)
+            assert utils.call_niftyreg("reg_fake")
+        finally:
+            utils.remove_telemetry_hook(records.append)
+
+        assert records == utils.get_telemetry()
+        assert [(r.phase, r.call) for r in records] == [
+            ("stage", "fake"),
+            ("exec", "fake"),
+            ("load", "fake"),
+        ] * 2 + [("exec", "reg_fake")]
+
+        stage, exec_, load = records[:3]
+        assert stage.nbytes >= array.nbytes and load.nbytes == array.nbytes
+        assert exec_.tool == "reg_fake" and exec_.cpu is not None and exec_.rss > 0
+        assert records[4].cpu is not None
+
+        summary = utils.telemetry_summary()
+        assert summary["fake"]["exec"]["count"] == 2
+        assert summary["fake"]["load"]["nbytes"] == 2 * array.nbytes
+        assert summary["reg_fake"]["exec"]["wall"] == records[-1].wall
+
+        utils.set_telemetry(enabled=False)
+        fake(array)
+        assert not utils.get_telemetry() and not utils.telemetry_summary()
+        utils.set_telemetry()
+
+    def test_json_logging(self, tmp_path, monkeypatch, capsys):
+        script = tmp_path / "reg_fake"
+        script.write_text("#!/bin/sh\necho working\necho broken >&2\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        @utils.niftyreg_command
+        def fake(array):
+            utils.stage_nifti(str(tmp_path / "in.nii"), array)
+            return (yield utils.NiftyRegCall("reg_fake", True))
+
+        stream = io.StringIO()
+        utils.set_json_logging(stream)
+        utils.set_trace_file(tmp_path / "trace.json")
+        try:
+            with utils.span("batch", size=1) as batch_id:
+                assert not fake(np.ones((4, 4, 4), dtype=np.float32))
+        finally:
+            utils.set_trace_file(None)
+            utils.set_json_logging(level=None)
+
+        assert capsys.readouterr().out == ""
+
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [e["message"] for e in entries] == ["reg_fake", "working", "broken"]
+        assert entries[2]["level"] == "ERROR" and entries[2]["tool"] == "reg_fake"
+        assert len({e["call_id"] for e in entries}) == 1
+        assert {e["trace_id"] for e in entries} == {batch_id}
+
+        with open(tmp_path / "trace.json") as f:
+            events = {e["name"]: e for e in json.load(f)}
+        assert set(events) == {"batch", "fake", "stage", "reg_fake"}
+        assert len({e["tid"] for e in events.values()}) == 1
+        assert events["reg_fake"]["args"]["call_id"] == entries[0]["call_id"]
+        assert events["reg_fake"]["args"]["cpu"] is not None
+        assert events["stage"]["args"]["nbytes"] > 0
+        assert events["batch"]["ts"] <= events["reg_fake"]["ts"]
+        assert events["batch"]["dur"] >= events["reg_fake"]["dur"]
+
+        # Verbose output is printed once, not again by the root logger
+        root = logging.StreamHandler(io.StringIO())
+        logging.getLogger().addHandler(root)
+        try:
+            assert not fake(np.ones((4, 4, 4), dtype=np.float32))
+        finally:
+            logging.getLogger().removeHandler(root)
+        assert capsys.readouterr().out == "reg_fake\nworking\n"
+        assert "working" not in root.stream.getvalue()
+
+    def test_metrics(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_fake"
+        script.write_text('#!/bin/sh\n[ "$1" = fail ] && echo failed >&2\nexit 0\n')
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+        @utils.niftyreg_command
+        def fake(array, args=""):
+            with utils.scratch_dir(array) as tmp_folder:
+                utils.stage_nifti(os.path.join(tmp_folder, "in.nii"), array)
+                return (yield utils.NiftyRegCall(f"reg_fake {args}"))
+
+        array = np.ones((4, 4, 4), dtype=np.float32)
+
+        utils.set_metrics()
+        try:
+            assert fake(array)
+            assert not fake(array, "fail")
+            text = utils.render_metrics()
+
+            utils.write_metrics(tmp_path / "metrics.prom")
+            server = utils.serve_metrics()
+            try:
+                url = f"http://127.0.0.1:{server.server_port}/metrics"
+                with urllib.request.urlopen(url) as response:
+                    served = response.read().decode()
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            utils.set_metrics(False)
+
+        lines = text.splitlines()
+        assert 'niftyregpy_calls_total{tool="reg_fake"} 2' in lines
+        assert 'niftyregpy_failures_total{tool="reg_fake"} 1' in lines
+        assert "niftyregpy_staging_cache_misses_total 1" in lines
+        assert "niftyregpy_staging_cache_hits_total 1" in lines
+        assert "# TYPE niftyregpy_exec_seconds histogram" in lines
+        assert 'niftyregpy_exec_seconds_bucket{tool="reg_fake",le="+Inf"} 2' in lines
+        assert 'niftyregpy_stage_bytes_count{call="fake"} 2' in lines
+        assert (tmp_path / "metrics.prom").read_text() == text == served
+        assert utils.render_metrics() == ""
+
+    def test_binaries(self, tmp_path):
+        calls = tmp_path / "calls"
+        script = tmp_path / "reg_tools"
+        script.write_text(
+            "#!/bin/sh\n"
+            f'echo "$1" >> {calls}\n'
+            'case "$1" in\n'
+            "  -h) echo 'Usage: reg_tools -in <file> [-chgres <x> <y> <z>]' ;;\n"
+            "  --version) echo 'NiftyReg 1.5.69' ;;\n"
+            "  *) echo done ;;\n"
+            "esac\n"
+        )
+        script.chmod(0o755)
+
+        cache_file = tmp_path / "cache.json"
+        utils.set_niftyreg_path(tmp_path, cache_file)
+        try:
+            assert utils.find_binary("reg_tools") == str(script)
+            assert utils.find_binary("reg_tools; ls") is None
+            for _ in range(3):
+                assert utils.is_function_available("reg_tools", "chgres")
+                assert not utils.is_function_available("reg_tools", "rmNanInf")
+            assert utils.get_version("reg_tools") == "1.5.69"
+            assert "Usage" in utils.get_help_string("reg_tools")
+            assert calls.read_text().split() == ["-h", "--version"]
+
+            table = utils.capabilities()
+            assert set(table) == {"reg_tools"}
+            assert {"in", "chgres"} <= table["reg_tools"]["options"]
+
+            # A new process reads the cache file instead of running reg_tools
+            utils.set_niftyreg_path(tmp_path, cache_file)
+            assert utils.has_option("reg_tools", "chgres")
+            assert utils.call_niftyreg("reg_tools -run", output_stdout=True) == "done\n"
+            assert calls.read_text().split() == ["-h", "--version", "-run"]
+
+            # A rebuilt executable is probed again
+            os.utime(script, ns=(0, 0))
+            assert utils.get_version("reg_tools") == "1.5.69"
+            assert calls.read_text().split()[-2:] == ["-h", "--version"]
+        finally:
+            utils.set_niftyreg_path()
+
+    def test_launcher(self, tmp_path, monkeypatch):
+        script = tmp_path / "reg_fake"
+        script.write_text(
+            "#!/bin/sh\n"
+            'case "$1" in\n'
+            "  -err) echo 'bad input' >&2 ;;\n"
+            "  -cpus) grep Cpus_allowed_list /proc/$$/status ;;\n"
+            "  -sleep) echo '[NiftyReg F3D] [1] Current objective function: 0.5'\n"
+            "          exec sleep 30 ;;\n"
+            '  *) echo "$NIFTYREG_TEST" ;;\n'
+            "esac\n"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+        monkeypatch.setenv("NIFTYREG_TEST", "hello")
+
+        def on_event(event):
+            raise utils.StopRegistration
+
+        affinity = os.sched_getaffinity(0)
+
+        utils.set_telemetry()
+        try:
+            for backend in ("popen", "spawn", "helper"):
+                try:
+                    utils.set_launcher(backend)
+                except NotImplementedError:
+                    continue
+                assert utils.get_launcher() == backend
+
+                assert utils.call_niftyreg("reg_fake", output_stdout=True) == "hello\n"
+                record = utils.get_telemetry()[-1]
+                assert record.phase == "exec" and record.cpu is not None
+
+                output = common.run_async(
+                    utils.call_niftyreg_async("reg_fake", output_stdout=True)
+                )
+                assert output == "hello\n" and utils.get_telemetry()[-1].cpu is not None
+
+                assert not utils.call_niftyreg("reg_fake -err")
+
+                start = time.monotonic()
+                assert not utils.call_niftyreg("reg_fake -sleep", on_event=on_event)
+                assert time.monotonic() - start < 10
+
+                with pytest.raises(FileNotFoundError):
+                    utils.call_niftyreg("reg_missing")
+
+                # Pinned processes start on their CPU, the launching thread
+                # keeps its own
+                utils.set_thread_budget(1, pin=True)
+                output = utils.call_niftyreg("reg_fake -cpus", output_stdout=True)
+                assert output.split()[-1].isdigit()
+                assert os.sched_getaffinity(0) == affinity
+                output = common.run_async(
+                    utils.call_niftyreg_async("reg_fake -cpus", output_stdout=True)
+                )
+                assert output.split()[-1].isdigit()
+                assert os.sched_getaffinity(0) == affinity
+                utils.set_thread_budget()
+
+            with pytest.raises(AssertionError):
+                utils.set_launcher("fork")
+        finally:
+            utils.set_launcher()
+            utils.set_telemetry(enabled=False)
@@ -1,4 +1,7 @@
+import asyncio
+
 import numpy as np
+import pytest
 from niftyregpy import reg, utils
 from skimage import transform
 
@@ -21,6 +24,73 @@ class TestReg:
         output = reg.resample(ref, flo, trans=affine, inter=0, verbose=self.verbose)
         assert output is not None
 
+    def test_resample_paths(self, tmp_path):
+        ref = common.create_square(self.matrix_size, size=self.object_size)
+        utils.write_nifti(str(tmp_path / "ref.nii.gz"), ref)
+        utils.write_txt(str(tmp_path / "aff.txt"), common.random_affine(rigid=True))
+        output = reg.resample(
+            str(tmp_path / "ref.nii.gz"),
+            str(tmp_path / "ref.nii.gz"),
+            trans=str(tmp_path / "aff.txt"),
+            inter=0,
+            verbose=self.verbose,
+        )
+        assert output is not None and output.shape == ref.shape
+
+    def test_resample_geometry(self):
+        flo = common.create_square(self.matrix_size, size=self.object_size)
+        ref = utils.Geometry(flo.shape, np.diag((2, 2, 1, 1)))
+        output = reg.resample(ref, flo, trans=np.eye(4), inter=0)
+        assert output.shape == flo.shape and np.allclose(output.affine, ref.affine)
+
+    def test_resample_roi_invalid(self):
+        # The roi is checked before reg_resample runs
+        flo = common.create_square(self.matrix_size, size=self.object_size)
+        with pytest.raises(AssertionError):
+            reg.resample(flo, flo, trans=np.eye(4), roi=(slice(None), "center"))
+
+    def test_resample_async(self):
+        flo = common.create_square(self.matrix_size, size=self.object_size)
+        affines = [common.random_affine(rigid=True) for _ in range(3)]
+
+        async def main():
+            limit = asyncio.Semaphore(2)
+            return await asyncio.gather(
+                *(
+                    reg.resample_async(flo, flo, trans=a, inter=0, limit=limit)
+                    for a in affines
+                )
+            )
+
+        outputs = common.run_async(main())
+        for output, affine in zip(outputs, affines):
+            assert np.allclose(output, reg.resample(flo, flo, trans=affine, inter=0))
+
+    def test_resample_batch(self, tmp_path):
+        flo = common.create_square(self.matrix_size, size=self.object_size)
+        affines = [common.random_affine(rigid=True) for _ in range(3)]
+        affines[1] = str(tmp_path / "missing.txt")
+        results, failures = reg.resample_batch(flo, flo, affines, workers=2, inter=0)
+        assert [i for i, _ in failures] == [1]
+        for i in (0, 2):
+            expected = reg.resample(flo, flo, affines[i], inter=0)
+            assert np.allclose(results[i], expected)
+
+    def test_resample_iter(self):
+        flo = common.create_square(self.matrix_size, size=self.object_size)
+        affines = [common.random_affine(rigid=True) for _ in range(8)]
+        submitted = []
+
+        def transforms():
+            for i, affine in enumerate(affines):
+                submitted.append(i)
+                yield affine
+
+        output = reg.resample_iter(flo, flo, transforms(), workers=2, inter=0)
+        i, result = next(output)
+        assert len(submitted) <= 4
+        assert sorted([i] + [j for j, _ in output]) == list(range(8))
+
     def test_aladin1(self):
         ref = utils.create_test_image(self.matrix_size)
         flo = common.rotate_array(ref, angle=45)
@@ -42,6 +112,14 @@ class TestReg:
         output = reg.aladin(ref, flo, user_opts="-voff")
         assert 1 - common.dice(ref, output[0]) < self.tol
 
+    def test_aladin_outputs(self):
+        ref = utils.create_test_image(self.matrix_size)
+        flo = common.rotate_array(ref, angle=45)
+        res, aff = reg.aladin(ref, flo, outputs="transform")
+        assert res is None and aff.shape == (4, 4)
+        res, aff = reg.aladin(ref, flo, outputs="lazy")
+        assert 1 - common.dice(ref, res.load()) < self.tol
+
     def test_aladin_rigonly(self):
         ref = common.create_circle(self.matrix_size, r=self.object_size // 2)
         flo = common.create_circle(
@@ -95,6 +173,21 @@ class TestReg:
         output = reg.f3d(ref, flo, nmi=True, rbn=2, fbn=2, verbose=self.verbose)
         assert 1 - common.dice(ref, output[0]) < self.tol
 
+    def test_f3d_trace(self):
+        ref = common.create_square(self.matrix_size, size=self.object_size)
+        flo = common.apply_swirl(
+            ref, self.matrix_size // 2, self.non_linearity, self.object_size
+        )
+        res, cpp, trace = reg.f3d(ref, flo, return_trace=True, verbose=self.verbose)
+        assert 1 - common.dice(ref, res) < self.tol
+        assert trace and all(e.kind == "iteration" for e in trace)
+        assert trace[-1].level == trace[-1].levels
+
+        res, cpp, trace = reg.f3d(
+            ref, flo, return_trace=True, stop_when=lambda trace: len(trace) > 2
+        )
+        assert res is None and cpp is None and len(trace) == 3
+
     def test_f3d_lncc(self):
         ref = common.create_square(self.matrix_size, size=self.object_size)
         flo = common.apply_swirl(